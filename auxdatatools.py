@@ -1,55 +1,244 @@
 ## Functions for doing quick queries on auxiliary data
 
+import re
 import sqlitetools
 from urllib.parse import urljoin
+from functools import lru_cache, wraps
+from numbers import Integral
+import numpy as np
 
 import presets
 
+staticdataindex_tables = ('Items', 'Regions', 'Systems', 'Stations', 'MarketGroups', 'bpProducts')
+staticdataindex_enabled = False # opt-in, see usestaticdataindex()
+staticdataindex = None
+marketgroupinfo = None # {marketGroupID : (parentGroupID, marketGroupName)}, see getmarketgroupancestry()
+marketgroupancestry = {}
+stationlocations = None # (stationIDs, systemIDs, regionIDs) arrays sorted by station ID, see getstationlocations()
+locationnames = None # {name : (kind, ID)} for every region, system & station, see getlocationnames()
+memo_maxsize = 4096 # max results kept per memoised function
+memoised_functions = [] # everything wrapped with memoise(), so they can all be cleared together
+numeric_text = re.compile(r'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*') # text that SQLite takes as a number when comparing it with a numeric column
+
+class StaticDataIndex:
+    # in-memory copy of the static aux data tables, so lookups don't need a SQL query each time
+    # tables are indexed by their ID and name columns on load, other columns are indexed on first use
+    # values looked up are converted by the column's type affinity first, as SQLite does, so e.g. typeID '34' finds the same rows as in SQL
+
+    def __init__(self, db=presets.auxdataDB, tables=staticdataindex_tables):
+        self.columns, self.affinities, self.rows, self.indexes = {}, {}, {}, {}
+
+        for table in tables:
+            cols = tuple(col.lower() for col in sqlitetools.columnsindbtable(db, table)) # SQL column names are case-insensitive, so we are too
+            self.columns[table] = {col : ii for ii, col in enumerate(cols)}
+            self.affinities[table] = {row[1].lower() : sqlaffinity(row[2]) for row in sqlitetools.getdbconnection(db, readonly=True).execute('''PRAGMA table_info(%s)''' % table)}
+            self.rows[table] = sqlitetools.getxbyyfromdb(db, table, cols, 'ALL', 'ALL') or []
+
+            for col in cols:
+                if col.endswith('id') or col.endswith('name'): self.getindex(table, (col,))
+
+    def getindex(self, table, y):
+        # get (building if necessary) a dict of {y values : [matching rows]} for columns y of table
+        key = (table, y)
+        if key not in self.indexes:
+            y_cols = tuple(self.columns[table][col] for col in y)
+
+            index = {}
+            for row in self.rows[table]:
+                y_val = tuple(row[ii] for ii in y_cols)
+                if None in y_val: continue # NULL never matches in SQL
+                index.setdefault(y_val, []).append(row)
+
+            self.indexes[key] = index
+
+        return self.indexes[key]
+
+    def hastable(self, table):
+        return table in self.rows
+
+    def getxbyy(self, table, x, y, y_val, flatten_on_single_match=True):
+        # same inputs and outputs as sqlitetools.getxbyyfromdb
+        if (isinstance(x, list) or isinstance(x, tuple)) and all(isinstance(ii, str) for ii in x):
+            multiselect = True
+            x_cols = tuple(self.columns[table][col.lower()] for col in x)
+        else:
+            multiselect = False
+            x_cols = (self.columns[table][x.lower()],)
+
+        if y == 'ALL' and y_val == 'ALL':
+            found = self.rows[table]
+        else:
+            if not (isinstance(y, list) or isinstance(y, tuple)): y, y_val = (y,), (y_val,)
+
+            if len(y) != len(y_val): raise Exception()
+
+            y = tuple(col.lower() for col in y)
+            found = self.getindex(table, y).get(tuple(applyaffinity(val, self.affinities[table][col]) for col, val in zip(y, y_val)), [])
+
+        if not found:
+            return None
+
+        if not multiselect:
+            x_val = tuple( row[x_cols[0]] for row in found )
+
+            if len(x_val) == 1 and flatten_on_single_match: x_val = x_val[0]
+
+        else:
+            x_val = [ tuple(row[ii] for ii in x_cols) for row in found ]
+
+        return x_val
+
+    def checkifitem(self, table, column, item):
+        # same as sqlitetools.checkifitemindb
+        return (applyaffinity(item, self.affinities[table][column.lower()]),) in self.getindex(table, (column.lower(),))
+
+def sqlaffinity(decltype):
+    # type affinity of a column with this declared type, by SQLite's rules (https://www.sqlite.org/datatype3.html)
+    decltype = (decltype or '').upper()
+
+    if 'INT' in decltype:
+        return 'INTEGER'
+    elif 'CHAR' in decltype or 'CLOB' in decltype or 'TEXT' in decltype:
+        return 'TEXT'
+    elif 'BLOB' in decltype or not decltype:
+        return 'BLOB'
+    elif 'REAL' in decltype or 'FLOA' in decltype or 'DOUB' in decltype:
+        return 'REAL'
+    else:
+        return 'NUMERIC'
+
+def applyaffinity(val, affinity):
+    # convert a value we're comparing with a column of this affinity the way SQLite would
+    if affinity in ('INTEGER', 'REAL', 'NUMERIC'):
+        if isinstance(val, str) and numeric_text.fullmatch(val):
+            try:
+                return int(val)
+            except ValueError:
+                return float(val)
+
+    elif affinity == 'TEXT':
+        if isinstance(val, Integral):
+            return str(int(val))
+        elif isinstance(val, float):
+            mantissa, e, exponent = ('%.15g' % val).partition('e') # SQLite always shows reals with a decimal point
+            return mantissa + ('' if '.' in mantissa or not mantissa[-1].isdigit() else '.0') + e + exponent
+
+    return val
+
+def usestaticdataindex(enable=True):
+    # turn on/off serving lookups from an in-memory StaticDataIndex instead of querying presets.auxdataDB
+    global staticdataindex_enabled
+
+    staticdataindex_enabled = enable
+    if not enable: invalidatestaticdataindex()
+
+def invalidatestaticdataindex():
+    # drop the index (and other cached static data), e.g. when the aux data DB has been rebuilt - it will be reloaded on next use
+    global staticdataindex, marketgroupinfo, stationlocations, locationnames
+
+    staticdataindex = None
+    marketgroupinfo = None
+    stationlocations = None
+    locationnames = None
+    marketgroupancestry.clear()
+
+def getstaticdataindex():
+    global staticdataindex
+
+    if not staticdataindex: staticdataindex = StaticDataIndex(presets.auxdataDB)
+
+    return staticdataindex
+
+def memoise(func):
+    # cache results of a lookup that only depends on the static data (bounded LRU), cleared with clearmemos() when the aux data DB changes
+    cached = lru_cache(maxsize=memo_maxsize)(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            hash((args, tuple(kwargs.items())))
+        except TypeError: # e.g. a list was passed in, can't cache that
+            return func(*args, **kwargs)
+
+        result = cached(*args, **kwargs)
+
+        return result.copy() if isinstance(result, dict) else result # so callers can't change what's in the cache
+
+    wrapper.cache_info, wrapper.cache_clear = cached.cache_info, cached.cache_clear
+    memoised_functions.append(wrapper)
+
+    return wrapper
+
+def clearmemos():
+    for func in memoised_functions: func.cache_clear()
+
+def getmemostats():
+    # {function name : (hits, misses, maxsize, currsize)} for everything memoised
+    return {'%s.%s' % (func.__module__, func.__name__) : func.cache_info() for func in memoised_functions}
+
+def getxbyy(table, x, y, y_val, flatten_on_single_match=True):
+    # query presets.auxdataDB, using the static data index if enabled
+    if staticdataindex_enabled and table in staticdataindex_tables:
+        return getstaticdataindex().getxbyy(table, x, y, y_val, flatten_on_single_match)
+    else:
+        return sqlitetools.getxbyyfromdb(presets.auxdataDB, table, x, y, y_val, flatten_on_single_match)
+
+def checkifitem(table, column, item):
+    if staticdataindex_enabled and table in staticdataindex_tables:
+        return getstaticdataindex().checkifitem(table, column, item)
+    else:
+        return sqlitetools.checkifitemindb(presets.auxdataDB, table, column, item)
+
 def urljoin_long(*args):
     # join a url using unlimited sections (like with os.path.join)
     return urljoin(args[0], '/'.join(args[1:]))
 
 def getregionID(name):
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Regions', 'regionID', 'regionName', name)
+    return getxbyy('Regions', 'regionID', 'regionName', name)
 
 def getregionName(ID):
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Regions', 'regionName', 'regionID', ID)
+    return getxbyy('Regions', 'regionName', 'regionID', ID)
 
 def isregion(region):
     if isinstance(region, str):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'Regions', 'regionName', region)
+        return checkifitem('Regions', 'regionName', region)
     elif isinstance(region, int):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'Regions', 'regionID', region)
+        return checkifitem('Regions', 'regionID', region)
     else:
         raise Exception()
 
 def getsystemID(name):
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Systems', 'solarSystemID', 'solarSystemName', name)
+    return getxbyy('Systems', 'solarSystemID', 'solarSystemName', name)
 
 def getsystemName(ID):
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Systems', 'solarSystemName', 'solarSystemID', ID)
+    return getxbyy('Systems', 'solarSystemName', 'solarSystemID', ID)
+
+def getregionsbyclass(space_type):
+    # IDs of all regions of a space type ('empire', 'null', 'wormhole' or 'jove'), see krabtools.doLocationClasses()
+    return getxbyy('RegionClass', 'regionID', 'spaceType', space_type, flatten_on_single_match=False) or ()
+
+def getsystemsbyclass(space_type=None, security_band=None, trade_hub=None):
+    # IDs of all systems matching the given classes e.g. getsystemsbyclass('empire', 'high') for all high-sec systems in empire regions
+    # space_type: 'empire', 'null', 'wormhole' or 'jove', security_band: 'high', 'low' or 'null', trade_hub: True/False, None for any
+    criteria = [(col, val) for col, val in (('spaceType', space_type), ('securityBand', security_band), ('isTradeHub', (None if trade_hub is None else int(trade_hub)))) if val is not None]
+
+    if not criteria: return getxbyy('SystemClass', 'solarsystemID', 'ALL', 'ALL', flatten_on_single_match=False) or ()
+
+    return getxbyy('SystemClass', 'solarsystemID', tuple(col for col, val in criteria), tuple(val for col, val in criteria), flatten_on_single_match=False) or ()
 
 def getsystemsecurity(system):
     if isinstance(system, str): system = getsystemID(system)
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Systems', 'Security', 'solarSystemID', system)
+    return getxbyy('Systems', 'Security', 'solarSystemID', system)
 
 def getsystemregion(system):
     if isinstance(system, str): system = getsystemID(system)
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Systems', 'regionID', 'solarSystemID', system)
+    return getxbyy('Systems', 'regionID', 'solarSystemID', system)
 
 def issystem(system):
     if isinstance(system, str):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'Systems', 'solarSystemName', system)
+        return checkifitem('Systems', 'solarSystemName', system)
     elif isinstance(system, int):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'Systems', 'solarSystemID', system)
-    else:
-        raise Exception()
-
-def isitem(item):
-    if isinstance(item, str):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'Items', 'typeName', item)
-    elif isinstance(item, int):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'Items', 'typeID', item)
+        return checkifitem('Systems', 'solarSystemID', system)
     else:
         raise Exception()
 
@@ -57,82 +246,139 @@ def isbp(bp):
     if isinstance(bp, str): bp = getitemid(bp)
 
     if isinstance(bp, int):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'bpProducts', 'typeID', bp)
+        return checkifitem('bpProducts', 'typeID', bp)
     else:
         raise Exception()
 
 def hasbp(item):
     item = getitemid(item)
 
-    return sqlitetools.checkifitemindb(presets.auxdataDB, 'bpProducts', 'productTypeID', item)
+    return checkifitem('bpProducts', 'productTypeID', item)
 
 def getstationid(name):
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Stations', 'stationID', 'stationName', name)
+    return getxbyy('Stations', 'stationID', 'stationName', name)
 
 def getstationname(ID):
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Stations', 'stationName', 'stationID', ID)
+    return getxbyy('Stations', 'stationName', 'stationID', ID)
 
 def getstationcorp(station):
     if isinstance(station, str): station = getstationid(station)
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Stations', 'corporationID', 'stationID', station)
+    return getxbyy('Stations', 'corporationID', 'stationID', station)
 
 def getstationsystem(station):
     if isinstance(station, str): station = getstationid(station)
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Stations', 'solarSystemID', 'stationID', station)
+    return getxbyy('Stations', 'solarSystemID', 'stationID', station)
 
 def getstationregion(station):
     if isinstance(station, str): station = getstationid(station)
     return getsystemregion(getstationsystem(station))
 
+def getstationlocations():
+    # every station's ID, system and region as arrays sorted by station ID, loaded once, so lots of stations can be looked up at the same time
+    global stationlocations
+
+    if stationlocations is None:
+        entries = sqlitetools.getdbconnection(presets.auxdataDB, readonly=True).execute('''SELECT Stations.stationID, Stations.solarsystemID, Systems.regionID FROM Stations
+                                                                                            JOIN Systems ON Stations.solarsystemID = Systems.solarsystemID ORDER BY Stations.stationID''').fetchall()
+
+        stationlocations = tuple(np.array([entry[ii] for entry in entries], dtype=np.int64) for ii in range(3))
+
+    return stationlocations
+
+def getstationssystemsregions(stations):
+    # map an array of station IDs to arrays of their system & region IDs in one go, unknown stations get -1
+    stationIDs, systemIDs, regionIDs = getstationlocations()
+    stations = np.asarray(stations, dtype=np.int64)
+
+    if len(stationIDs) == 0: return np.full(len(stations), -1), np.full(len(stations), -1)
+
+    idx = np.minimum(np.searchsorted(stationIDs, stations), len(stationIDs) - 1)
+    found = stationIDs[idx] == stations
+
+    return np.where(found, systemIDs[idx], -1), np.where(found, regionIDs[idx], -1)
+
 def isstation(station):
     if isinstance(station, str):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'Stations', 'stationName', station)
+        return checkifitem('Stations', 'stationName', station)
     elif isinstance(station, int):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'Stations', 'stationID', station)
+        return checkifitem('Stations', 'stationID', station)
     else:
         raise Exception()
 
-def islocation(location):
-    return (isregion(location) or issystem(location) or isstation(location))
+def getlocationnames():
+    # {name : (kind, ID)} for every region, system & station, loaded once
+    # if a name is used for more than one kind of location, regions win over systems and systems over stations (same as getlocationid() always did)
+    global locationnames
+
+    if locationnames is None:
+        names = {}
+        for kind, table, idcol, namecol in (('station', 'Stations', 'stationID', 'stationName'), ('system', 'Systems', 'solarsystemID', 'solarsystemName'), ('region', 'Regions', 'regionID', 'regionName')):
+            for ID, name in sqlitetools.getxbyyfromdb(presets.auxdataDB, table, (idcol, namecol), 'ALL', 'ALL') or []: names[name] = (kind, ID)
+
+        locationnames = names
+
+    return locationnames
+
+def resolvelocation(location):
+    # (kind, ID) of a location name or ID, kind is 'region', 'system' or 'station', or (None, None) if it isn't a location
+    # IDs are classified by their range (presets.location_ID_ranges), only IDs outside these are looked up in the DB
+    # IDs can be any kind of integer e.g. numpy ints from order arrays, and are always returned as plain ints
+    if isinstance(location, str):
+        return getlocationnames().get(location, (None, None))
+
+    elif isinstance(location, Integral) and not isinstance(location, bool):
+        location = int(location)
+
+        for kind, (first, last) in presets.location_ID_ranges:
+            if first <= location <= last: return (kind, location)
+
+        for kind, check in (('region', isregion), ('system', issystem), ('station', isstation)):
+            if check(location): return (kind, location)
+
+        return (None, None)
 
-def getlocationid(location):
-    if isregion(location):
-        return getregionID(location)
-    elif issystem(location):
-        return getsystemID(location)
-    elif isstation(location):
-        return getstationid(location)
     else:
         raise Exception()
 
+def islocation(location):
+    return resolvelocation(location)[0] is not None
+
+def getlocationid(location):
+    kind, ID = resolvelocation(location)
+    if kind is None: raise Exception('Unknown location: %s' % location)
+
+    return ID
+
 def getlocationname(location):
-    if isregion(location):
-        return getregionName(location)
-    elif issystem(location):
-        return getsystemName(location)
-    elif isstation(location):
-        return getstationname(location)
+    kind, ID = resolvelocation(location)
+
+    if kind == 'region':
+        return getregionName(ID)
+    elif kind == 'system':
+        return getsystemName(ID)
+    elif kind == 'station':
+        return getstationname(ID)
     else:
-        raise Exception()
+        raise Exception('Unknown location: %s' % location)
 
 def getlocationregion(location):
-    if isinstance(location, str): location = getlocationid(location)
-
-    if isregion(location):
-        return location
-    elif issystem(location):
-        return getsystemregion(location)
-    elif isstation(location):
-        return getstationregion(location)
+    kind, ID = resolvelocation(location)
+
+    if kind == 'region':
+        return ID
+    elif kind == 'system':
+        return getsystemregion(ID)
+    elif kind == 'station':
+        return getstationregion(ID)
     else:
-        raise Exception()
+        raise Exception('Unknown location: %s' % location)
 
 def getitemid(name):
     if isitem(name):
         if isinstance(name, int):
             return name
         if isinstance(name, str):
-            return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Items', 'typeID', 'typeName', name)
+            return getxbyy('Items', 'typeID', 'typeName', name)
         else:
             raise Exception('Unexpected type for item: %s (%s)' % (name, type(name)))
     else:
@@ -143,7 +389,7 @@ def getitemName(ID):
         if isinstance(ID, str):
             return ID
         if isinstance(ID, int):
-            return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Items', 'typeName', 'typeID', ID)
+            return getxbyy('Items', 'typeName', 'typeID', ID)
         else:
             raise Exception()
     else:
@@ -173,32 +419,37 @@ def geticonurl(itemID, size):
 
 def isitem(item):
     if isinstance(item, str):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'Items', 'typeName', item)
+        return checkifitem('Items', 'typeName', item)
     elif isinstance(item, int):
-        return sqlitetools.checkifitemindb(presets.auxdataDB, 'Items', 'typeID', item)
+        return checkifitem('Items', 'typeID', item)
     else:
         raise Exception('Unexpected type for item: %s (%s), expecting int (ID) or str (name)' % (item, type(item)) )
 
 def getallmarketitems():
+    if staticdataindex_enabled: return getxbyy('Items', 'typeID', 'ALL', 'ALL', flatten_on_single_match=False)
+
     return sqlitetools.getallitemsfromdbcol(presets.auxdataDB, 'Items', 'typeID')
 
+@memoise
 def getbpIDforitem(item):
     # get the ID for the BP that produces the given item, if it exists
     item = getitemid(item) # get item ID if necessary
 
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'bpProducts', 'typeID', 'productTypeID', item)
+    return getxbyy('bpProducts', 'typeID', 'productTypeID', item)
 
+@memoise
 def getmatsforbp(bp, activity='Manufacturing'):
     # get the inputs needed for specified BP (1 run, no ME modifiers)
     if isinstance(activity, str): activity = presets.bp_activities[activity]
 
-    mats_list = sqlitetools.getxbyyfromdb(presets.auxdataDB, 'bpMaterials', ('materialTypeID', 'quantity'), ('typeID', 'activityID'), (bp, activity))
+    mats_list = getxbyy('bpMaterials', ('materialTypeID', 'quantity'), ('typeID', 'activityID'), (bp, activity))
 
     mats_dict = {}
     for mat in mats_list: mats_dict[mat[0]] = mat[1]
 
     return mats_dict
 
+@memoise
 def isT2(check):
     # checks if an item (or its BP) is T2, by finding if its BP can be produce by invention
     # check: item (name or ID) or BP (ID) to check
@@ -208,7 +459,7 @@ def isT2(check):
     else:
         bp = getbpIDforitem(check)
 
-    entries = sqlitetools.getxbyyfromdb(presets.auxdataDB, 'bpProducts', 'activityID', 'productTypeID', bp, flatten_on_single_match=False)
+    entries = getxbyy('bpProducts', 'activityID', 'productTypeID', bp, flatten_on_single_match=False)
   
     # this probably isn't necessary, but just in case there's more than one way of making a BP we check that it's due to Invention
     if entries:
@@ -219,6 +470,7 @@ def isT2(check):
 
     return False
 
+@memoise
 def getinventbase(product):
     # gets the T1 BP ID from which a T2/T3 item's BP is invented
     # product: T2/T3 item (name or ID) or BP (ID)
@@ -230,7 +482,7 @@ def getinventbase(product):
         bp_T2 = getbpIDforitem(product)
 
     activityID_invent = presets.bp_activities['Invention']
-    bp_T1 = sqlitetools.getxbyyfromdb(presets.auxdataDB, 'bpProducts', 'typeID', ('productTypeID', 'activityID'), (bp_T2, activityID_invent), flatten_on_single_match=True)
+    bp_T1 = getxbyy('bpProducts', 'typeID', ('productTypeID', 'activityID'), (bp_T2, activityID_invent), flatten_on_single_match=True)
 
     return bp_T1
 
@@ -242,20 +494,42 @@ def ishullsection(item):
     else:
         return False
 
+def getmarketgroupancestry(marketgroupid):
+    # get a market group and all the groups above it, up to its master group e.g. (group, parent, parent's parent..., master group)
+    # the whole market group tree is loaded once and the results are cached
+    global marketgroupinfo
+
+    if marketgroupid not in marketgroupancestry:
+        if not marketgroupinfo: marketgroupinfo = {entry[0] : (entry[1], entry[2]) for entry in getxbyy('MarketGroups', ('marketGroupID', 'parentGroupID', 'marketGroupName'), 'ALL', 'ALL')}
+
+        ancestry = [marketgroupid]
+        while ancestry[-1] in marketgroupinfo and marketgroupinfo[ancestry[-1]][0] and len(ancestry) <= len(marketgroupinfo):
+            ancestry.append(marketgroupinfo[ancestry[-1]][0])
+
+        marketgroupancestry[marketgroupid] = tuple(ancestry)
+
+    return marketgroupancestry[marketgroupid]
+
+def getmarketgroupname(marketgroupid):
+    getmarketgroupancestry(marketgroupid) # make sure group info is loaded
+
+    return marketgroupinfo[marketgroupid][1] if marketgroupid in marketgroupinfo else None
+
 def getBPproductgroup(bp):
     bp = getitemid(bp)
-    marketgroupid = sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Items', 'marketGroupID', 'typeID', bp, flatten_on_single_match=True)
-    parentgroupid = sqlitetools.getxbyyfromdb(presets.auxdataDB, 'MarketGroups', 'parentGroupID', 'marketGroupID', marketgroupid, flatten_on_single_match=True)
-    parentgroupname = sqlitetools.getxbyyfromdb(presets.auxdataDB, 'MarketGroups', 'marketGroupName', 'marketGroupID', parentgroupid, flatten_on_single_match=True)
+    marketgroupid = getxbyy('Items', 'marketGroupID', 'typeID', bp, flatten_on_single_match=True)
+    ancestry = getmarketgroupancestry(marketgroupid)
+    parentgroupname = getmarketgroupname(ancestry[1]) if len(ancestry) > 1 else None
 
-    if 'Rigs' in parentgroupname: parentgroupname = 'Rigs'
+    if parentgroupname and 'Rigs' in parentgroupname: parentgroupname = 'Rigs'
 
     return parentgroupname
 
+@memoise
 def getBPtime(bp, activity):
     if isinstance(activity, str): activity = presets.bp_activities[activity]
 
-    time = sqlitetools.getxbyyfromdb(presets.auxdataDB, 'bpTimes', 'time', ('typeID', 'activityID'), (bp, activity), flatten_on_single_match=True)
+    time = getxbyy('bpTimes', 'time', ('typeID', 'activityID'), (bp, activity), flatten_on_single_match=True)
 
     return time
 
@@ -1,13 +1,46 @@
 ## Tools for talking to CREST
 
+import sys
 import requests
 import json
 from math import floor
-from urllib.parse import urljoin
+from statistics import mean, median
+from collections import deque
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urljoin, urlencode
+from email.utils import parsedate_to_datetime
+from datetime import timezone
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlitetools
+import presets
 
 CREST_public_baseURL = 'https://public-crest.eveonline.com/'
 CREST_public_rateLimits = {'rate' : 100, 'burst' : 100, 'safety_margin' : 0.8} # safety margin reduces rate limits e.g. 0.8 will use 80% of the official rate limit
+CREST_max_workers = 20 # max concurrent requests for getcrestdatamany()
+
+TokenBucket_lock = threading.Lock() # token bucket is shared between all threads making requests
+
+HTTP_pool_size = CREST_max_workers # connections kept alive per host, should be at least the number of concurrent requests
+HTTP_max_retries = 3 # retries for failed connections & server errors, before our own retry handling kicks in
+HTTP_session = None
+HTTP_session_lock = threading.Lock() # the threads of getcrestdatamany() may all want the session before it has been made
+
+print_lock = threading.Lock() # so messages from concurrent requests don't get mixed up on the console, see printstatus()
+status_line = '' # what printstatus() last left on the console
+
+HTTP_latencies = deque(maxlen=1000) # times (s) of recent requests, see getrequeststats()
+HTTP_latencies_lock = threading.Lock()
+
+# how long (s) responses are cached for, by request type, if the server doesn't tell us with Cache-Control/Expires
+# request types not listed here are not cached
+CREST_cache_TTLs = {'dailystats' : 6*3600, 'buyorders' : 300, 'sellorders' : 300, 'allorders' : 300, 'adjprices' : 24*3600}
+CREST_cache_keep_stale = 24*3600 # how long (s) after expiring a response is kept so it can be revalidated, if it has an ETag/Last-Modified
+CREST_cache_enabled = True
+CREST_cache_initialised = False
 
 class TokensOverCapacity(Exception):
     pass
@@ -22,6 +55,68 @@ def urljoin_long(*args):
     # join a url using unlimited sections (like with os.path.join)
     return urljoin(args[0], '/'.join(args[1:]))
 
+def getsession():
+    # get the shared HTTP session, so connections are kept alive and reused between requests rather than setting up TCP/TLS every time
+    global HTTP_session
+
+    with HTTP_session_lock:
+        if not HTTP_session:
+            retries = Retry(total=HTTP_max_retries, connect=HTTP_max_retries, read=0, backoff_factor=0.5, status_forcelist=(502, 503, 504), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_pool_size, pool_maxsize=HTTP_pool_size, max_retries=retries)
+
+            HTTP_session = requests.Session()
+            HTTP_session.mount('http://', adapter)
+            HTTP_session.mount('https://', adapter)
+            HTTP_session.headers.update({'Accept-Encoding' : 'gzip, deflate'})
+
+        return HTTP_session
+
+def closesession():
+    global HTTP_session
+
+    with HTTP_session_lock:
+        if HTTP_session:
+            HTTP_session.close()
+            HTTP_session = None
+
+def printstatus(msg):
+    # show msg on a status line that each call overwrites, '' to finish the line, safe to call from any thread
+    global status_line
+
+    with print_lock:
+        if msg:
+            if not status_line: print('')
+            print('\r' + msg + ' ' * max(len(status_line) - len(msg), 0), end='')
+        elif status_line:
+            print('')
+
+        status_line = msg
+        sys.stdout.flush()
+
+def httprequest(method, url, **kwargs):
+    # make an HTTP request using the shared session, recording how long it took
+    start_time = time.time()
+
+    resp = getsession().request(method, url, **kwargs)
+
+    with HTTP_latencies_lock:
+        HTTP_latencies.append(time.time() - start_time)
+
+    return resp
+
+def getrequeststats():
+    # latency stats for recent requests, for seeing how long we're spending waiting on the network
+    with HTTP_latencies_lock:
+        latencies = tuple(HTTP_latencies)
+
+    if not latencies: return {'nRequests' : 0, 'meanLatency' : None, 'medianLatency' : None, 'maxLatency' : None}
+
+    return {'nRequests' : len(latencies), 'meanLatency' : mean(latencies), 'medianLatency' : median(latencies), 'maxLatency' : max(latencies)}
+
+def resetrequeststats():
+    with HTTP_latencies_lock:
+        HTTP_latencies.clear()
+
 def getcresturl(reqtype, **kwargs):
     def check_kwargs(args_to_check_for, args_to_check=kwargs.keys()):
         if not set(args_to_check_for).issubset(kwargs): raise Exception('Missing required input argument(s), expected %s got %s' % (args_to_check_for, args_to_check))
@@ -39,6 +134,11 @@ def getcresturl(reqtype, **kwargs):
         CRESTUrl = urljoin_long(CREST_public_baseURL, 'market', str(kwargs['regionID']), 'orders', ('buy' if reqtype == 'buyorders' else 'sell'))
         CRESTParams = {'type' : urljoin_long(CREST_public_baseURL, 'types', str(kwargs['typeID']))}
 
+    elif reqtype == 'allorders':
+        check_kwargs(('regionID',))
+
+        CRESTUrl = urljoin_long(CREST_public_baseURL, 'market', str(kwargs['regionID']), 'orders', 'all')
+
     elif reqtype == 'adjprices':
         CRESTUrl = urljoin_long(CREST_public_baseURL, 'market', 'prices')
 
@@ -55,6 +155,95 @@ def getcresturl(reqtype, **kwargs):
     else:
         return CRESTUrl
 
+def getcrestreqtype(url):
+    # work out which type of request (as used by getcresturl()) a CREST url is for
+    path = url.split('?')[0].rstrip('/')
+
+    if path.endswith('/history'):
+        return 'dailystats'
+    elif path.endswith('/orders/buy'):
+        return 'buyorders'
+    elif path.endswith('/orders/sell'):
+        return 'sellorders'
+    elif path.endswith('/orders/all'):
+        return 'allorders'
+    elif path.endswith('/market/prices'):
+        return 'adjprices'
+    else:
+        return None
+
+def initcrestcache():
+    global CREST_cache_initialised
+
+    conn = sqlitetools.getdbconnection(presets.crestcacheDB)
+
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS Responses
+                        (cacheKey TEXT PRIMARY KEY,
+                        body TEXT,
+                        etag TEXT,
+                        lastModified TEXT,
+                        expires REAL
+                        )''')
+
+        # drop responses that have expired and can't be revalidated, or have been expired for too long to be worth it
+        conn.execute('''DELETE FROM Responses WHERE expires < ? OR (expires < ? AND etag IS NULL AND lastModified IS NULL)''', (time.time() - CREST_cache_keep_stale, time.time()))
+
+    CREST_cache_initialised = True
+
+def getcachekey(url, params=None):
+    return url + ('?' + urlencode(sorted(params.items())) if params else '')
+
+def getcachedresponse(key):
+    # returns (body, etag, lastModified, expires) for a cached response, or None if we don't have it
+    if not CREST_cache_initialised: initcrestcache()
+
+    found = sqlitetools.getdbconnection(presets.crestcacheDB).execute('''SELECT body, etag, lastModified, expires FROM Responses WHERE cacheKey=?''', (key,)).fetchall()
+
+    return found[0] if found else None
+
+def getcacheexpiry(resp, reqtype):
+    # work out when a response goes stale, from the response's headers if it has any, otherwise the TTL for this request type
+    # returns None if the response shouldn't be cached
+    cache_control = [ii.strip().lower() for ii in resp.headers.get('Cache-Control', '').split(',')]
+
+    if 'no-store' in cache_control: return None
+    if 'no-cache' in cache_control: return time.time() # can store, but must revalidate every time
+
+    for directive in cache_control:
+        if directive.startswith('max-age='):
+            try:
+                return time.time() + int(directive[len('max-age='):])
+            except ValueError:
+                pass
+
+    if 'Expires' in resp.headers:
+        try:
+            expires = parsedate_to_datetime(resp.headers['Expires'])
+            if expires.tzinfo is None: expires = expires.replace(tzinfo=timezone.utc) # a -0000 offset comes back naive, but it's still UTC
+
+            return expires.timestamp()
+        except (TypeError, ValueError):
+            return time.time() # invalid Expires means already expired
+
+    return time.time() + CREST_cache_TTLs[reqtype]
+
+def storecachedresponse(key, body, etag, lastModified, expires):
+    if not CREST_cache_initialised: initcrestcache()
+
+    conn = sqlitetools.getdbconnection(presets.crestcacheDB)
+
+    with conn:
+        conn.execute('''INSERT OR REPLACE INTO Responses VALUES (?,?,?,?,?)''', (key, body, etag, lastModified, expires))
+
+def clearcrestcache():
+    if not CREST_cache_initialised: initcrestcache()
+
+    conn = sqlitetools.getdbconnection(presets.crestcacheDB)
+
+    with conn:
+        conn.execute('''DELETE FROM Responses''')
+
 def inittokenbucket():
     global TokenBucket, TokenBucket_rate, TokenBucket_capacity, TokenBucket_last_update
 
@@ -85,22 +274,55 @@ def refilltokenbucket():
 def overridetokenbucket(tokens):
     global TokenBucket
 
-    TokenBucket = tokens
+    with TokenBucket_lock:
+        TokenBucket = tokens
 
 def consumetokens(tokens_consumed):
     global TokenBucket
 
-    refilltokenbucket()
+    with TokenBucket_lock:
+        if 'TokenBucket' not in globals(): inittokenbucket()
 
-    if tokens_consumed > TokenBucket_capacity:
-        raise TokensOverCapacity('Token Bucket capacity: ', TokenBucket_capacity, ', Tokens requested: ', tokens_consumed)
-    elif tokens_consumed > TokenBucket:
-        raise NotEnoughTokens('Token Bucket contents: ', TokenBucket, ', Tokens requested: ', tokens_consumed)
-    else:
-        TokenBucket -= tokens_consumed
+        refilltokenbucket()
+
+        if tokens_consumed > TokenBucket_capacity:
+            raise TokensOverCapacity('Token Bucket capacity: ', TokenBucket_capacity, ', Tokens requested: ', tokens_consumed)
+        elif tokens_consumed > TokenBucket:
+            raise NotEnoughTokens('Token Bucket contents: ', TokenBucket, ', Tokens requested: ', tokens_consumed)
+        else:
+            TokenBucket -= tokens_consumed
+
+def getcrestdatamany(reqs, max_workers=CREST_max_workers):
+    # get a batch of CREST resources concurrently, all threads share the token bucket so we still stay inside the rate limit
+    # reqs: iterable of urls or (url, params) pairs, as given by getcresturl()
+    # returns data in the same order as reqs
+    reqs = [(req if isinstance(req, tuple) else (req, None)) for req in reqs]
+
+    if len(reqs) <= 1 or max_workers <= 1: return [getcrestdata(url, params) for url, params in reqs]
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(reqs))) as executor:
+            return list(executor.map(lambda req: getcrestdata(*req), reqs))
+    finally:
+        sqlitetools.prunedbconnections() # the workers have finished, so close the cache connections they opened
 
 def getcrestdata(url, params=None):
-    if 'TokenBucket' not in globals(): inittokenbucket()
+    reqtype = getcrestreqtype(url)
+    use_cache = CREST_cache_enabled and reqtype in CREST_cache_TTLs
+
+    if use_cache:
+        cache_key = getcachekey(url, params)
+        cached = getcachedresponse(cache_key)
+
+        if cached and cached[3] > time.time(): return json.loads(cached[0]) # still fresh, no need to ask the server
+
+        # if we have a stale copy, ask the server to only send the data if it has changed
+        headers = {}
+        if cached and cached[1]: headers['If-None-Match'] = cached[1]
+        if cached and cached[2]: headers['If-Modified-Since'] = cached[2]
+    else:
+        cached, headers = None, {}
+
 
     token_timeout = 20 # retry period in seconds
     start_time, time_trying = time.time(), 0
@@ -111,20 +333,13 @@ def getcrestdata(url, params=None):
         except NotEnoughTokens:
             time.sleep(TokenBucket_rate * 2)
             time_trying = time.time() - start_time
-            if verbose and not already_slept:
-                print('')
-                print_str = ''
-            if verbose:
-                if len(print_str) > 0: print('\r' + ' '*len(print_str), end='\r')
-                print_str = 'Rate limit reached, sleeping (%ss)' % round(time_trying,2)
-                print(print_str, end='')
-                sys.stdout.flush()
+            if verbose: printstatus('Rate limit reached, sleeping (%ss)' % round(time_trying,2))
             already_slept = True
 
         else:
             break
     
-    if verbose and already_slept: print('')
+    if verbose and already_slept: printstatus('')
     if time_trying >= token_timeout: raise TokenRefillTimeout('Tokens did not refill in timeout period!')
 
     conn_timeout = 15
@@ -133,7 +348,7 @@ def getcrestdata(url, params=None):
         tries += 1
         if tries > 1: print('retrying %s/%s' % (tries, max_tries))
         try:
-            resp = requests.get(url, params, timeout=conn_timeout)
+            resp = httprequest('GET', url, params=params, headers=headers, timeout=conn_timeout)
         except requests.exceptions.ReadTimeout as e:
             if tries < max_tries:
                 if verbose:
@@ -167,7 +382,30 @@ def getcrestdata(url, params=None):
         print(resp.url)
         print(str(resp.status_code) + ': ' + json.loads(resp.text)['message'] + '\n')
         raise
-    
-    data = json.loads(resp.text)
+
+    if use_cache and cached and resp.status_code == 304: # not modified, so our copy is good for a while longer
+        body, etag, lastModified = cached[0], resp.headers.get('ETag', cached[1]), resp.headers.get('Last-Modified', cached[2])
+    else:
+        body, etag, lastModified = resp.text, resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+
+    if use_cache:
+        expires = getcacheexpiry(resp, reqtype)
+        if expires is not None: storecachedresponse(cache_key, body, etag, lastModified, expires)
+
+    data = json.loads(body)
 
     return data
+
+def getcrestpages(url, params=None):
+    # get a paged CREST resource, following the 'next' links until we run out of pages
+    # yields the items from each page as it comes in, so big resources (e.g. a whole region's orders) don't have to be held in memory
+    page = 0
+    while url:
+        data = getcrestdata(url, params)
+
+        page += 1
+        if verbose > 1: print('Got page %s/%s' % (page, data['pageCount'] if 'pageCount' in data else '?'))
+
+        yield data['items']
+
+        url, params = (data['next']['href'], None) if 'next' in data else (None, None) # next href already has any params in it
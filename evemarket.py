@@ -1,12 +1,22 @@
 # Functions for dealing with market order data
 
 import sys
+import threading
+from datetime import datetime, timezone
 from statistics import mean, median, stdev, StatisticsError
 from numpy import percentile
+import numpy as np
 
 import auxdatatools
 import sqlitetools
 import crest
+import presets
+
+bulkorders_enabled = False # see usebulkorders()
+orderbookDBs_initialised = set()
+priceDBs_initialised = set() # see initpriceDB()
+price_TTL = 3600 # seconds, default time before a stored price needs refreshing
+autosaving = set() # PriceLists with an autosave thread running, see stopautosaves()
 
 def getdailystats(item, region, days_back=1):
     # CREST history returns data for previous 13 months, days_back specifies how many days of data to retrieve
@@ -19,25 +29,114 @@ def getdailystats(item, region, days_back=1):
     return list(reversed(stats))[0:days_back]
 
 def getorders(item, location, order_type):
-    order_type = order_type.lower()
-    if isinstance(item, str): item = auxdatatools.getitemid(item)
-    if isinstance(location, str): location = auxdatatools.getlocationid(location)
+    return getordersmany([(item, location)], order_type)[0]
+
+def getordersmany(itemlocations, order_type):
+    # get orders for a batch of (item, location) pairs, with the CREST requests made concurrently
+    # returns a list of orders for each pair, in the same order as itemlocations
+    return getordersbatch([(item, location, order_type) for item, location in itemlocations])
 
-    region = auxdatatools.getlocationregion(location)
+def getordersbatch(reqs):
+    # same as getordersmany, but for (item, location, order_type) so buy & sell orders can be pulled in the same batch
+    reqs = [( (auxdatatools.getitemid(item) if isinstance(item, str) else item), (auxdatatools.getlocationid(location) if isinstance(location, str) else location), order_type.lower() ) for item, location, order_type in reqs]
 
-    if order_type == 'buy':
-        url, params = crest.getcresturl('BuyOrders', regionID=region, typeID=item)
-    elif order_type == 'sell':
-        url, params = crest.getcresturl('SellOrders', regionID=region, typeID=item)
+    if any(order_type not in ('buy', 'sell') for item, location, order_type in reqs): raise Exception()
+
+    regions = [auxdatatools.getlocationregion(location) for item, location, order_type in reqs]
+
+    if bulkorders_enabled:
+        regionOrders_list = [getsnapshotorders(item, region, order_type) for (item, location, order_type), region in zip(reqs, regions)]
     else:
-        raise Exception()
+        urls = [crest.getcresturl(('BuyOrders' if order_type == 'buy' else 'SellOrders'), regionID=region, typeID=item) for (item, location, order_type), region in zip(reqs, regions)]
+
+        regionOrders_list = [data['items'] for data in crest.getcrestdatamany(urls)]
+
+    orders_list = []
+    for (item, location, order_type), regionOrders in zip(reqs, regionOrders_list):
+        kind = auxdatatools.resolvelocation(location)[0]
+
+        if kind == 'region':
+            orders_list.append(regionOrders)
+        elif kind in ('system', 'station'):
+            orders_list.append(selectordersbylocation(regionOrders, location))
+        else:
+            orders_list.append(None)
+
+    return orders_list
+
+def usebulkorders(enable=True):
+    # turn on/off answering order requests from local snapshots of whole regions' order books (see pullregionorders())
+    # instead of a CREST request per item
+    global bulkorders_enabled
+
+    if enable: initorderbookDB()
+
+    bulkorders_enabled = enable
+
+def initorderbookDB(db=presets.orderbookDB):
+    # only needs doing once per DB per session
+    if db in orderbookDBs_initialised: return
+
+    conn = sqlitetools.getdbconnection(db)
+
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS Orders
+                        (regionID INT,
+                        typeID INT,
+                        locationID INT,
+                        buy INT,
+                        price REAL,
+                        volume INT,
+                        issued TEXT
+                        )''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS OrdersByType ON Orders(typeID, buy, regionID)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS OrderSnapshots
+                        (regionID INT PRIMARY KEY,
+                        pulled TEXT
+                        )''')
+
+    orderbookDBs_initialised.add(db)
+
+def pullregionorders(region, db=presets.orderbookDB):
+    # pull every order in a region from CREST in one paged pass and store as the region's snapshot, replacing any older one
+    # the number of requests depends only on the number of pages, not the number of items
+    if isinstance(region, str): region = auxdatatools.getregionID(region)
+
+    initorderbookDB(db)
+
+    if verbose: print('Pulling order book for %s...' % auxdatatools.getregionName(region))
 
-    regionOrders =  crest.getcrestdata(url, params)['items']
+    conn = sqlitetools.getdbconnection(db)
 
-    if auxdatatools.isregion(location):
-        return regionOrders
-    elif auxdatatools.issystem(location) or auxdatatools.isstation(location):
-        return selectordersbylocation(regionOrders, location)
+    with conn: # all in one transaction, so if the pull fails part way through we keep the old snapshot
+        conn.execute('''DELETE FROM Orders WHERE regionID=?''', (region,))
+
+        for page in crest.getcrestpages(crest.getcresturl('AllOrders', regionID=region)):
+            conn.executemany('''INSERT INTO Orders VALUES (?,?,?,?,?,?,?)''',
+                                [(region, order['type'], order['stationID'], int(order['buy']), order['price'], order['volume'], order['issued']) for order in page])
+
+        conn.execute('''INSERT OR REPLACE INTO OrderSnapshots VALUES (?,?)''', (region, datetime.now(timezone.utc).isoformat()))
+
+    if verbose: print('done.')
+
+def hasregionsnapshot(region, db=presets.orderbookDB, max_age=None):
+    # whether we have a snapshot of the region's order book that is no more than max_age seconds old (default presets.orderbook_snapshot_TTL)
+    if max_age is None: max_age = presets.orderbook_snapshot_TTL
+
+    pulled = sqlitetools.getxbyyfromdb(db, 'OrderSnapshots', 'pulled', 'regionID', region)
+    if pulled is None: return False
+
+    return (datetime.now(timezone.utc) - datetime.fromisoformat(pulled)).total_seconds() <= max_age
+
+def getsnapshotorders(item, region, order_type, db=presets.orderbookDB):
+    # get an item's orders in a region from the local snapshot, pulling the region's order book first if we don't have it or it's out of date
+    # orders are returned in the same form as CREST gives for a single item, so they can be used with all the functions below
+    initorderbookDB(db)
+    if not hasregionsnapshot(region, db): pullregionorders(region, db)
+
+    entries = sqlitetools.getxbyyfromdb(db, 'Orders', ('locationID', 'price', 'volume', 'issued'), ('typeID', 'buy', 'regionID'), (item, int(order_type == 'buy'), region)) or []
+
+    return [{'location' : {'id' : entry[0]}, 'price' : entry[1], 'volume' : entry[2], 'issued' : entry[3], 'buy' : order_type == 'buy'} for entry in entries]
 
 def getbuyorders(item, location):
     return getorders(item, location, 'Buy')
@@ -55,16 +154,31 @@ def getorderregion(order):
     return auxdatatools.getstationregion(getorderstation(order))
 
 def selectordersbylocation(orders, location):
-    if isinstance(location, str): location = auxdatatools.getlocationid(location)
+    return selectordersbylocations(orders, [location])[0]
+
+def selectordersbylocations(orders, locations):
+    # split orders by location (station, system or region) e.g. a region's orders into each of its systems
+    # the orders' stations are mapped to systems & regions once, then each location is a single array comparison
+    # returns list of orders for each location, in the same order as locations
+    stations = np.fromiter((getorderstation(order) for order in orders), dtype=np.int64, count=len(orders))
+    systems, regions = auxdatatools.getstationssystemsregions(stations)
+
+    found_orders_list = []
+    for location in locations:
+        kind, location = auxdatatools.resolvelocation(location)
+
+        if kind == 'station':
+            found = stations == location
+        elif kind == 'system':
+            found = systems == location
+        elif kind == 'region':
+            found = regions == location
+        else:
+            found = np.zeros(len(orders), dtype=bool)
 
-    found_orders = []
-    for order in orders:
-        if (auxdatatools.isstation(location) and getorderstation(order) == location) \
-        or (auxdatatools.issystem(location) and getordersystem(order) == location) \
-        or (auxdatatools.isregion(location) and getorderregion(order) == location):
-            found_orders.append(order)
+        found_orders_list.append([orders[ii] for ii in np.flatnonzero(found)])
 
-    return found_orders
+    return found_orders_list
 
 def getordertime(order):
     return order['issued']
@@ -90,24 +204,84 @@ def getpercentilepriceoforders(orders, pctile):
 def gettotalvolumeoforders(orders):
     return sum([getordervolume(order) for order in orders])
 
+def getorderarrays(orders):
+    # (prices, volumes) of orders as arrays, so stats can be done on them without going through the orders again
+    prices = np.fromiter((getorderprice(order) for order in orders), dtype=np.float64, count=len(orders))
+    volumes = np.fromiter((getordervolume(order) for order in orders), dtype=np.float64, count=len(orders))
+
+    return prices, volumes
+
+def calcorderstats(prices, pctiles=(5, 95)):
+    # all the price stats for a set of orders in one go, from a price array e.g. from getorderarrays()
+    # mean & std dev are done by statistics like getmeanpriceoforders()/getstdpriceoforders(), numpy's can be an ulp out which changes how half-cent ties round
+    # returns dict, prices rounded to 2dp the same as the get...priceoforders() functions, or None if there are no orders
+    prices = np.asarray(prices, dtype=np.float64)
+    n_orders = len(prices)
+    if n_orders == 0: return None
+
+    prices_list = prices.tolist()
+    sorted_prices = np.sort(prices)
+
+    stats = {'nOrders' : n_orders,
+             'meanPrice' : round(mean(prices_list), 2),
+             'medianPrice' : round(float(np.median(sorted_prices)), 2),
+             'stdPrice' : (round(stdev(prices_list), 2) if n_orders > 1 else 0), # sample std dev isn't defined for 1 order
+             'percentilePrices' : {pctile : round(pctileprice, 2) for pctile, pctileprice in zip(pctiles, np.percentile(sorted_prices, pctiles))} # rounded as numpy floats, same as getpercentilepriceoforders()
+             }
+
+    return stats
+
+def calcfillcosts(prices, volumes, quantities, order_type):
+    # cost of filling each of quantities by taking orders of order_type best price first (lowest for sell orders, highest for buy orders)
+    # uses running totals of volume & cost over the sorted book, so any number of quantities can be priced against it at once
+    # if the book doesn't have enough volume the rest is priced at the worst price in it, returns None for all if there are no orders
+    prices, volumes = np.asarray(prices, dtype=np.float64), np.asarray(volumes, dtype=np.float64)
+    quantities = np.asarray(quantities, dtype=np.float64)
+
+    if len(prices) == 0: return [None] * len(quantities)
+
+    order = np.argsort(prices, kind='stable')
+    if order_type == 'buy': order = order[::-1]
+    prices, volumes = prices[order], volumes[order]
+
+    cum_volumes, cum_costs = np.cumsum(volumes), np.cumsum(prices * volumes)
+
+    idx = np.minimum(np.searchsorted(cum_volumes, quantities, side='left'), len(prices) - 1) # order that each quantity finishes filling on
+    volume_before, cost_before = np.where(idx > 0, cum_volumes[idx - 1], 0), np.where(idx > 0, cum_costs[idx - 1], 0)
+
+    costs = cost_before + (quantities - volume_before) * prices[idx]
+
+    if verbose and (quantities > cum_volumes[-1]).any(): print('Not enough volume on the market to fill %s, pricing the rest at the worst price' % quantities[quantities > cum_volumes[-1]])
+
+    return [round(float(cost), 2) for cost in costs]
+
+def getmatslistfillcosts(matslist, order_type, location='Jita'):
+    # true cost of buying every material in a materials list (quantities included) by taking orders of order_type at location
+    # all the orders are pulled in one batch, so with bulk orders on everything is priced against the same order book snapshot
+    # returns {matID : cost}, raises an exception if there are no orders at all for one of the materials, as it can't be priced
+    matIDs = [auxdatatools.getitemid(mat) for mat in matslist]
+    quantities = [matslist[mat] for mat in matslist]
+
+    orders_list = getordersbatch([(matID, location, order_type) for matID in matIDs])
+
+    costs = {}
+    for matID, quantity, orders in zip(matIDs, quantities, orders_list):
+        costs[matID] = calcfillcosts(*getorderarrays(orders), [quantity], order_type)[0]
+        if costs[matID] is None: raise Exception('No %s orders for %s at %s, cannot price it' % (order_type, auxdatatools.getitemName(matID), location))
+
+    return costs
+
 def getitemstats(item, location, order_type, orders=None, get_region_stats=True, return_type='tuple'):
-    if not orders: orders = getorders(item, location, order_type) # pull orders from CREST if orders not supplied
+    if orders is None: orders = getorders(item, location, order_type) # pull orders from CREST if orders not supplied
 
     if len(orders) == 0:
         meanPrice, medianPrice, stdPrice, percentilePrice, nOrders = None, None, None, None, None
     else:
-        meanPrice, medianPrice = getmeanpriceoforders(orders), getmedianpriceoforders(orders)
-        percentilePrice = ( getpercentilepriceoforders(orders, 95) if order_type == 'buy' else getpercentilepriceoforders(orders, 5) ) # highest 5% for buy, lowest 5% for sell
-        try:
-            stdPrice = getstdpriceoforders(orders)
-        except StatisticsError:
-            if len(orders) == 1:
-                stdPrice = 0
-            else:
-                print(orders)
-                raise
-        
-        nOrders = len(orders)
+        pctile = (95 if order_type == 'buy' else 5) # highest 5% for buy, lowest 5% for sell
+
+        stats = calcorderstats(getorderarrays(orders)[0], pctiles=(pctile,))
+
+        meanPrice, medianPrice, stdPrice, percentilePrice, nOrders = stats['meanPrice'], stats['medianPrice'], stats['stdPrice'], stats['percentilePrices'][pctile], stats['nOrders']
         
     if get_region_stats:
         region = auxdatatools.getlocationregion(location)
@@ -166,19 +340,12 @@ def getpricelist(items, order_type, location='Jita'):
 
     pricelist = {}
 
-    if verbose > 1: counter, print_str = 0, ''
-    for item in items:
-        if verbose > 1:
-            counter += 1
-            if len(print_str) > 0: print('\r' + ' '*len(print_str), end='\r')
-            print_str = 'Getting price for item %s/%s...' % (counter, len(items))
-            print(print_str, end='')
-            sys.stdout.flush()
-        
-        item = auxdatatools.getitemid(item)
+    items = [auxdatatools.getitemid(item) for item in items]
 
-        price = getitemstats(item, location, order_type, get_region_stats=False, return_type='dict')['percentilePrice']
+    if verbose > 1: print('Getting prices for %s items...' % len(items), end='')
+    sys.stdout.flush()
 
+    for item, price in zip(items, getpricesbatch([(item, order_type, location) for item in items])): # pull all the orders in one go
         if item not in pricelist: pricelist[item] = {}
         pricelist[item][order_type] = price
 
@@ -186,6 +353,13 @@ def getpricelist(items, order_type, location='Jita'):
 
     return pricelist
 
+def getpricesbatch(reqs):
+    # get the price used for price lists for each (item, order_type, location), with all the orders pulled in one batch
+    # returns list of prices in the same order as reqs
+    orders_list = getordersbatch([(item, location, order_type) for item, order_type, location in reqs])
+
+    return [getitemstats(item, location, order_type, orders=orders, get_region_stats=False, return_type='dict')['percentilePrice'] for (item, order_type, location), orders in zip(reqs, orders_list)]
+
 def combinepricelists(pricelist_master, pricelist_new, overwrite=True):
     # updates an older pricelist dict with newer prices and/or items
     # if overwrite is False, only new items will be added (previously existing prices will remain the same)
@@ -200,7 +374,11 @@ def combinepricelists(pricelist_master, pricelist_new, overwrite=True):
 
     return pricelist_master
 
-def refreshpricelist(pricelist, location='Jita'):
+def refreshpricelist(pricelist, location=None):
+    # location defaults to the PriceList's own, or Jita for a plain dict
+    if location is None: location = getattr(pricelist, 'location', 'Jita')
+    if isinstance(pricelist, PriceList): pricelist.checklocation(location)
+
     items_buy, items_sell = [], []
 
     for item in pricelist:
@@ -226,12 +404,30 @@ def iteminpricelist(item, pricelist, order_type):
 def addmissingitemstopricelist(items, pricelist, order_type, location='Jita'):
     if isinstance(items, str) or isinstance(items, int): items = [items]
 
-    missingitems = []
-    for item in items:
+    return fillpricegaps([(item, order_type, location) for item in items], pricelist)
+
+def fillpricegaps(reqs, pricelist):
+    # add prices for (item, order_type, location) to pricelist, only fetching the ones it doesn't have yet
+    # buy & sell gaps are fetched together in one batch, with duplicates removed, so there's one request per price actually missing
+    if isinstance(pricelist, PriceList):
+        for location in {req[2] for req in reqs}: pricelist.checklocation(location)
+
+    missing, seen = [], set()
+    for item, order_type, location in reqs:
         item = auxdatatools.getitemid(item)
-        if not iteminpricelist(item, pricelist, order_type): missingitems.append(item)
+        if (item, order_type, location) in seen or iteminpricelist(item, pricelist, order_type): continue
+
+        seen.add( (item, order_type, location) )
+        missing.append( (item, order_type, location) )
+
+    if missing:
+        if verbose > 1: print('Getting %s missing prices...' % len(missing))
 
-    if missingitems: pricelist = combinepricelists(pricelist, getpricelist(items, order_type, location))
+        for (item, order_type, location), price in zip(missing, getpricesbatch(missing)):
+            if item in pricelist:
+                pricelist[item][order_type] = price
+            else:
+                pricelist[item] = {order_type : price}
 
     return pricelist
 
@@ -300,29 +496,232 @@ def checkvalidskilllevel(skills):
         else:
             pass
 
-def savepricelisttoDB(pricelist, db):
-    sqlitetools.createtable(db, 'Prices', ('typeID INT PRIMARY KEY NOT NULL', 'buy REAL', 'sell REAL'))
-
-    pricelist_list = []
+def initpriceDB(db):
+    # prices are stored per (typeID, locationID, side), with when they were fetched and how long they're good for
+    # only needs doing once per DB per session, forget the DB with priceDBs_initialised.discard() if the file is deleted
+    if db in priceDBs_initialised: return
+
+    conn = sqlitetools.getdbconnection(db)
+
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS PriceSnapshots
+                        (typeID INT NOT NULL,
+                        locationID INT NOT NULL,
+                        side TEXT NOT NULL,
+                        price REAL,
+                        fetched_at REAL,
+                        ttl REAL,
+                        PRIMARY KEY (typeID, locationID, side)
+                        )''')
+
+        # price DBs from older versions have one buy & sell price per item (assumed Jita) and no timestamps, carry them over as stale entries
+        if 'Prices' in sqlitetools.tablesindb(db):
+            jita = auxdatatools.getlocationid('Jita')
+            for side in ('buy', 'sell'):
+                conn.execute('''INSERT OR IGNORE INTO PriceSnapshots SELECT typeID, ?, ?, {}, NULL, ? FROM Prices WHERE {} IS NOT NULL'''.format(side, side), (jita, side, price_TTL))
+            conn.execute('''DROP TABLE Prices''')
+
+    priceDBs_initialised.add(db)
+
+def savepricelisttoDB(pricelist, db, location='Jita', fetched_at=None, ttl=None):
+    # upsert prices for a location that were fetched at fetched_at (default now): every entry gets the new timestamp,
+    # but the price itself is only written when it is new or has changed
+    # returns number of prices written
+    initpriceDB(db)
+
+    if not isinstance(location, int): location = auxdatatools.getlocationid(location)
+    if fetched_at is None: fetched_at = datetime.now(timezone.utc).timestamp()
+    if ttl is None: ttl = price_TTL
+
+    entries = []
     for item in pricelist:
         for order_type in ('buy', 'sell'):
-            if order_type not in pricelist[item]: pricelist[item][order_type] = None
-        pricelist_list.append( (item, pricelist[item]['buy'], pricelist[item]['sell']) )
+            if order_type in pricelist[item]: entries.append( (item, location, order_type, pricelist[item][order_type], fetched_at, ttl) )
+
+    conn = sqlitetools.getdbconnection(db)
 
-    sqlitetools.insertmany(db, 'Prices', pricelist_list)
+    with conn:
+        # refresh the timestamps first, so an unchanged price is not re-fetched again as soon as it goes stale
+        conn.executemany('''UPDATE PriceSnapshots SET fetched_at=?, ttl=? WHERE typeID=? AND locationID=? AND side=?''',
+                         [(fetched_at, ttl, item, location, order_type) for item, location, order_type, _, _, _ in entries])
 
-def loadpricelistfromDB(db):
-    entries = sqlitetools.getxbyyfromdb(db, 'Prices', ('typeID', 'buy', 'sell'), 'ALL', 'ALL')
+        changes_before = conn.total_changes
+        conn.executemany('''INSERT INTO PriceSnapshots VALUES (?,?,?,?,?,?)
+                            ON CONFLICT (typeID, locationID, side) DO UPDATE SET price=excluded.price
+                            WHERE price IS NOT excluded.price''', entries)
+        n_written = conn.total_changes - changes_before
+
+    if verbose > 1: print('Saved %s of %s prices' % (n_written, len(entries)))
+
+    return n_written
+
+def loadpricelistfromDB(db, location='Jita'):
+    initpriceDB(db)
+
+    if not isinstance(location, int): location = auxdatatools.getlocationid(location)
+
+    entries = sqlitetools.getxbyyfromdb(db, 'PriceSnapshots', ('typeID', 'side', 'price'), 'locationID', location) or []
 
     pricelist = {}
 
     for entry in entries:
-        pricelist[entry[0]] = {}
-        pricelist[entry[0]]['buy'] = entry[1]
-        pricelist[entry[0]]['sell'] = entry[2]
+        if entry[0] not in pricelist: pricelist[entry[0]] = {}
+        pricelist[entry[0]][entry[1]] = entry[2]
 
     if verbose: print('loaded %s entries' % len(pricelist))
 
     return pricelist
 
+def getstaleprices(db, location=None):
+    # get (typeID, locationID, side) of stored prices which are older than their TTL, for one location or all of them
+    initpriceDB(db)
+
+    sql_cmd = '''SELECT typeID, locationID, side FROM PriceSnapshots WHERE (fetched_at IS NULL OR fetched_at + ttl < ?)'''
+    params = [datetime.now(timezone.utc).timestamp()]
+
+    if location is not None:
+        sql_cmd += ''' AND locationID=?'''
+        params.append(location if isinstance(location, int) else auxdatatools.getlocationid(location))
+
+    return sqlitetools.getdbconnection(db, readonly=True).execute(sql_cmd, params).fetchall()
+
+def refreshstalepricesinDB(db, location=None, ttl=None):
+    # re-fetch only the stored prices that have expired, and write them back with a new timestamp
+    # returns number of prices refreshed
+    stale = {}
+    for item, locationID, side in getstaleprices(db, location): stale.setdefault((locationID, side), []).append(item)
+
+    for (locationID, side), items in stale.items():
+        savepricelisttoDB(getpricelist(items, side, locationID), db, locationID, ttl=ttl)
+
+    return sum(len(items) for items in stale.values())
+
+class PriceListEntry(dict):
+    # {order_type : price} for one item in a PriceList, tells the PriceList whenever a price is set
+
+    def __init__(self, pricelist, item):
+        super().__init__()
+        self.pricelist, self.item = pricelist, item
+
+    def __setitem__(self, order_type, price):
+        # a price that was fetched again needs saving even if it hasn't changed, so its timestamp is refreshed
+        super().__setitem__(order_type, price)
+        self.pricelist.markdirty(self.item, order_type)
+
+    def update(self, prices):
+        for order_type, price in dict(prices).items(): self[order_type] = price
+
+class PriceList(dict):
+    # {typeID : {order_type : price}} like any other price list, but remembers which prices have been set since they were last saved
+    # so flush() only has to write those, and can be done every so often from a background thread (see startautosave())
+    # all prices are for one location, fillpricegaps() & refreshpricelist() won't put prices for anywhere else in it
+
+    def __init__(self, prices=None, location='Jita'):
+        super().__init__()
+        self.location = location
+        self.dirty = {} # (typeID, order_type) : time the price was set
+        self.lock = threading.RLock() # prices are changed by the GUI while autosave may be flushing them
+        self.autosave_thread, self.autosave_stop = None, threading.Event()
+        self.autosave_db, self.autosave_interval = None, None
+
+        if prices: self.update(prices)
+
+    def __setitem__(self, item, prices):
+        with self.lock:
+            entry = PriceListEntry(self, item)
+            super().__setitem__(item, entry)
+            entry.update(prices)
+
+    def __delitem__(self, item):
+        with self.lock:
+            super().__delitem__(item)
+            self.dirty = {entry: set_at for entry, set_at in self.dirty.items() if entry[0] != item}
+
+    def update(self, prices):
+        for item, itemprices in dict(prices).items():
+            if item in self:
+                self[item].update(itemprices)
+            else:
+                self[item] = itemprices
+
+    def clear(self):
+        # forget all prices in memory, prices already saved stay in the DB (use krabtools.deleteindypriceDB() to get rid of those)
+        with self.lock:
+            super().clear()
+            self.dirty.clear()
+
+    def checklocation(self, location):
+        if location != self.location and auxdatatools.getlocationid(location) != auxdatatools.getlocationid(self.location):
+            raise Exception('Price list is for %s, cannot add prices for %s' % (self.location, location))
+
+    def markdirty(self, item, order_type):
+        with self.lock: self.dirty[(item, order_type)] = datetime.now(timezone.utc).timestamp()
+
+    def markclean(self):
+        with self.lock: self.dirty.clear()
+
+    def isdirty(self):
+        return bool(self.dirty)
+
+    def load(self, db):
+        # replace contents with the prices stored for our location
+        prices = loadpricelistfromDB(db, self.location)
+
+        with self.lock:
+            self.clear()
+            self.update(prices)
+            self.markclean()
+
+    def flush(self, db):
+        # write only the prices set since the last flush, in one transaction
+        # they are all saved as fetched when the oldest of them was set, so none of them lives past its TTL
+        # returns number of prices written
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            changed = {}
+            for item, order_type in dirty: changed.setdefault(item, {})[order_type] = self[item][order_type]
+
+        if not changed: return 0
+
+        try:
+            return savepricelisttoDB(changed, db, self.location, fetched_at=min(dirty.values()))
+        except:
+            with self.lock: # try again next time, unless they've been set again since
+                for (item, order_type), set_at in dirty.items():
+                    if item in self: self.dirty.setdefault((item, order_type), set_at)
+            raise
 
+    def startautosave(self, db, interval=60):
+        # flush every interval seconds in a background thread, until stopautosave()
+        self.stopautosave()
+        self.autosave_stop.clear()
+        self.autosave_db, self.autosave_interval = db, interval
+
+        def autosave():
+            while not self.autosave_stop.wait(interval):
+                try:
+                    self.flush(db)
+                except Exception as e:
+                    print('Autosaving prices failed: %s' % e)
+
+        self.autosave_thread = threading.Thread(target=autosave, daemon=True)
+        self.autosave_thread.start()
+        autosaving.add(self)
+
+    def stopautosave(self):
+        # waits for a flush in progress to finish
+        if self.autosave_thread:
+            self.autosave_stop.set()
+            self.autosave_thread.join()
+            self.autosave_thread = None
+            autosaving.discard(self)
+
+    __hash__ = object.__hash__ # so it can go in autosaving, dicts aren't hashable
+
+def stopautosaves(db):
+    # stop every PriceList autosaving to db, e.g. before closing its connections
+    # returns the PriceLists stopped, so they can be started again
+    stopped = [pricelist for pricelist in list(autosaving) if pricelist.autosave_db == db]
+    for pricelist in stopped: pricelist.stopautosave()
+
+    return stopped
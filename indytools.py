@@ -1,4 +1,6 @@
 from math import ceil, floor
+import heapq
+import numpy as np
 
 import krabtools
 import sqlitetools
@@ -6,6 +8,91 @@ import auxdatatools
 import evemarket
 import presets
 
+verbose = 0
+blueprintgraph = None
+
+class BlueprintGraph:
+    # manufacturing tree, built once from the aux data BP tables so we don't need SQL queries to walk it
+    # each product typeID maps to the BP that makes it, the quantity produced per run, materials per run (no ME) and build time per run
+
+    def __init__(self, db=presets.auxdataDB):
+        activity = presets.bp_activities['Manufacturing']
+
+        self.bpIDs, self.outputqty, self.materials, self.times = {}, {}, {}, {}
+
+        bp_products = {}
+        for bp, productID, quantity in sqlitetools.getxbyyfromdb(db, 'bpProducts', ('typeID', 'productTypeID', 'quantity'), 'activityID', activity) or []:
+            if productID in self.bpIDs: continue # if more than one BP makes the same thing, use the first one
+            self.bpIDs[productID], self.outputqty[productID], self.materials[productID] = bp, quantity, {}
+            bp_products[bp] = productID
+
+        for bp, matID, quantity in sqlitetools.getxbyyfromdb(db, 'bpMaterials', ('typeID', 'materialTypeID', 'quantity'), 'activityID', activity) or []:
+            if bp in bp_products: self.materials[bp_products[bp]][matID] = quantity
+
+        for bp, time in sqlitetools.getxbyyfromdb(db, 'bpTimes', ('typeID', 'time'), 'activityID', activity) or []:
+            if bp in bp_products: self.times[bp_products[bp]] = time
+
+        self.order = self.toposort()
+        self.rank = {product : ii for ii, product in enumerate(self.order)} # position in order, anything a product is built from has a lower rank
+
+    def toposort(self):
+        # order products so that every product comes after anything it is built from
+        # getbasematsforitem() works back through this, so it knows the total needed of a component before it expands it
+        # also makes sure there are no loops in the tree
+        order, done, inprogress = [], set(), set()
+
+        for root in self.bpIDs:
+            if root in done: continue
+
+            stack = [(root, iter(self.materials[root]))]
+            inprogress.add(root)
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if child not in self.bpIDs or child in done: continue # base materials don't need ordering
+                    if child in inprogress: raise Exception('Loop in blueprint data: %s is built from itself' % child)
+                    inprogress.add(child)
+                    stack.append((child, iter(self.materials[child])))
+                    break
+                else: # all components of this node are done
+                    stack.pop()
+                    inprogress.remove(node)
+                    done.add(node)
+                    order.append(node)
+
+        return tuple(order)
+
+    def hasbp(self, item):
+        return item in self.bpIDs
+
+    def getbpID(self, item):
+        return self.bpIDs[item]
+
+    def getrank(self, item):
+        return self.rank[item]
+
+    def getoutputqty(self, item):
+        return self.outputqty[item]
+
+    def getmats(self, item):
+        return dict(self.materials[item]) # copy, so callers can't change the graph
+
+    def gettime(self, item):
+        return self.times[item]
+
+def getblueprintgraph():
+    global blueprintgraph
+
+    if not blueprintgraph: blueprintgraph = BlueprintGraph(presets.auxdataDB)
+
+    return blueprintgraph
+
+def invalidateblueprintgraph():
+    # drop the graph, e.g. when the aux data DB has been rebuilt - it will be rebuilt on next use
+    global blueprintgraph
+
+    blueprintgraph = None
+
 def getmatsforitem(item, n_produced=1, ME=0, production_efficiences=None, bpMaxRuns=float('inf')):
     # get the materials required to produce an item
     # n_produced is the number of items desired
@@ -28,7 +115,8 @@ def getmatsforitem(item, n_produced=1, ME=0, production_efficiences=None, bpMaxR
         matslist = combinematslists(mats_fullbp, mats_rem)
 
     else:
-        matslist = auxdatatools.getmatsforbp(auxdatatools.getbpIDforitem(item)) # get mats for 1 run w/o ME modifiers
+        if not isinstance(item, int): item = auxdatatools.getitemid(item)
+        matslist = getblueprintgraph().getmats(item) # get mats for 1 run w/o ME modifiers
 
         if runs > 1: matslist = scalematslistbyint(matslist, runs) # scale up to # of runs (this happens *before* ME calculations)
 
@@ -53,27 +141,27 @@ def getbasematsforitem(item, n_produced=1, ME=0, production_efficiences=None, ME
         for mat in top_mats: production_efficiences_components[mat] = production_efficiences_components['ALL']
         del production_efficiences_components['ALL']
 
-    base_mats = top_mats
+    bpgraph = getblueprintgraph()
 
-    while any([auxdatatools.hasbp(ii) for ii in base_mats]): # while we have anything that can be manufactured
+    # expand components in one pass down the tree, highest rank first, so every component has had all its demand added before it is expanded
+    # the heap holds the components we need which haven't been expanded yet
+    base_mats = dict(top_mats)
+    to_build = [(-bpgraph.getrank(matID), matID) for matID in base_mats if bpgraph.hasbp(matID)]
+    heapq.heapify(to_build)
 
-        temp_mats = {} # use temp dict to avoid confusing when add/removing entries
+    while to_build:
+        matID = heapq.heappop(to_build)[1]
+        matqty = base_mats.pop(matID)
 
-        for matID, matqty in base_mats.items():       
-            
-            if not auxdatatools.hasbp(matID): # if this component has no BP i.e. cannot be manufactured, it is already a base material
-                temp_mats[matID] = matqty
-            
-            else: # else get the materials needed from its BP
-                ME_thismat = ME_components[matID] if (matID in ME_components) else 0
-                production_efficiences_thismat = production_efficiences_components[matID] if (matID in production_efficiences_components) else None
-                bpMaxRuns_thismat = bpMaxRuns_components[matID] if (matID in bpMaxRuns_components) else float('inf')
-                
-                component_mats = getmatsforitem(matID, n_produced=matqty, ME=ME_thismat, production_efficiences=production_efficiences_thismat, bpMaxRuns=bpMaxRuns_thismat)
+        ME_thismat = ME_components[matID] if (matID in ME_components) else 0
+        production_efficiences_thismat = production_efficiences_components[matID] if (matID in production_efficiences_components) else None
+        bpMaxRuns_thismat = bpMaxRuns_components[matID] if (matID in bpMaxRuns_components) else float('inf')
 
-                temp_mats = combinematslists(temp_mats, component_mats)
+        component_mats = getmatsforitem(matID, n_produced=matqty, ME=ME_thismat, production_efficiences=production_efficiences_thismat, bpMaxRuns=bpMaxRuns_thismat)
 
-        base_mats = temp_mats
+        for compID, compqty in component_mats.items():
+            if compID not in base_mats and bpgraph.hasbp(compID): heapq.heappush(to_build, (-bpgraph.getrank(compID), compID))
+            base_mats[compID] = base_mats.get(compID, 0) + compqty
 
     return base_mats
 
@@ -96,54 +184,108 @@ def combinematslists(*args):
     else:
         raise Exception('Need at least 2 arguments') 
 
+def matslisttoarrays(matslist):
+    # split a materials list {typeID : qty} into parallel arrays of typeIDs and quantities
+    matIDs = np.fromiter(matslist.keys(), dtype=np.int64, count=len(matslist))
+    matqtys = np.fromiter(matslist.values(), dtype=np.int64, count=len(matslist))
+
+    return (matIDs, matqtys)
+
+def arraystomatslist(matIDs, matqtys):
+    return dict(zip(matIDs.tolist(), matqtys.tolist())) # tolist() gives us back plain python ints
+
 def scalematslistbyint(matslist, scale_factor):
     if not isinstance(scale_factor, int): raise Exception()
     
-    matslist_scaled = {}
-    for matID, matqty in matslist.items(): matslist_scaled[matID] = matqty * scale_factor
+    matIDs, matqtys = matslisttoarrays(matslist)
 
-    return matslist_scaled
+    return arraystomatslist(matIDs, matqtys * scale_factor)
 
-def scalematslistbyefficiency(matslist, runs, ME, production_efficiences=None):
-    # scales materials in materials list for ME level, and optionally additional material efficiency factors (e.g. skills, POS effects etc.)
+def getefficiencyscalefactors(production_efficiences):
+    # convert additional efficiency savings to scale factors e.g. 25% efficiency saving == 0.25 -> 0.75 scale factor
+    if not production_efficiences: return []
+
+    if not isinstance(production_efficiences, list) and not isinstance(production_efficiences, tuple):
+        if isinstance(production_efficiences, float):
+            production_efficiences = [production_efficiences] # if only one additional efficiency factor, cast as list to make iteration work
+        else:
+            raise Exception('Invalid efficiency factors: %s, must be list or tuple of floats' % production_efficiences)
+
+    additional_scale_factors = []
+    for arg in production_efficiences:
+        if not isinstance(arg, float) or not (arg >= 0 and arg < 1): raise Exception('Invalid efficiency factor: %s, must be fraction of 1' % arg)
+
+        additional_scale_factors.append(1 - arg)
+
+    return additional_scale_factors
+
+def checkvalidME(ME):
     if not isinstance(ME, int) and not (ME >= 0 and ME <= 10): raise Exception('Invalid ME: %s, must be int between 0 & 10' % ME)
-    
-    if production_efficiences:
-        additional_scale_factors = []
 
-        if not isinstance(production_efficiences, list) and not isinstance(production_efficiences, tuple):
-            if isinstance(production_efficiences, float):
-                production_efficiences = [production_efficiences] # if only one additional efficiency factor, cast as list to make iteration work
-            else:
-                raise Exception('Invalid efficiency factors: %s, must be list or tuple of floats' % production_efficiences)
+def applyefficiency(matqtys, runs, ME_scale_factors, additional_scale_factors):
+    # the actual ME calculation, on arrays of quantities and their runs & ME scale factors
+    # scale factors are applied one at a time in the same order as always, so floating point rounding is identical to doing it item by item
+    matqtys = matqtys * ME_scale_factors
+
+    for scale_factor in additional_scale_factors: matqtys = matqtys * scale_factor
 
-        for arg in production_efficiences:
-            if not isinstance(arg, float) or not (arg >= 0 and arg < 1): raise Exception('Invalid efficiency factor: %s, must be fraction of 1' % arg)
+    matqtys = np.where(matqtys / runs < 1, runs, np.ceil(matqtys)) # can't have less than 1 of a material per run
 
-            additional_scale_factors.append(1 - arg) # convert fractions to scale factor e.g. 25% efficiency saving == 0.25 -> 0.75 scale factor
+    return matqtys.astype(np.int64)
+
+def scalematslistbyefficiency(matslist, runs, ME, production_efficiences=None):
+    # scales materials in materials list for ME level, and optionally additional material efficiency factors (e.g. skills, POS effects etc.)
+    checkvalidME(ME)
+
+    additional_scale_factors = getefficiencyscalefactors(production_efficiences)
 
     ME_scale_factor = 1 - (ME * 0.01) # convert ME level to scale factor e.g. 9 ME == 9% saving -> 0.91 scale factor
 
-    matslist_scaled = {}
-    for matID, matqty in matslist.items():      
-        matqty *= ME_scale_factor
-    
-        if production_efficiences:
-            for scale_factor in additional_scale_factors: matqty *= scale_factor
+    matIDs, matqtys = matslisttoarrays(matslist)
 
-        if matqty/runs < 1: # can't have less than 1 matID per run
-            matqty = runs
-        else:
-            matqty = ceil(matqty)
+    return arraystomatslist(matIDs, applyefficiency(matqtys, runs, ME_scale_factor, additional_scale_factors))
+
+def getmatsforbpruns(configs, production_efficiences=None):
+    # get materials for a batch of BP jobs in one go e.g. to sweep ME 0-10 over lots of products
+    # configs: iterable of (product, runs, ME), product is item name or ID
+    # returns a list of materials lists in the same order as configs, same as getmatsforitem would give for each job (no max runs limit)
+    additional_scale_factors = getefficiencyscalefactors(production_efficiences)
+    bpgraph = getblueprintgraph()
+
+    all_IDs, all_qtys, all_runs, all_MEs, lengths = [], [], [], [], []
+    for product, runs, ME in configs:
+        checkvalidME(ME)
+        if not isinstance(product, int): product = auxdatatools.getitemid(product)
+
+        matIDs, matqtys = matslisttoarrays(bpgraph.getmats(product))
+
+        all_IDs.append(matIDs)
+        all_qtys.append(matqtys)
+        all_runs.append(runs)
+        all_MEs.append(ME)
+        lengths.append(len(matIDs))
+
+    if not lengths: return []
+
+    # flatten everything into single arrays, with each job's runs & ME repeated for each of its materials
+    matIDs, matqtys = np.concatenate(all_IDs), np.concatenate(all_qtys)
+    runs, MEs = np.repeat(np.array(all_runs, dtype=np.int64), lengths), np.repeat(np.array(all_MEs, dtype=np.int64), lengths)
 
-        matslist_scaled[matID] = matqty
+    matqtys = matqtys * runs # scale up to # of runs (this happens *before* ME calculations)
 
-    return matslist_scaled
+    ME_scale_factors = 1 - (MEs * 0.01)
+    matqtys_scaled = applyefficiency(matqtys, runs, ME_scale_factors, additional_scale_factors)
+    if not additional_scale_factors: matqtys_scaled = np.where(MEs > 0, matqtys_scaled, matqtys) # getmatsforitem skips the ME calculation for ME 0
 
+    splits = np.cumsum(lengths)[:-1]
+
+    return [arraystomatslist(jobIDs, jobqtys) for jobIDs, jobqtys in zip(np.split(matIDs, splits), np.split(matqtys_scaled, splits))]
+
+@auxdatatools.memoise
 def getrunsfornproducts(product, n_produced):
     # calc number of runs of a BP needed to make desired n of a given product (e.g. if BP produces 100 of product per run and we need 250, we must run BP 3 times)
-    product = auxdatatools.getitemid(product)
-    bp_output_quantity = sqlitetools.getxbyyfromdb(presets.auxdataDB, 'bpProducts', 'quantity', 'productTypeID', product)
+    if not isinstance(product, int): product = auxdatatools.getitemid(product)
+    bp_output_quantity = getblueprintgraph().getoutputqty(product)
 
     return(ceil(n_produced / bp_output_quantity))
 
@@ -221,7 +363,10 @@ def calcjobfee(item, runs, systemModifier, buildLocation='POS'):
         for ii, itm in enumerate(item): jobFeeList.append(calcjobfee(itm, runs[ii], systemModifier, buildLocation))
         return(jobFeeList)
 
-    jobFee = krabtools.getbasecostforitem(item) * runs * systemModifier
+    baseCost = krabtools.getbasecostforitem(item)
+    if baseCost is None: raise Exception('No base cost for %s, cannot work out its job fee' % item)
+
+    jobFee = baseCost * runs * systemModifier
 
     if buildLocation.lower() == 'station': jobFee += (jobFee * 0.1) # station tax is 10%
 
@@ -272,16 +417,25 @@ def calcbuildcosts(product, productRuns, **kwargs):
     else:
         systemModifier = kwargs['systemModifier']
 
-    if 'baseMatsPriceList' in kwargs and kwargs['baseMatsPriceList']:
-        baseMatsPriceList = kwargs['baseMatsPriceList']
+    if 'depthPricing' in kwargs and kwargs['depthPricing']:
+        # cost of actually buying the quantities needed from sell orders, walking up the order book, rather than 1 price * quantity
+        if verbose: print('Pulling orders...')
+        baseMatsPriceList = None
+        baseMatsOrderType = 'sell'
+        baseMatsCosts = evemarket.getmatslistfillcosts(baseMatsList, baseMatsOrderType, buySystem)
+
     else:
-        if verbose: print('Pulling prices...')
-        baseMatsPriceList = evemarket.getpricelist(basematids, 'buy', buySystem)
-    
-    baseMatsCosts = get_matslist_cost_from_pricelist(baseMatsList, baseMatsPriceList, order_type='buy', return_type='list')
+        if 'baseMatsPriceList' in kwargs and kwargs['baseMatsPriceList']:
+            baseMatsPriceList = kwargs['baseMatsPriceList']
+        else:
+            if verbose: print('Pulling prices...')
+            baseMatsPriceList = evemarket.getpricelist(basematids, 'buy', buySystem)
+
+        baseMatsOrderType = 'buy'
+        baseMatsCosts = get_matslist_cost_from_pricelist(baseMatsList, baseMatsPriceList, order_type=baseMatsOrderType, return_type='list')
 
     baseMatsBuyFees = {}
-    for basematID, basematcost in baseMatsCosts.items(): baseMatsBuyFees[basematID] = evemarket.calcbuyfee(basematcost, 'buy', skillBrokerRelations=1)
+    for basematID, basematcost in baseMatsCosts.items(): baseMatsBuyFees[basematID] = evemarket.calcbuyfee(basematcost, baseMatsOrderType, skillBrokerRelations=1)
 
     componentsBuildFees = {}
     for compID, comp_qty in componentsList.items():
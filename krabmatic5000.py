@@ -11,6 +11,8 @@ from PyQt5.QtGui import *
 
 import krabtools
 
+priceAutosaveInterval = 60 # seconds between background saves of changed market prices
+
 class OutLog:
     def __init__(self, editBox, out=None):
         """(editBox, out=None, color=None) -> can write stdout, stderr to a QTextEdit.
@@ -108,10 +110,11 @@ class IndyAppMain(QMainWindow):
 
         global masterPriceList
         
-        masterPriceList = {}
+        masterPriceList = krabtools.evemarket.PriceList(location='Jita')
 
         self.initUI()
         loadMasterPriceList()
+        masterPriceList.startautosave(krabtools.presets.indypriceDB, priceAutosaveInterval)
 
     def initUI(self):
         self.setWindowTitle('KrabMatic 5000')
@@ -206,7 +209,10 @@ class IndyAppMain(QMainWindow):
             appIsBusy = False
 
     def closeEvent(self, event):
-        if masterPriceList_hasBeenUpdated: saveMasterPriceList()
+        masterPriceList.stopautosave()
+        if masterPriceList.isdirty(): saveMasterPriceList() # only what's changed since the last autosave
+        krabtools.sqlitetools.closedbconnections()
+        krabtools.crest.closesession()
         event.accept()
 
 class mainInterfaceWidget(QWidget):
@@ -306,7 +312,7 @@ class mainInterfaceWidget(QWidget):
         krabtools.initauxdata()
         loadBPProducts()
         deleteAllIcons()
-        masterPriceList = {}
+        masterPriceList.clear()
         print('Initialisation complete.')
         
         self.forceUpdateAuxDataCBx.setChecked(False)
@@ -818,8 +824,7 @@ class buildWidget(QWidget):
         if self.inventmode: self.calcInventCost()
 
         # pull market prices as necessary
-        updateMasterPriceList(self.baseMatsList, 'buy', 'Jita')
-        updateMasterPriceList(self.productName, 'sell', 'Jita')
+        updateMasterPriceListMany([(mat, 'buy', 'Jita') for mat in self.baseMatsList] + [(self.productName, 'sell', 'Jita')])
 
         # work out costs
         self.buildCosts = krabtools.indytools.calcbuildcosts(self.productID, self.runstobuild, bpMaxRuns=self.runsperBP, baseMatsList=self.baseMatsList, componentsList=self.matsList, baseMatsPriceList=masterPriceList)
@@ -1041,22 +1046,18 @@ def checkProduct(product):
         return True
 
 def saveMasterPriceList():
-    global masterPriceList_hasBeenUpdated
-
     if not masterPriceList: # !TODO Add yes/no dialog box if price list is empty
         pass
     else:
         QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
 
         print('Saving market prices to %s...' % os.path.abspath(krabtools.presets.indypriceDB), end='')
-        krabtools.evemarket.savepricelisttoDB(masterPriceList, krabtools.presets.indypriceDB)
-
-        masterPriceList_hasBeenUpdated = False
+        print('saved %s changed prices' % masterPriceList.flush(krabtools.presets.indypriceDB))
         
         QApplication.restoreOverrideCursor()
 
 def loadMasterPriceList():
-    global masterPriceList, masterPriceList_hasBeenUpdated
+    global masterPriceList
 
     if not os.path.isfile(krabtools.presets.indypriceDB):
         print('Local price DB not found (%s)' % os.path.abspath(krabtools.presets.indypriceDB))
@@ -1065,37 +1066,35 @@ def loadMasterPriceList():
         QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
 
         print('Loading market prices from %s...' % os.path.abspath(krabtools.presets.indypriceDB), end='')
-        masterPriceList = krabtools.evemarket.loadpricelistfromDB(krabtools.presets.indypriceDB)
+        masterPriceList.load(krabtools.presets.indypriceDB)
 
         QApplication.restoreOverrideCursor()
 
-    masterPriceList_hasBeenUpdated = False
-
 def refreshMasterPriceList():
-    global masterPriceList, masterPriceList_hasBeenUpdated
+    global masterPriceList
 
     QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
 
     print('Refreshing %s cached market prices...' % len(masterPriceList))
-    masterPriceList = krabtools.evemarket.refreshpricelist(masterPriceList)
-
-    masterPriceList_hasBeenUpdated = True
+    masterPriceList.update(krabtools.evemarket.refreshpricelist(masterPriceList)) # only prices that have changed will need saving
     
     QApplication.restoreOverrideCursor()
 
 def updateMasterPriceList(items, order_type, location):
-    global masterPriceList, masterPriceList_hasBeenUpdated
-    masterPriceList_old = masterPriceList
-    masterPriceList = krabtools.evemarket.addmissingitemstopricelist(items, masterPriceList, order_type, location)
+    global masterPriceList
+    krabtools.evemarket.addmissingitemstopricelist(items, masterPriceList, order_type, location) # adds to masterPriceList in place, which keeps track of what's changed
 
-    if masterPriceList != masterPriceList_old: masterPriceList_hasBeenUpdated = True
+def updateMasterPriceListMany(reqs):
+    # reqs: (item, order_type, location), all missing prices are pulled together
+    global masterPriceList
+    krabtools.evemarket.fillpricegaps(reqs, masterPriceList)
 
 def clearMasterPriceList():
     global masterPriceList
 
-    masterPriceList = {}
+    masterPriceList.clear()
 
-    print('Master price list cleared')
+    print('Master price list cleared (saved prices are kept, delete the local price DB to remove them)')
 
 def deleteMasterPriceListDB():
     def checkIfSure():
@@ -1134,6 +1133,7 @@ if __name__ == '__main__':
     doPlatformSpecificSetup()
 
     krabtools.setverbosity(2)
+    krabtools.auxdatatools.usestaticdataindex()
 
     app = QApplication(sys.argv)
 
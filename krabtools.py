@@ -4,16 +4,19 @@ import csv
 import dateutil.parser
 import sqlite3
 import argparse
-import requests
 import bz2
 import re
+import hashlib
+import time
 
 from urllib.parse import urlparse
+from urllib.request import url2pathname
 from datetime import datetime, timezone
 from dateutil.tz import tzutc
 from statistics import mean, stdev, StatisticsError
 from math import ceil, floor
 from operator import itemgetter
+import numpy as np
 
 import sqlitetools
 import auxdatatools
@@ -26,7 +29,10 @@ import presets
 # non-standard dependencies: requests, xlrd
 
 auxdata_updated = False
+download_chunk_size = 64 * 1024 # bytes, downloads & decompression are done in chunks of this size so we never hold whole files in memory
 debug, verbose = False, 0 # defaults, will be overridden by docmdargs()
+adjprices_cache, basecosts_cache = None, None # {typeID : price}, loaded from the aux DB on first use
+auxdata_postprocessed_tables = ('Items', 'MarketGroups', 'bpMaterials', 'bpProducts') # changed in place after extraction (see initauxdata()), so never kept by an incremental update
 
 def docmdargs():
     global cmdargs, forceupdateauxdata, skip_aux_data_check
@@ -64,7 +70,7 @@ def passglobals():
     # pass on some global variables to sub modules
     global verbose, debug
 
-    sqlitetools.verbose, auxdatatools.verbose, crest.verbose, evemarket.verbose = verbose, verbose, verbose, verbose
+    sqlitetools.verbose, auxdatatools.verbose, crest.verbose, evemarket.verbose, indytools.verbose = verbose, verbose, verbose, verbose, verbose
     sqlitetools.debug, auxdatatools.debug, crest.debug, evemarket.debug = debug, debug, debug, debug
 
 def setverbosity(n):
@@ -86,42 +92,170 @@ def setdebug(n):
 def downloadfile(url, dlpath='./'):
     outfilepath = os.path.join(dlpath, os.path.basename(url))
 
-    r = requests.get(url)
+    r = crest.httprequest('GET', url, stream=True)
 
     with open(outfilepath, 'wb') as outfile:
-        for chunk in r.iter_content(1024):
+        for chunk in r.iter_content(download_chunk_size):
             outfile.write(chunk)
 
     return outfilepath
 
+def localpathforurl(url):
+    # if url is actually a local file (path or file:// url), get its path, otherwise None
+    # lets us use a local file as a stand-in for the server e.g. for testing
+    if os.path.isfile(url): return url
+
+    parsed = urlparse(url)
+    if parsed.scheme == 'file': return url2pathname(parsed.path)
+
+    return None
+
+def iterfilechunks(filepath, start=0, chunk_size=download_chunk_size):
+    with open(filepath, 'rb') as infile:
+        infile.seek(start)
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            yield chunk
+
+def openurlchunks(url, start=0, chunk_size=download_chunk_size, validator=None):
+    # open url to be read in chunks, from byte start onwards if the server will let us (HTTP Range request)
+    # validator is the ETag or Last-Modified of the response we got the first start bytes from, sent as If-Range so the server only
+    # sends the rest if the file hasn't changed since - without one we can't tell, so we start from the beginning
+    # returns (start, chunks, validator) - start will be 0 if we've had to start from the beginning, validator is for this response
+    localpath = localpathforurl(url)
+    if localpath: return (start, iterfilechunks(localpath, start, chunk_size), None)
+
+    if not validator: start = 0
+
+    headers = {'Accept-Encoding' : 'identity'} # no compression on top, so byte ranges match the file
+    if start: headers['Range'], headers['If-Range'] = 'bytes=%s-' % start, validator
+
+    r = crest.httprequest('GET', url, headers=headers, stream=True)
+    r.raise_for_status()
+
+    if start and r.status_code != 206: start = 0 # server ignored the range or the file has changed, so we're getting the whole file
+
+    etag = r.headers.get('ETag')
+    validator = (etag if etag and not etag.startswith('W/') else r.headers.get('Last-Modified')) # weak ETags can't be used with If-Range
+
+    return (start, r.iter_content(chunk_size), validator)
+
+def decompresschunk_bz2(decompressor, data, outfile):
+    # decompress a chunk of bz2 data, writing the output to outfile
+    # handles files made of several bz2 streams one after the other, so returns the decompressor to use for the next chunk
+    while data:
+        if decompressor.eof: decompressor = bz2.BZ2Decompressor()
+
+        outfile.write(decompressor.decompress(data))
+
+        data = decompressor.unused_data if decompressor.eof else b''
+
+    return decompressor
+
 def decompress_bz2(bz2file, outfilepath=None, deletebz2=False):
     if not outfilepath: outfilepath = os.path.splitext(bz2file)[0]
 
-    with open(bz2file, 'rb') as infile, open(outfilepath, 'wb') as outfile:
-        outfile.write(bz2.decompress(infile.read()))
+    decompressor = bz2.BZ2Decompressor()
+    with open(outfilepath, 'wb') as outfile:
+        for chunk in iterfilechunks(bz2file):
+            decompressor = decompresschunk_bz2(decompressor, chunk, outfile)
+
+    if not decompressor.eof: raise Exception('Incomplete bz2 file: %s' % bz2file)
 
     if deletebz2: os.remove(bz2file)
 
     return outfilepath
 
+def downloadanddecompress_bz2(url, outfilepath=None, dlpath='./', keepbz2=False):
+    # download a bz2 file and decompress it as it comes in
+    # the compressed data is saved to a .part file as we go, so if the download fails it can be resumed from where it stopped next time
+    # the ETag/Last-Modified of the download is kept next to it, so when resuming we can check the file on the server is still the same one
+    bz2file = os.path.join(dlpath, os.path.basename(urlparse(url).path))
+    partfile = bz2file + '.part'
+    if not outfilepath: outfilepath = os.path.splitext(bz2file)[0]
+
+    with open(outfilepath, 'wb') as outfile:
+        decompressor = continuedownload_bz2(url, partfile, outfile, resume=True)
+        if not decompressor: # partial file is corrupt, so throw away everything we have and start again
+            if verbose: print('Partial download is corrupt, starting again')
+            decompressor = continuedownload_bz2(url, partfile, outfile, resume=False)
+
+    # check we've got the whole thing, and that it is what we expect
+    if not decompressor.eof: raise Exception('Download incomplete: %s, run again to resume' % url)
+
+    with open(outfilepath, 'rb') as checkfile:
+        if checkfile.read(16) != b'SQLite format 3\x00': raise Exception('Downloaded file is not a SQLite DB: %s' % url)
+
+    if keepbz2:
+        os.replace(partfile, bz2file)
+    else:
+        os.remove(partfile)
+    if os.path.isfile(partfile + '.validator'): os.remove(partfile + '.validator')
+
+    return outfilepath
+
+def continuedownload_bz2(url, partfile, outfile, resume=True):
+    # download a bz2 file to partfile, decompressing it into outfile as it comes in
+    # if resume, first decompress whatever is already in partfile and carry on downloading from the end of it
+    # returns the decompressor, or None if the resumed data turns out to be corrupt (which may not show until the rest of it arrives)
+    outfile.seek(0)
+    outfile.truncate()
+    decompressor = bz2.BZ2Decompressor()
+
+    done = 0
+    if resume and os.path.isfile(partfile): # decompress what we already have to get back to where we were
+        try:
+            for chunk in iterfilechunks(partfile):
+                decompressor = decompresschunk_bz2(decompressor, chunk, outfile)
+        except (OSError, EOFError):
+            return None
+        done = os.path.getsize(partfile)
+        if verbose: print('Resuming download from %s bytes' % done)
+
+    if done and decompressor.eof: return decompressor # we already have all of it
+
+    validatorfile = partfile + '.validator'
+    validator = None
+    if done and os.path.isfile(validatorfile):
+        with open(validatorfile) as f: validator = f.read()
+
+    start, chunks, validator = openurlchunks(url, done, validator=validator)
+    if start != done: # server won't resume, so starting from scratch
+        outfile.seek(0)
+        outfile.truncate()
+        decompressor = bz2.BZ2Decompressor()
+
+    if not start: # new download, so remember what we're downloading for next time
+        if validator:
+            with open(validatorfile, 'w') as f: f.write(validator)
+        elif os.path.isfile(validatorfile):
+            os.remove(validatorfile)
+
+    with open(partfile, ('ab' if start else 'wb')) as part:
+        for chunk in chunks:
+            part.write(chunk)
+            try:
+                decompressor = decompresschunk_bz2(decompressor, chunk, outfile)
+            except (OSError, EOFError):
+                if start: return None # new data doesn't follow on from the old, so the old must be bad
+                raise
+
+    return decompressor
+
 def invert_dict(dict_in):
     return {v:k for k,v in dict_in.items()}
 
 def currenttimeUTC():
     return datetime.now(tzutc())
 
-def updateauxdata(url=presets.sde_fuzzwork_url, remove_temp_files=True):
+def updateauxdata(url=presets.sde_fuzzwork_url, remove_temp_files=True, incremental=False):
     global auxdata_updated
     auxdata_updated = True
 
-    if verbose: print('Downloading master data from %s...' % url)
-    mainDB = downloadfile(url=url)
-
-    if verbose: print('Decompressing...')
-    mainDB = decompress_bz2(mainDB, deletebz2=remove_temp_files)
+    if verbose: print('Downloading and decompressing master data from %s...' % url)
+    mainDB = downloadanddecompress_bz2(url, keepbz2=not remove_temp_files)
 
     if verbose: print('Extracting required data...')
-    createauxDB(mainDB)
+    createauxDB(mainDB, incremental=incremental)
 
     if verbose: print('Creating metadata...')
     storefileupdateinfo(currenttimeUTC(), getlastmodified(url), metadatafile='auxdata_meta.txt')
@@ -130,11 +264,66 @@ def updateauxdata(url=presets.sde_fuzzwork_url, remove_temp_files=True):
 
     if verbose: print('')
 
-def createauxDB(masterDB, auxDB=presets.auxdataDB):
-    for dataset in presets.auxdatainfo:
-        dbtable, srctable, cols_to_keep = dataset['desttable'], dataset['srctable'], dataset['cols_to_keep']
+def createauxDB(masterDB, auxDB=presets.auxdataDB, incremental=False):
+    # extract the tables we need from the master DB into the aux DB, all in one transaction
+    # tables get their primary keys up front, other indexes are made after the data is loaded (much faster than updating them on every insert)
+    # if incremental, only tables whose source data has changed since last time are rewritten, apart from the ones in auxdata_postprocessed_tables
+    # source data is only fingerprinted when it might let us skip a table, otherwise the table is marked to be rewritten next time too
+    conn = sqlitetools.getdbconnection(auxDB)
 
-        sqlitetools.copycolstonewDB(masterDB, srctable, auxDB, dbtable, cols_to_keep)
+    conn.execute('''ATTACH DATABASE "%s" AS dbsrc''' % masterDB)
+    try:
+        conn.execute('''CREATE TABLE IF NOT EXISTS AuxDataSources (tableName TEXT PRIMARY KEY, fingerprint TEXT)''')
+        conn.commit()
+
+        existing_tables = sqlitetools.tablesindb(auxDB)
+
+        conn.execute('''BEGIN''')
+
+        for dataset in presets.auxdatainfo:
+            dbtable, srctable, cols_to_keep = dataset['desttable'], dataset['srctable'], dataset['cols_to_keep']
+
+            keepable = incremental and dbtable not in auxdata_postprocessed_tables
+            fingerprint = getsourcefingerprint(conn, srctable, cols_to_keep) if keepable else None
+
+            if keepable and dbtable in existing_tables:
+                found = conn.execute('''SELECT fingerprint FROM AuxDataSources WHERE tableName=?''', (dbtable,)).fetchall()
+                if found and found[0][0] == fingerprint:
+                    if verbose > 1: print('%s unchanged, skipping' % dbtable)
+                    continue
+
+            if verbose > 1: print('Extracting %s...' % dbtable)
+
+            src_types = {row[1].lower() : row[2] for row in conn.execute('''PRAGMA dbsrc.table_info(%s)''' % srctable).fetchall()} # column name : declared type
+            coldefs = ['%s %s' % (col, src_types[col.lower()]) for col in cols_to_keep]
+            if dataset['primary_key']: coldefs.append('PRIMARY KEY (%s)' % ', '.join(dataset['primary_key']))
+
+            conn.execute('''DROP TABLE IF EXISTS %s''' % dbtable)
+            conn.execute('''CREATE TABLE %s (%s)''' % (dbtable, ', '.join(coldefs)))
+            conn.execute('''INSERT INTO %s SELECT %s FROM dbsrc.%s''' % (dbtable, ','.join(cols_to_keep), srctable))
+
+            for index_cols in dataset['indexes']:
+                conn.execute('''CREATE INDEX %s ON %s (%s)''' % ('_'.join((dbtable,) + index_cols), dbtable, ', '.join(index_cols)))
+
+            conn.execute('''INSERT OR REPLACE INTO AuxDataSources VALUES (?,?)''', (dbtable, fingerprint))
+
+        conn.commit()
+
+    except:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.execute('''DETACH DATABASE dbsrc''')
+
+def getsourcefingerprint(conn, srctable, cols):
+    # hash of the data we would take from a table in the master DB, so we can tell if it has changed
+    fingerprint = hashlib.sha1()
+
+    for row in conn.execute('''SELECT %s FROM dbsrc.%s ORDER BY rowid''' % (','.join(cols), srctable)):
+        fingerprint.update(repr(row).encode('utf-8'))
+
+    return fingerprint.hexdigest()
 
 def auxdataneedsupdate(dbfile=presets.auxdataDB, metadatafile='auxdata_meta.txt', url=presets.sde_fuzzwork_url):
     if verbose: print('Checking %s...' % presets.auxdataDB, end='')
@@ -163,7 +352,10 @@ def auxdataneedsupdate(dbfile=presets.auxdataDB, metadatafile='auxdata_meta.txt'
     return False
 
 def getlastmodified(url):
-    r = requests.head(url)
+    localpath = localpathforurl(url)
+    if localpath: return datetime.fromtimestamp(floor(os.path.getmtime(localpath)), tzutc())
+
+    r = crest.httprequest('HEAD', url)
 
     d = dateutil.parser.parse(r.headers['last-modified'])
 
@@ -189,136 +381,147 @@ def getfileupdateinfo(metadatafile):
     return (last_dl, last_mod)
 
 def doUltimateMarketGroups():
-    conn = sqlite3.connect(presets.auxdataDB)
-    c = conn.cursor()
-
-    # figure out what the ultimate group is for each marketGroup by following the parentGroups
-    if 'ultimateGroupID' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'MarketGroups'):
-        c.execute('''ALTER TABLE MarketGroups ADD COLUMN ultimateGroupID INT''')
-
-    d = conn.cursor() # we're going to need an extra cursor
-
-    c.execute('''SELECT MarketGroupID, ParentGroupID FROM MarketGroups WHERE ParentGroupID IS NOT NULL''') # get all records that have a parent ID (i.e. are not master market groups)
-    baserow = c.fetchone() # get the first record
-    try:
-        while baserow: # while we still have records
-            basemarketgroupID = baserow[0] # the original market group, the one we're finding an ultimate group for
-            
-            thismarketgroupID, thisparentID = baserow[0], baserow[1] # starting group & parent group IDs for iteration
-            while thisparentID: # while there is still a parentID i.e. there are more levels to go up
-                d.execute('''SELECT MarketGroupID, ParentGroupID FROM MarketGroups WHERE MarketGroupID=?''', (thisparentID,)) # get the record for the parentID
-                parentrow = d.fetchone()
-                thismarketgroupID, thisparentID = parentrow[0], parentrow[1] # get the IDs of this record
-                # if thisparentID exists, we still have a level to go up, so repeat for new parentID
-
-            # if parentID is NULL/None, we have hit a master group
-            d.execute('''UPDATE MarketGroups SET ultimateGroupID=? WHERE MarketGroupID=?''', (thismarketgroupID, basemarketgroupID)) # update ultimateGroupID of base record accordingly
-
-            baserow = c.fetchone() # get next row to work on
-    except:
-        print(baserow)
-        raise
-    finally:
-        conn.commit()
-        conn.close()
+    # figure out what the ultimate group is for each marketGroup by following the parentGroups, all in one go with a recursive query
+    # master market groups (no parent) are left as NULL
+    if 'ultimateGroupID' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'MarketGroups'): sqlitetools.addcolumntodbtable(presets.auxdataDB, 'MarketGroups', 'ultimateGroupID', 'INT')
+
+    conn = sqlitetools.getdbconnection(presets.auxdataDB)
+
+    with conn:
+        conn.execute('''DROP TABLE IF EXISTS temp.UltimateGroups''')
+
+        # chain: each group with a parent, paired with every group above it - the one with no parent is the ultimate group
+        # (depth limit is just a guard against loops in the data)
+        conn.execute('''CREATE TEMP TABLE UltimateGroups (marketGroupID INTEGER PRIMARY KEY, ultimateGroupID INT)''')
+        conn.execute('''INSERT INTO temp.UltimateGroups
+                        WITH RECURSIVE chain(baseGroupID, groupID, parentID, depth) AS (
+                            SELECT marketGroupID, marketGroupID, parentGroupID, 0 FROM MarketGroups WHERE parentGroupID IS NOT NULL
+                            UNION ALL
+                            SELECT chain.baseGroupID, MarketGroups.marketGroupID, MarketGroups.parentGroupID, chain.depth + 1
+                                FROM chain JOIN MarketGroups ON MarketGroups.marketGroupID = chain.parentID
+                                WHERE chain.depth < 100
+                            )
+                        SELECT baseGroupID, groupID FROM chain WHERE parentID IS NULL''')
+
+        conn.execute('''UPDATE MarketGroups SET ultimateGroupID =
+                            (SELECT ultimateGroupID FROM temp.UltimateGroups WHERE temp.UltimateGroups.marketGroupID = MarketGroups.marketGroupID)''')
+
+        conn.execute('''DROP TABLE temp.UltimateGroups''')
+
+def doLocationClasses():
+    # classify every region by space type (empire, null, wormhole, jove) and every system by space type, security band (high, low, null) and
+    # whether it's a trade hub, stored as indexed tables so finding e.g. all high-sec empire systems is a single query
+    if verbose: print('Classifying regions and systems...')
+
+    conn = sqlitetools.getdbconnection(presets.auxdataDB)
+
+    with conn:
+        conn.execute('''DROP TABLE IF EXISTS RegionClass''')
+        conn.execute('''CREATE TABLE RegionClass (regionID INTEGER PRIMARY KEY, spaceType TEXT NOT NULL)''')
+
+        # wormhole regions are named like A-R00001
+        conn.execute('''INSERT INTO RegionClass
+                        SELECT regionID, CASE WHEN regionName IN {} THEN 'jove'
+                                              WHEN regionName IN {} THEN 'null'
+                                              WHEN substr(regionName, 2, 1) = '-' AND length(regionName) > 3 AND substr(regionName, 4) NOT GLOB '*[^0-9]*' THEN 'wormhole'
+                                              ELSE 'empire' END
+                        FROM Regions'''.format(sqlitetools.sql_placeholder_of_length(len(presets.jove_regions)), sqlitetools.sql_placeholder_of_length(len(presets.null_regions))),
+                        presets.jove_regions + presets.null_regions)
+
+        conn.execute('''DROP TABLE IF EXISTS SystemClass''')
+        conn.execute('''CREATE TABLE SystemClass (solarsystemID INTEGER PRIMARY KEY, regionID INT, spaceType TEXT NOT NULL, securityBand TEXT NOT NULL, isTradeHub INT NOT NULL)''')
+
+        # security band goes by security rounded to 1 dp as shown in game, except anything above 0 is low-sec (the game shows it as 0.1)
+        conn.execute('''INSERT INTO SystemClass
+                        SELECT Systems.solarsystemID, Systems.regionID, RegionClass.spaceType,
+                               CASE WHEN ROUND(Systems.security, 1) >= 0.5 THEN 'high' WHEN Systems.security > 0 THEN 'low' ELSE 'null' END,
+                               Systems.solarsystemName IN {}
+                        FROM Systems JOIN RegionClass ON Systems.regionID = RegionClass.regionID'''.format(sqlitetools.sql_placeholder_of_length(len(presets.trade_hubs))),
+                        presets.trade_hubs)
+
+        conn.execute('''CREATE INDEX RegionClassBySpaceType ON RegionClass(spaceType)''')
+        conn.execute('''CREATE INDEX SystemClassByClass ON SystemClass(spaceType, securityBand, isTradeHub)''')
+        conn.execute('''CREATE INDEX SystemClassByRegion ON SystemClass(regionID)''')
 
 def flagitemDB():
+    # flag everything we don't want to trade, each category of items is flagged with a single UPDATE, all in one transaction
     if verbose: print('Flagging items to exclude from trading...')
 
-    items_to_flag = []
-
     if 'ExcludeFromTrade' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'Items'): sqlitetools.addcolumntodbtable(presets.auxdataDB, 'Items', 'ExcludeFromTrade', 'INT', 'DEFAULT 0')
 
-    conn = sqlite3.connect(presets.auxdataDB)
-    c = conn.cursor()
-
-    c.execute('''DELETE FROM Items WHERE typeID IS NULL''') # delete any entries without an typeID
-    c.execute('''DELETE FROM Items WHERE marketGroupID IS NULL AND typeName NOT LIKE ?''', ('%% Blueprint',)) # delete any entries without a marketGroupID, except T2 Blueprints
-
-    if verbose: print('Flagging items not available on market...')
-    items_to_flag.extend(c.execute('''SELECT typeID FROM Items WHERE marketGroupID IS NULL''').fetchall()) # delete entries with no marketGroupID i.e. cannot be sold on the market
-
-    if verbose: print('Flagging items without documented market group...')
-    items_to_flag.extend(c.execute('''SELECT Items.typeID FROM Items WHERE Items.marketGroupID not in (SELECT marketGroupID FROM MarketGroups)''').fetchall())
-
-    if verbose: print('Flagging officer items...')
-    items_to_flag.extend(c.execute('''SELECT typeID FROM Items WHERE typeName LIKE ?''', ('%%\'s Modified %',)).fetchall())
-    items_to_flag.extend(c.execute('''SELECT typeID FROM Items WHERE typeName LIKE ?''', ('%%s\' Modified %',)).fetchall())
+    conn = sqlitetools.getdbconnection(presets.auxdataDB)
 
     if verbose:
-        print('Flagging items in master market groups: ', end='')
         sql_cmd = '''SELECT marketGroupName FROM MarketGroups WHERE marketGroupID IN %s''' % sqlitetools.sql_placeholder_of_length(len(presets.ultimateMarketGroupsToSkip))
-        print(', '.join([jj[0] for jj in c.execute(sql_cmd, presets.ultimateMarketGroupsToSkip).fetchall()]))
-    
-    sql_cmd = '''SELECT Items.typeID FROM Items NATURAL JOIN MarketGroups WHERE MarketGroups.ultimateGroupID IN %s''' % sqlitetools.sql_placeholder_of_length(len(presets.ultimateMarketGroupsToSkip))
-    items_to_flag.extend(c.execute(sql_cmd, presets.ultimateMarketGroupsToSkip).fetchall())
+        ultimate_group_names = ', '.join([jj[0] for jj in conn.execute(sql_cmd, presets.ultimateMarketGroupsToSkip).fetchall()])
 
-    if verbose:
-        print('Flagging items in sub market groups: ', end='')
         sql_cmd = '''SELECT marketGroupName FROM MarketGroups WHERE marketGroupID IN %s''' % sqlitetools.sql_placeholder_of_length(len(presets.subMarketGroupsToSkip))
-        print(', '.join([jj[0] for jj in c.execute(sql_cmd, presets.subMarketGroupsToSkip).fetchall()]))
-
-    sql_cmd = '''SELECT typeID FROM Items WHERE marketGroupID IN %s''' % sqlitetools.sql_placeholder_of_length(len(presets.subMarketGroupsToSkip))
-    items_to_flag.extend(c.execute(sql_cmd, presets.subMarketGroupsToSkip).fetchall())
+        sub_group_names = ', '.join([jj[0] for jj in conn.execute(sql_cmd, presets.subMarketGroupsToSkip).fetchall()])
 
-    if verbose:
-        print('Flagging specific items: ', end='')
         sql_cmd = '''SELECT typeName FROM Items WHERE typeName IN %s''' % sqlitetools.sql_placeholder_of_length(len(presets.itemsToSkip))
-        print(', '.join([jj[0] for jj in c.execute(sql_cmd, presets.itemsToSkip).fetchall()]))
+        specific_item_names = ', '.join([jj[0] for jj in conn.execute(sql_cmd, presets.itemsToSkip).fetchall()])
+    else:
+        ultimate_group_names, sub_group_names, specific_item_names = '', '', ''
 
-    sql_cmd = '''SELECT typeID FROM Items WHERE typeName IN %s''' % sqlitetools.sql_placeholder_of_length(len(presets.itemsToSkip))
-    items_to_flag.extend(c.execute(sql_cmd, presets.itemsToSkip).fetchall())
+    # (description, WHERE clause for items to flag, parameters)
+    flag_categories = (
+        ('items not available on market', '''marketGroupID IS NULL''', ()),
+        ('items without documented market group', '''marketGroupID NOT IN (SELECT marketGroupID FROM MarketGroups)''', ()),
+        ('officer items', '''typeName LIKE ? OR typeName LIKE ?''', ('%%\'s Modified %', '%%s\' Modified %')),
+        ('items in master market groups: ' + ultimate_group_names,
+            '''marketGroupID IN (SELECT marketGroupID FROM MarketGroups WHERE ultimateGroupID IN %s)''' % sqlitetools.sql_placeholder_of_length(len(presets.ultimateMarketGroupsToSkip)), presets.ultimateMarketGroupsToSkip),
+        ('items in sub market groups: ' + sub_group_names,
+            '''marketGroupID IN %s''' % sqlitetools.sql_placeholder_of_length(len(presets.subMarketGroupsToSkip)), presets.subMarketGroupsToSkip),
+        ('specific items: ' + specific_item_names,
+            '''typeName IN %s''' % sqlitetools.sql_placeholder_of_length(len(presets.itemsToSkip)), presets.itemsToSkip),
+        )
 
-    items_to_flag = [ii[0] for ii in items_to_flag] # flatten list [(x1,), (x2,)...] -> [x1, x2...]
+    start_time = time.time()
 
-    for item in items_to_flag: c.execute('''UPDATE Items SET ExcludeFromTrade=1 WHERE typeID = %s''' % item)
+    with conn:
+        conn.execute('''DELETE FROM Items WHERE typeID IS NULL''') # delete any entries without an typeID
+        conn.execute('''DELETE FROM Items WHERE marketGroupID IS NULL AND typeName NOT LIKE ?''', ('%% Blueprint',)) # delete any entries without a marketGroupID, except T2 Blueprints
 
-    if verbose:
-        print('Total items flagged: %s' % conn.total_changes)
-        print('')
+        conn.execute('''UPDATE Items SET ExcludeFromTrade=0''') # start from scratch, in case the table has been kept from a previous update
 
-    conn.commit()
-    conn.close()
+        for description, where_clause, params in flag_categories:
+            category_start_time = time.time()
 
-def trimBPDB():
-    if verbose: print('Trimming BP data...')
+            n_flagged = conn.execute('''UPDATE Items SET ExcludeFromTrade=1 WHERE ''' + where_clause, params).rowcount
 
-    conn = sqlite3.connect(presets.auxdataDB)
-    c = conn.cursor()
+            if verbose: print('Flagged %s %s (%ss)' % (n_flagged, description, round(time.time() - category_start_time, 3)))
 
-    sql_cmd = ('''DELETE FROM Materials
-                    WHERE activityID NOT IN %s ''' % sqlitetools.sql_placeholder_of_length(len(presets.bp_activities.values())))
+    if verbose:
+        print('Total items flagged: %s (%ss)' % (sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Items', 'COUNT(*)', 'ExcludeFromTrade', 1), round(time.time() - start_time, 3)))
+        print('')
 
-    c.execute(sql_cmd, list(presets.bp_activities.values()))
+def trimBPDB():
+    if verbose: print('Trimming BP data...')
 
-    sql_cmd = ('''DELETE FROM Products
-                    WHERE activityID NOT IN %s ''' % sqlitetools.sql_placeholder_of_length(len(presets.bp_activities.values())))
+    if 'Manufacturable' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'Items'): sqlitetools.addcolumntodbtable(presets.auxdataDB, 'Items', 'Manufacturable', 'INT', 'DEFAULT 0')
 
-    c.execute(sql_cmd, list(presets.bp_activities.values()))
+    conn = sqlitetools.getdbconnection(presets.auxdataDB)
 
-    conn.commit()
-    conn.close()
+    activities = list(presets.bp_activities.values())
 
-    if verbose: print('Flagging manufacturable items...')
+    start_time = time.time()
 
-    if 'Manufacturable' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'Items'): sqlitetools.addcolumntodbtable(presets.auxdataDB, 'Items', 'Manufacturable', 'INT', 'DEFAULT 0')
+    with conn:
+        for table in ('bpMaterials', 'bpProducts'):
+            sql_cmd = ('''DELETE FROM %s
+                            WHERE activityID NOT IN %s ''' % (table, sqlitetools.sql_placeholder_of_length(len(activities))))
 
-    items_to_flag = sqlitetools.getxbyyfromdb(presets.auxdataDB, 'bpProducts', 'productTypeID', 'activityID', presets.bp_activities['Manufacturing'])
-    items_to_flag = [ii for ii in items_to_flag if ii] # get rid of items which don't resolve to a name - 
-    # !TODO: fix this properly with trimBPDB()
-    items_to_flag = sorted(items_to_flag)
+            conn.execute(sql_cmd, activities)
 
-    conn = sqlite3.connect(presets.auxdataDB)
-    c = conn.cursor()
+        if verbose: print('Flagging manufacturable items...')
 
-    for item in items_to_flag: c.execute('''UPDATE Items SET Manufacturable=1 WHERE typeID = %s''' % item)
+        conn.execute('''UPDATE Items SET Manufacturable=0''')
+        n_flagged = conn.execute('''UPDATE Items SET Manufacturable=1
+                                    WHERE typeID IN (SELECT productTypeID FROM bpProducts WHERE activityID=?)''', (presets.bp_activities['Manufacturing'],)).rowcount
 
     if verbose:
-        print('%s manufacturable items total' % conn.total_changes)
+        print('%s manufacturable items total (%ss)' % (n_flagged, round(time.time() - start_time, 3)))
         print('')
-
-    conn.commit()
-    conn.close()
         
 def checkstrisfloat(string):
     try:
@@ -380,6 +583,8 @@ def checkvalidskilllevel(skills):
             pass
 
 def pulladjprices(updatedb):
+    global adjprices_cache
+
     if verbose: print('Updating adjusted prices...')
 
     data = crest.getcrestdata(crest.getcresturl('adjprices'))
@@ -390,75 +595,141 @@ def pulladjprices(updatedb):
     if updatedb:
         if 'adjPrice' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'Items'): sqlitetools.addcolumntodbtable(presets.auxdataDB, 'Items', 'adjPrice', 'REAL')
 
-        conn = sqlite3.connect(presets.auxdataDB)
-        c = conn.cursor()
+        conn = sqlitetools.getdbconnection(presets.auxdataDB)
 
-        for entry in adjprices: c.execute('''UPDATE Items SET adjPrice=? WHERE typeID=?''', (entry[1], entry[0]))
+        with conn:
+            n_updated = conn.executemany('''UPDATE Items SET adjPrice=? WHERE typeID=?''', [(entry[1], entry[0]) for entry in adjprices]).rowcount
 
-        if verbose > 1: print('Updated %s adjusted prices' % conn.total_changes)
+        if verbose > 1: print('Updated %s adjusted prices' % n_updated)
 
-        conn.commit()
-        conn.close()
+        adjprices_cache = None
+
+        updatebasecosts() # base costs depend on adjusted prices
 
     else:
         return adjprices
 
+def getadjprices():
+    # {typeID : adjPrice} for all items, loaded from the aux DB once
+    global adjprices_cache
+
+    if adjprices_cache is None:
+        if 'adjPrice' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'Items'): pulladjprices(updatedb=True)
+
+        adjprices_cache = dict(sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Items', ('typeID', 'adjPrice'), 'ALL', 'ALL') or [])
+
+    return adjprices_cache
+
 def getadjpriceforitem(item):
     item = auxdatatools.getitemid(item)
 
-    if 'adjPrice' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'Items'): pulladjprices(updatedb=True)
+    return getadjprices().get(item)
+
+def updatebasecosts():
+    # work out the base cost (adjusted price of materials for 1 run, no ME) of every manufacturable item in one go, and store them in the aux DB
+    global basecosts_cache
+
+    if verbose: print('Calculating base costs...')
+
+    if 'baseCost' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'Items'): sqlitetools.addcolumntodbtable(presets.auxdataDB, 'Items', 'baseCost', 'REAL')
+
+    bpgraph, adjprices = indytools.getblueprintgraph(), getadjprices()
+    manufacturable = {row[0] for row in sqlitetools.getdbconnection(presets.auxdataDB, readonly=True).execute('''SELECT typeID FROM Items WHERE Manufacturable=1''')}
+
+    # flatten the materials for all products into single arrays, then sum price * qty for each product
+    products = [product for product in bpgraph.materials if product in manufacturable]
+    n_mats = [len(bpgraph.materials[product]) for product in products]
+    matIDs = [matID for product in products for matID in bpgraph.materials[product]]
+
+    matqtys = np.fromiter((matqty for product in products for matqty in bpgraph.materials[product].values()), dtype=np.float64, count=len(matIDs))
+    matprices = np.array([(adjprices[matID] if adjprices.get(matID) is not None else np.nan) for matID in matIDs], dtype=np.float64) # no price -> NaN -> no base cost
 
-    return sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Items', 'adjPrice', 'typeID', item)
+    basecosts = np.bincount(np.repeat(np.arange(len(products)), n_mats), weights=matprices * matqtys, minlength=len(products))
+
+    entries = [((None if np.isnan(basecost) else round(float(basecost), 2)), product) for product, basecost in zip(products, basecosts)]
+
+    conn = sqlitetools.getdbconnection(presets.auxdataDB)
+
+    with conn:
+        conn.execute('''UPDATE Items SET baseCost=NULL''')
+        conn.executemany('''UPDATE Items SET baseCost=? WHERE typeID=?''', entries)
+
+    basecosts_cache = {product : basecost for basecost, product in entries}
+
+    if verbose > 1: print('Calculated %s base costs' % len(entries))
 
 def calcbasecostforitem(item, updatedb=True):
+    # None if any of the materials has no adjusted price
     matslist = indytools.getmatsforitem(item)
+    adjprices = [getadjpriceforitem(matID) for matID in matslist]
 
-    baseCost = 0
-    for matID, matqty in matslist.items(): baseCost += (getadjpriceforitem(matID) * matqty)
-
-    baseCost = round(baseCost, 2)
+    if None in adjprices:
+        baseCost = None
+    else:
+        baseCost = round(sum(adjprice * matqty for adjprice, matqty in zip(adjprices, matslist.values())), 2)
 
     if updatedb:
         if 'baseCost' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'Items'): sqlitetools.addcolumntodbtable(presets.auxdataDB, 'Items', 'baseCost', 'REAL')
 
-        conn = sqlite3.connect(presets.auxdataDB)
-        c = conn.cursor()
+        conn = sqlitetools.getdbconnection(presets.auxdataDB)
 
-        c.execute('''UPDATE Items SET baseCost=? WHERE typeID=?''', (baseCost, item))
-
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute('''UPDATE Items SET baseCost=? WHERE typeID=?''', (baseCost, item))
 
     return baseCost
 
 def getbasecostforitem(item):
+    # None for items that aren't manufacturable or have a material with no adjusted price
+    global basecosts_cache
+
     item = auxdatatools.getitemid(item)
 
-    if 'baseCost' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'Items'):
-        baseCost = calcbasecostforitem(item)
-    else:
-        baseCost = sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Items', 'baseCost', 'typeID', item)
-        if not baseCost: baseCost = calcbasecostforitem(item)
+    if basecosts_cache is None:
+        if 'baseCost' not in sqlitetools.columnsindbtable(presets.auxdataDB, 'Items'):
+            updatebasecosts()
+        else:
+            basecosts_cache = dict(sqlitetools.getxbyyfromdb(presets.auxdataDB, 'Items', ('typeID', 'baseCost'), 'ALL', 'ALL') or [])
 
-    return baseCost
+    return basecosts_cache.get(item)
+
+def invalidateauxdatacaches():
+    # drop everything we've loaded from the aux DB into memory, for when it has changed
+    global adjprices_cache, basecosts_cache
+
+    auxdatatools.invalidatestaticdataindex()
+    indytools.invalidateblueprintgraph()
+    auxdatatools.clearmemos()
+    adjprices_cache, basecosts_cache = None, None
 
 def deleteindypriceDB():
+    stopped = evemarket.stopautosaves(presets.indypriceDB) # their threads use the connection we're about to close
+
+    sqlitetools.closedbconnections(presets.indypriceDB) # can't delete the file while we still have it open
     if os.path.isfile(presets.indypriceDB): os.remove(presets.indypriceDB)
+    evemarket.priceDBs_initialised.discard(presets.indypriceDB)
+
+    for pricelist in stopped: pricelist.startautosave(presets.indypriceDB, pricelist.autosave_interval)
 
 def initauxdata():
     global forceupdateauxdata
 
     if not skip_aux_data_check and (forceupdateauxdata or auxdataneedsupdate()):
-        updateauxdata()
+        updateauxdata(incremental=not forceupdateauxdata) # forcing an update rebuilds everything
+        invalidateauxdatacaches() # aux DB has been rebuilt, so any in-memory copy is out of date
  
         doUltimateMarketGroups()
+        doLocationClasses()
         flagitemDB()
-        pulladjprices(updatedb=True)
         trimBPDB()
+        pulladjprices(updatedb=True)
         deleteindypriceDB()
+        invalidateauxdatacaches() # and the steps above have changed it again
 
         forceupdateauxdata = False # turn off force update for next time
 
+    elif os.path.isfile(presets.auxdataDB) and 'SystemClass' not in sqlitetools.tablesindb(presets.auxdataDB): # aux DB made before we classified locations (no DB at all if we skipped the check)
+        doLocationClasses()
+
 ## SHIT HERE GETS RUN REGARDLESS
 docmdargs()
 
@@ -520,4 +791,7 @@ if __name__ == '__main__':
         if verbose: print('done.')
 
     else:
-        pass
\ No newline at end of file
+        pass
+
+    sqlitetools.closedbconnections()
+    crest.closesession()
\ No newline at end of file
@@ -1,144 +1,291 @@
+import sys
+import os
+import argparse
+import hashlib
+from datetime import datetime
+import threading
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import perf_counter
+
+import auxdatatools
+import sqlitetools
+import evemarket
+import crest
+import presets
+
+verbose = 0
+scan_shard_size = 25 # items per unit of work for pullitemstatstomarketDB(), each unit is one region's data for this many items
+
 def initmarketDB():
-    conn = sqlite3.connect(presets.marketDB)
-    c = conn.cursor()
-
-    c.execute('''DROP TABLE IF EXISTS MarketItems''')
-    c.execute('''CREATE TABLE MarketItems
-                    (EntryID INTEGER PRIMARY KEY,
-                    ItemID INT,
-                    systemID INT,
-                    MeanPrice REAL,
-                    MedianPrice REAL,
-                    StdPrice REAL,
-                    PercentilePrice REAL,
-                    nOrders INT,
-                    MeanRegionalVolume REAL,
-                    StdRegionalVolume REAL
-                    )''')
-
-    conn.commit()
-    conn.close()
+    conn = sqlitetools.getdbconnection(presets.marketDB)
+
+    with conn:
+        conn.execute('''DROP TABLE IF EXISTS MarketItems''')
+        conn.execute('''CREATE TABLE MarketItems
+                        (EntryID INTEGER PRIMARY KEY,
+                        ItemID INT,
+                        systemID INT,
+                        MeanPrice REAL,
+                        MedianPrice REAL,
+                        StdPrice REAL,
+                        PercentilePrice REAL,
+                        nOrders INT,
+                        MeanRegionalVolume REAL,
+                        StdRegionalVolume REAL
+                        )''')
+        conn.execute('''CREATE UNIQUE INDEX MarketItemsByItemSystem ON MarketItems(ItemID, systemID)''') # so rewriting an item/system pair replaces it
 
     inittradetable()
+    initscantables()
+
+def initscantables():
+    # a fresh MarketItems table means any old scan progress is meaningless
+    conn = sqlitetools.getdbconnection(presets.marketDB)
+
+    with conn:
+        conn.execute('''DROP TABLE IF EXISTS Scans''')
+        conn.execute('''CREATE TABLE Scans
+                        (scanID TEXT PRIMARY KEY,
+                        orderType TEXT,
+                        started REAL,
+                        nUnits INT
+                        )''')
+
+        # one row per unit of work (an item's data for all requested systems in one region) once it's been written
+        conn.execute('''DROP TABLE IF EXISTS ScanCheckpoint''')
+        conn.execute('''CREATE TABLE ScanCheckpoint
+                        (scanID TEXT,
+                        typeID INT,
+                        regionID INT,
+                        orderType TEXT,
+                        completed REAL,
+                        PRIMARY KEY (scanID, typeID, regionID, orderType)
+                        )''')
+
+def getscanid(items, systems, order_type):
+    # the same scan (same items, systems & order type) always gets the same ID, so running it again can pick up where it left off
+    scan_def = '%s|%s|%s' % (order_type, ','.join(str(item) for item in sorted(items)), ','.join(str(system) for system in sorted(systems)))
+
+    return hashlib.sha1(scan_def.encode()).hexdigest()[:12]
+
+def getcompletedunits(scan_id, order_type):
+    # (typeID, regionID) of the units of a scan that have been written
+    entries = sqlitetools.getdbconnection(presets.marketDB).execute('''SELECT typeID, regionID FROM ScanCheckpoint WHERE scanID=? AND orderType=?''', (scan_id, order_type)).fetchall()
+
+    return set(entries)
+
+def getscanprogress(scan_id=None):
+    # [(scanID, orderType, started, nUnits, nDone, lastCompleted)] for one or all scans in the market DB
+    if not os.path.isfile(presets.marketDB) or 'Scans' not in sqlitetools.tablesindb(presets.marketDB): return []
+
+    sql_cmd = '''SELECT Scans.scanID, Scans.orderType, Scans.started, Scans.nUnits, COUNT(ScanCheckpoint.typeID), MAX(ScanCheckpoint.completed)
+                    FROM Scans LEFT JOIN ScanCheckpoint ON Scans.scanID = ScanCheckpoint.scanID AND Scans.orderType = ScanCheckpoint.orderType'''
+
+    if scan_id is not None:
+        return sqlitetools.getdbconnection(presets.marketDB).execute(sql_cmd + ''' WHERE Scans.scanID=? GROUP BY Scans.scanID''', (scan_id,)).fetchall()
+    else:
+        return sqlitetools.getdbconnection(presets.marketDB).execute(sql_cmd + ''' GROUP BY Scans.scanID ORDER BY Scans.started''').fetchall()
+
+def printscanprogress(scan_id=None):
+    progress = getscanprogress(scan_id)
+
+    if not progress: print('No market scans found in %s' % os.path.abspath(presets.marketDB))
+
+    for scanID, order_type, started, n_units, n_done, last_completed in progress:
+        print('Scan %s (%s orders), started %s: %s of %s units done (%.1f%%)%s' % (scanID, order_type, datetime.fromtimestamp(started).strftime('%Y-%m-%d %H:%M:%S'), n_done, n_units, (100 * n_done / n_units if n_units else 100),
+                                                                                   (', last at %s' % datetime.fromtimestamp(last_completed).strftime('%Y-%m-%d %H:%M:%S') if last_completed else '')))
 
 def inittradetable():
-    conn = sqlite3.connect(presets.marketDB)
-    c = conn.cursor()
-
-    c.execute('''DROP TABLE IF EXISTS Trades''')
-    c.execute('''CREATE TABLE Trades
-                    (EntryID INTEGER PRIMARY KEY,
-                    ItemID INT,
-                    BuysystemID INT,
-                    BuyMedianPrice REAL,
-                    BuyMeanRegionalVolume REAL,
-                    SellsystemID INT,
-                    SellMedianPrice REAL,
-                    SellMeanRegionalVolume REAL,
-                    nSellOrders INT
-                    )''')
-
-    conn.commit()
-    conn.close()
-
-def pullitemstatstomarketDB(items, systems, order_type, cache_limit=200, resume=False):
+    conn = sqlitetools.getdbconnection(presets.marketDB)
+
+    with conn:
+        conn.execute('''DROP TABLE IF EXISTS Trades''')
+        conn.execute('''CREATE TABLE Trades
+                        (EntryID INTEGER PRIMARY KEY,
+                        ItemID INT,
+                        BuysystemID INT,
+                        BuyMedianPrice REAL,
+                        BuyMeanRegionalVolume REAL,
+                        SellsystemID INT,
+                        SellMedianPrice REAL,
+                        SellMeanRegionalVolume REAL,
+                        nSellOrders INT
+                        )''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS MarketItemsByItem ON MarketItems(ItemID, MedianPrice)''') # for findtrades() to rank each item's systems by price
+
+def pullitemstatstomarketDB(items, systems, order_type, cache_limit=200, resume=False, max_workers=None, scan_id=None):
     # cache_limit: maximum number of DB entries to be held in memory before dumping to disk
+    # resume: carry on with the scan (see scan_id) from where it was stopped, otherwise the market DB is started from scratch
+    # scan_id: defaults to one made from the items, systems & order type, so the same call made again resumes the same scan
+    # max_workers: threads pulling data (default crest.CREST_max_workers), they share the CREST rate limit so more threads only help up to that
+    # work is split into shards of one region's data for scan_shard_size items, results go to a single writer thread which does all the DB writes
     # make sure iteration works (if there's only one arg)
     if isinstance(items, str): items = [items]
     if isinstance(systems, str): systems = [systems]
+    if max_workers is None: max_workers = crest.CREST_max_workers
 
     items = tuple(auxdatatools.getitemid(item) if isinstance(item, str) else item for item in items)
     systems = tuple(auxdatatools.getsystemID(system) if isinstance(system, str) else system for system in systems)
 
     systems_regions = tuple(auxdatatools.getsystemregion(system) for system in systems)
 
-    regionsToPull = set(systems_regions)
-
-    # we assume that the DB is being populated in the same order it was previously - this should be true, as the order is determined by the order of
-    # items in presets.auxdataDB and systems in presets.auxdataDB, which will remain constant unless the data is updated (and the new data is different). We could
-    # actually check each entry, but this is slow
-    if resume and os.path.isfile(presets.marketDB):
-        if verbose: print('Attempting to resume from last complete item request...', end='')
-        entry_items = sqlitetools.getallitemsfromdbcol(presets.marketDB, 'MarketItems', 'typeID')
-        
-        if len(entry_items) == 0:
-            if verbose: print('\nCannot resume, re-initialising market DB')
-            resume = False
-            initmarketDB()
-        else:
-            item_was_inprogress = entry_items[-1] # the item that was in progress last time the DB was written
-            items_done = set(entry_items)
-            items_done.remove(item_was_inprogress) # these items were definitely done
-
-            # delete all entries for the in progress item
-            conn = sqlite3.connect(presets.marketDB)
-            c = conn.cursor()
-            c.execute('''DELETE FROM MarketItems WHERE ItemID=?''', (item_was_inprogress, ))
-            conn.commit()
-            conn.close()
-
-            # remove completed items from list of requested items
-            items = list(items)
-            for item in items_done:
-                if item in items: items.remove(item)
-            items = tuple(items)
-
-            if verbose: print('ready to go.')
+    regionsystems = {}
+    for system, region in zip(systems, systems_regions): regionsystems.setdefault(region, []).append(system)
+
+    if scan_id is None: scan_id = getscanid(items, systems, order_type)
 
+    # progress is saved per unit of work (an item in a region) in the same transaction as its data, so we know exactly what's been done
+    if resume and os.path.isfile(presets.marketDB) and getscanprogress(scan_id):
+        done = getcompletedunits(scan_id, order_type)
+        if verbose: print('Resuming scan %s, %s of %s units already done' % (scan_id, len(done), len(items) * len(regionsystems)))
     else:
-        if verbose: print('(Re-) initialising market DB')
-        initmarketDB() # otherwise (re) initialise the market DB
+        if resume and verbose: print('Cannot resume scan %s, re-initialising market DB' % scan_id)
+        elif verbose: print('(Re-) initialising market DB')
+        initmarketDB()
+        done = set()
+
+    with sqlitetools.getdbconnection(presets.marketDB) as conn:
+        conn.execute('''INSERT OR IGNORE INTO Scans VALUES (?,?,?,?)''', (scan_id, order_type, datetime.now().timestamp(), len(items) * len(regionsystems)))
+
+    regionitems = {region : [item for item in items if (item, region) not in done] for region in regionsystems}
+
+    shards = [(region, regionitems[region][ii:ii + scan_shard_size]) for region in regionsystems for ii in range(0, len(regionitems[region]), scan_shard_size)]
+    total_pairs = sum(len(regionitems[region]) * len(regionsystems[region]) for region in regionsystems)
+
+    timings, timings_lock = {'orders' : 0, 'regionstats' : 0, 'itemstats' : 0, 'write' : 0, 'n_written' : 0}, threading.Lock()
+    entries_queue = queue.Queue(maxsize=max_workers * 4) # so the pullers can't get too far ahead of the writer
+    stop_scan, writer_error = threading.Event(), [] # set if anything goes wrong, so everyone stops instead of waiting on each other
 
-    counter, total_combos = 1, len(items) * len(systems)
-    entries = []
-    if verbose: print_str = ''
-    for item in items:
+    def queueentries(queued):
+        # the queue is only emptied while the writer is running, so if it has died don't wait on it forever
+        while writer.is_alive():
+            try:
+                entries_queue.put(queued, timeout=1)
+                return True
+            except queue.Full:
+                pass
 
-        for region in regionsToPull:
+        return False
+
+    def scanshard(region, shard_items):
+        for item in shard_items:
+            if stop_scan.is_set(): return
+
+            t_start = perf_counter()
             regionOrders = evemarket.getorders(item, region, order_type)
+
+            t_orders = perf_counter()
             avgRegionStats = evemarket.getavgregionstats(item, region, avg_period=7)
 
-            for ii, system in enumerate(systems):
-                if systems_regions[ii] == region:
-                    counter += 1
+            t_regionstats = perf_counter()
+            systemOrders = evemarket.selectordersbylocations(regionOrders, regionsystems[region]) # split the region's orders by system in one go
+            entries = [(item, system) + evemarket.getitemstats(item, system, order_type, orders=orders, get_region_stats=False) + avgRegionStats for system, orders in zip(regionsystems[region], systemOrders)]
+
+            t_itemstats = perf_counter()
+            with timings_lock:
+                timings['orders'] += t_orders - t_start
+                timings['regionstats'] += t_regionstats - t_orders
+                timings['itemstats'] += t_itemstats - t_regionstats
+
+            if not queueentries( ((item, region), entries) ): raise Exception('Market DB writer has stopped')
+
+    if verbose: print('Pulling data for %s item/system pairs in %s shards, %s workers...' % (total_pairs, len(shards), max_workers))
+
+    t_start = perf_counter()
+
+    def runwriter():
+        try:
+            writemarketentries(entries_queue, cache_limit, total_pairs, timings, timings_lock, scan_id, order_type)
+        except BaseException as e:
+            writer_error.append(e)
+            stop_scan.set()
+
+    writer = threading.Thread(target=runwriter)
+    writer.start()
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for future in as_completed([executor.submit(scanshard, region, shard_items) for region, shard_items in shards]): future.result() # raise the first error from the workers as soon as it happens
+    finally:
+        stop_scan.set() # on an error, shards that haven't started are cancelled and running ones stop after their current item
+        executor.shutdown(wait=True, cancel_futures=True)
+        queueentries(None) # tell the writer we're done
+        writer.join()
+        sqlitetools.prunedbconnections() # close any connections the workers opened
+        if writer_error: raise writer_error[0]
+
+    elapsed = perf_counter() - t_start
+    timings['elapsed'], timings['pairs_per_s'] = elapsed, (timings['n_written'] / elapsed if elapsed else 0)
+
+    if verbose:
+        print('done. %s pairs in %.1f s (%.1f pairs/s)' % (timings['n_written'], elapsed, timings['pairs_per_s']))
+        print('Time per stage (summed over workers): orders %.1f s, region stats %.1f s, item stats %.1f s, DB writes %.1f s' % (timings['orders'], timings['regionstats'], timings['itemstats'], timings['write']))
+
+    return timings
+
+def writemarketentries(entries_queue, batch_size, total_pairs, timings, timings_lock, scan_id, order_type):
+    # the only thing that writes to the market DB during a scan, takes (unit, MarketItems entries) from the queue until it gets None
+    # entries are written in batches of batch_size, one transaction each, with the DB in WAL mode so reading it while we write doesn't block
+    # each unit's checkpoint goes in the same transaction as its entries, so if we're stopped part way a unit is either all there or not at all
+    conn = sqlite3.connect(presets.marketDB)
+    conn.execute('''PRAGMA journal_mode=WAL''')
+    conn.execute('''PRAGMA synchronous=NORMAL''')
 
-                    if verbose:
-                        if len(print_str) > 0: print('\r' + ' '*len(print_str), end='\r')
-                        print_str = 'Pulling data for item/system pair %s of %s... (%s, %s)' % (counter, total_combos, auxdatatools.getitemName(item), auxdatatools.getsystemName(system))
-                        print(print_str, end=('\n' if counter == total_combos else ''))
-                        sys.stdout.flush()
+    batch, batch_units, n_written, t_start = [], [], 0, perf_counter()
 
-                    entry = (item, system) + evemarket.getitemstats(item, system, order_type, orders=regionOrders, get_region_stats=False) + avgRegionStats
-                    entries.append(entry)
+    def writebatch():
+        nonlocal batch, batch_units, n_written
+        if not batch_units: return
 
-                    # dump data to DB on disk every so often to prevent memory overflow
-                    if len(entries) > cache_limit:
-                        addtomarketDB(entries, 'MarketItems')
-                        entries = []
+        t_write = perf_counter()
+        with conn:
+            insertmarketitems(conn, batch)
+            conn.executemany('''INSERT OR REPLACE INTO ScanCheckpoint VALUES (?,?,?,?,?)''', [(scan_id, item, region, order_type, datetime.now().timestamp()) for item, region in batch_units])
 
-    addtomarketDB(entries, 'MarketItems')
+        n_written += len(batch)
+        batch, batch_units = [], []
 
-    print('done.')
+        with timings_lock:
+            timings['write'] += perf_counter() - t_write
+            timings['n_written'] = n_written
+
+        if verbose:
+            print('\rWritten %s of %s item/system pairs (%.1f pairs/s)' % (n_written, total_pairs, n_written / (perf_counter() - t_start)), end='')
+            sys.stdout.flush()
+
+    try:
+        while True:
+            queued = entries_queue.get()
+            if queued is None: break
+
+            batch_units.append(queued[0])
+            batch.extend(queued[1])
+            if len(batch) >= batch_size: writebatch()
+
+        writebatch()
+    finally:
+        conn.close()
+        if verbose: print('')
+
+def insertmarketitems(conn, entries):
+    conn.executemany('''INSERT OR REPLACE INTO MarketItems(ItemID, systemID, MeanPrice, MedianPrice, StdPrice, PercentilePrice, nOrders, MeanRegionalVolume, StdRegionalVolume)
+                            VALUES(?,?,?,?,?,?,?,?,?)''', entries)
 
 def addtomarketDB(entries, table):
     if entries: # ignore empty entries
-        conn = sqlite3.connect(presets.marketDB)
-        c = conn.cursor()
+        conn = sqlitetools.getdbconnection(presets.marketDB)
 
-        try:
+        with conn:
             if table == 'MarketItems':
-                c.executemany('''INSERT INTO MarketItems(ItemID, systemID, MeanPrice, MedianPrice, StdPrice, nOrders, MeanRegionalVolume, StdRegionalVolume)
-                                    VALUES(?,?,?,?,?,?,?,?)''', entries)
+                insertmarketitems(conn, entries)
             elif table == 'Trades':
-                c.executemany('''INSERT INTO Trades(ItemID, BuysystemID, BuyMedianPrice, BuyMeanRegionalVolume, SellsystemID, SellMedianPrice, SellMeanRegionalVolume, nSellOrders)
+                conn.executemany('''INSERT INTO Trades(ItemID, BuysystemID, BuyMedianPrice, BuyMeanRegionalVolume, SellsystemID, SellMedianPrice, SellMeanRegionalVolume, nSellOrders)
                                     VALUES(?,?,?,?,?,?,?,?)''', entries)
             else:
                 raise Exception()
 
-        finally:
-            conn.commit()
-            conn.close()
-
 def iswhregion(region):
     if isinstance(region, int): region = auxdatatools.getregionName(region)
 
@@ -152,81 +299,58 @@ def iswhregion(region):
 
 def initWHregions():
     global wh_regions
-    
-    all_regions = sqlitetools.getallitemsfromdbcol(presets.auxdataDB, 'Regions', 'regionName')
-    
-    wh_regions = tuple(region for region in all_regions if iswhregion(region))
+
+    wh_regions = tuple(auxdatatools.getregionName(region) for region in auxdatatools.getregionsbyclass('wormhole'))
 
 def initempireregions():
     global empire_regions
-    if 'wh_regions' not in globals(): initWHregions()
-
-    non_empire_regions = presets.null_regions + wh_regions + presets.jove_regions
-
-    conn = sqlite3.connect(presets.auxdataDB)
-    c = conn.cursor()
 
-    sql_cmd = '''SELECT regionName FROM Regions WHERE regionName not in %s''' % sqlitetools.sql_placeholder_of_length(len(non_empire_regions))
-
-    empire_regions = tuple(ii[0] for ii in c.execute(sql_cmd, non_empire_regions).fetchall())
-
-    conn.close()
+    empire_regions = tuple(auxdatatools.getregionName(region) for region in auxdatatools.getregionsbyclass('empire'))
 
 def getallHSsystems():
-    if 'empire_regions' not in globals(): initempireregions()
-
-    conn = sqlite3.connect(presets.auxdataDB)
-    c = conn.cursor()
-
-    sql_cmd = '''SELECT systemID FROM Systems NATURAL JOIN Regions
-                    WHERE regionName in %s
-                    AND Security >= 0.5''' % sqlitetools.sql_placeholder_of_length(len(empire_regions))
-
-    hs_systems = tuple(ii[0] for ii in c.execute(sql_cmd, empire_regions).fetchall())
-
-    conn.close()
+    return auxdatatools.getsystemsbyclass('empire', 'high')
 
-    return hs_systems
-
-def findtrades(itemIDs, margin_threshold_pct, margin_threshold_abs, min_volume_abs, max_competition, cache_limit=200):
+def findtrades(itemIDs, margin_threshold_pct, margin_threshold_abs, min_volume_abs, max_competition):
+    # find trades for all items in one SQL pass over MarketItems: for each item the system with the highest median price is where we sell,
+    # and every system cheap enough to give the required margin is somewhere to buy
+    # itemIDs: items to look at, or None for everything in MarketItems
     inittradetable()
 
     if isinstance(itemIDs, int): itemIDs = [itemIDs]
     margin_threshold = margin_threshold_pct / 100 # convert pct to decimal
 
-    for item in itemIDs:
-        entries = sqlitetools.getxbyyfromdb(presets.marketDB, 'MarketItems', ('solarSystemID', 'MedianPrice', 'MeanRegionalVolume', 'nOrders'), 'typeID', item)
-        entries = [entries[ii] for ii, entry in enumerate(entries) if entry[1] != None] # remove data where price is None
-        entries = [entries[ii] for ii, entry in enumerate(entries) if entry[2] != None] # remove data where voluem data was insufficient
+    conn = sqlitetools.getdbconnection(presets.marketDB)
 
-        if not entries: continue # skip where we have no entries
-        
-        try:
-            max_entry = max(entries, key = itemgetter(1))
-        except:
-            print(entries)
-            raise
+    if itemIDs is not None:
+        with conn:
+            conn.execute('''CREATE TEMP TABLE IF NOT EXISTS TradeItems (ItemID INT PRIMARY KEY)''')
+            conn.execute('''DELETE FROM TradeItems''')
+            conn.executemany('''INSERT OR IGNORE INTO TradeItems VALUES (?)''', [(item,) for item in itemIDs])
 
-        if max_entry[2] < min_volume_abs: continue # absolute sell volume threshold
-        if max_entry[3] > max_competition: continue # sell competition threshold
-        
-        minprice_for_margin = max_entry[1] / (margin_threshold + 1)
+    # entries with no price or not enough volume data are ignored, the sell system must have enough volume and not too much competition
+    trades = conn.execute('''WITH Valid AS (SELECT EntryID, ItemID, systemID, MedianPrice, MeanRegionalVolume, nOrders FROM MarketItems
+                                            WHERE MedianPrice IS NOT NULL AND MeanRegionalVolume IS NOT NULL {}),
+                                 Ranked AS (SELECT *, ROW_NUMBER() OVER (PARTITION BY ItemID ORDER BY MedianPrice DESC, EntryID) AS priceRank FROM Valid),
+                                 Sell AS (SELECT * FROM Ranked WHERE priceRank = 1 AND MeanRegionalVolume >= ? AND nOrders <= ?)
+                            SELECT Buy.ItemID, Buy.systemID, Buy.MedianPrice, Buy.MeanRegionalVolume, Sell.systemID, Sell.MedianPrice, Sell.MeanRegionalVolume, Sell.nOrders,
+                                   (Sell.MedianPrice - Buy.MedianPrice) / NULLIF(Buy.MedianPrice, 0) AS margin
+                            FROM Valid AS Buy JOIN Sell ON Buy.ItemID = Sell.ItemID
+                            WHERE Buy.MedianPrice <= Sell.MedianPrice / (? + 1) AND Sell.MedianPrice - Buy.MedianPrice >= ?
+                            ORDER BY Buy.ItemID, Buy.EntryID'''.format('''AND ItemID IN (SELECT ItemID FROM TradeItems)''' if itemIDs is not None else ''),
+                            (min_volume_abs, max_competition, margin_threshold, margin_threshold_abs)).fetchall()
 
-        trades = []
-        for entry in entries:
-            if entry[1] <= minprice_for_margin:
-                this_margin = (max_entry[1] - entry[1]) / entry[1]
-                this_margin_abs = this_margin * entry[1]
+    if verbose:
+        for trade in trades:
+            print('Profitable trade found: %s, %s -> %s. Margin: %s' % ( auxdatatools.getitemName(trade[0]), auxdatatools.getsystemName(trade[1]), auxdatatools.getsystemName(trade[4]), ('%s%%' % round(trade[8] * 100, 1) if trade[8] is not None else 'n/a') ) ) # no margin when buying for nothing
 
-                if this_margin_abs >= margin_threshold_abs:
-                    trades.append( (item, entry[0], entry[1], entry[2], max_entry[0], max_entry[1], max_entry[2], max_entry[3]) )
-                    try:
-                        if verbose: print('Profitable trade found: %s, %s -> %s. Margin: %s%%' % ( auxdatatools.getitemName(item), auxdatatools.getsystemName(entry[0]), auxdatatools.getsystemName(max_entry[0]), round(this_margin * 100, 1) ) )
-                    except NoMatchError:
-                        print('Warning: Item ID %s in Market DB but not main Item DB. Maybe Item DB has been updated recently?' % item)
+    addtomarketDB([trade[:8] for trade in trades], 'Trades')
 
-            if len(trades) > cache_limit: addtomarketDB(trades, 'Trades')
+    if verbose: print('Total possible trades found: %s' % sqlitetools.gettablelen(presets.marketDB, 'Trades'))
 
-        addtomarketDB(trades, 'Trades')
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--progress', help='Show progress of market scans (all, or the given scan ID)', nargs='?', const='ALL', type=str)
 
-    if verbose: print('Total possible trades found: %s' % sqlitetools.gettablelen(presets.marketDB, 'Trades'))
+    cmdargs = argparser.parse_args()
+
+    if cmdargs.progress: printscanprogress(None if cmdargs.progress == 'ALL' else cmdargs.progress)
@@ -5,8 +5,12 @@ sde_fuzzwork_url = 'https://www.fuzzwork.co.uk/dump/sqlite-latest.sqlite.bz2'
 auxdataDB = 'auxdata.sqlite3'
 
 marketDB = 'market.sqlite3'
+orderbookDB = 'orderbook.sqlite3'
+crestcacheDB = 'crestcache.sqlite3'
 indypriceDB = 'indyprices.sqlite3'
 
+orderbook_snapshot_TTL = 300 # seconds, age at which a region's order book snapshot is out of date and gets pulled again
+
 # Blueprints (2), Skills (150), Structures (477), Apparel (1396), Special Edition Assets (1659), Pilot's Services (1922), Ship SKINs (1954), Infantry Gear (350001)
 ultimateMarketGroupsToSkip = (2, 150, 477, 1396, 1659, 1922, 1954, 350001)
 # Titans (812-816), Boosters (491, 977, 1858), SE Ships
@@ -19,53 +23,72 @@ jove_regions = ('A821-A', 'J7HZ-F', 'UUA-F4')
 
 trade_hubs = ('Jita', 'Amarr', 'Dodixie', 'Rens', 'Hek')
 
+# EVE location IDs are allocated in fixed ranges, so we can tell what kind of location an ID is without looking it up (first, last)
+location_ID_ranges = (('region', (10000000, 19999999)), ('system', (30000000, 39999999)), ('station', (60000000, 63999999)))
+
 auxdatainfo = (
                 {
                 'desttable' : 'Items',
                 'srctable' : 'invTypes',
                 'cols_to_keep' : ('typeID', 'typeName', 'groupID', 'marketGroupID'),
+                'primary_key' : ('typeID',),
+                'indexes' : (('typeName',),),
                 },
 
                 {
                 'desttable' : 'MarketGroups',
                 'srctable' : 'invMarketGroups',
                 'cols_to_keep' : ('marketGroupID', 'parentGroupID', 'marketGroupName'),
+                'primary_key' : ('marketGroupID',),
+                'indexes' : (),
                 },
                 
                 {
                 'desttable' : 'Regions',
                 'srctable' : 'mapRegions',
                 'cols_to_keep' : ('regionID', 'regionName'),
+                'primary_key' : ('regionID',),
+                'indexes' : (('regionName',),),
                 },
 
                 {
                 'desttable' : 'Systems',
                 'srctable' : 'mapSolarSystems',
                 'cols_to_keep' : ('solarsystemID', 'solarsystemName', 'regionID', 'constellationID', 'security'),
+                'primary_key' : ('solarsystemID',),
+                'indexes' : (('solarsystemName',),),
                 },
 
                 {
                 'desttable' : 'Stations',
                 'srctable' : 'staStations',
                 'cols_to_keep' : ('stationID', 'stationName', 'solarsystemID', 'corporationID'),
+                'primary_key' : ('stationID',),
+                'indexes' : (('stationName',),),
                 },
 
                 {
                 'desttable' : 'bpMaterials',
                 'srctable': 'industryActivityMaterials',
                 'cols_to_keep' : ('typeID', 'activityID', 'materialTypeID', 'quantity'),
+                'primary_key' : None,
+                'indexes' : (('typeID', 'activityID'),),
                 },
 
                 {
                 'desttable' : 'bpProducts',
                 'srctable': 'industryActivityProducts',
                 'cols_to_keep' : ('typeID', 'activityID', 'productTypeID', 'quantity'),
+                'primary_key' : None,
+                'indexes' : (('typeID', 'activityID'), ('productTypeID',)),
                 },
 
                 {
                 'desttable' : 'bpTimes',
                 'srctable': 'industryActivity',
                 'cols_to_keep' : ('typeID', 'activityID', 'time'),
+                'primary_key' : None,
+                'indexes' : (('typeID', 'activityID'),),
                 },
                 )
                 
@@ -1,66 +1,97 @@
 ## Functions for doing general operations on sqlite dbs
 
+import os
 import sqlite3
+import threading
+from urllib.request import pathname2url
+
+# long-lived connections, shared by all the functions below so we don't pay for a connect/close on every query
+# keyed by (thread, absolute DB path, readonly) - sqlite connections shouldn't be shared between threads
+# the thread object itself is the key rather than its ID, as IDs get reused once a thread has finished
+db_connections = {}
+db_connections_lock = threading.RLock()
+
+def getdbconnection(db, readonly=False):
+    # get the pooled connection to db for the current thread, opening it if necessary
+    # readonly connections open the DB in read-only URI mode, so they will never create or modify the file (and the file must exist)
+    db_path = os.path.abspath(db)
+    key = (threading.current_thread(), db_path, readonly)
+
+    with db_connections_lock:
+        if key not in db_connections:
+            prunedbconnections() # good time to tidy up after any threads that have finished
+
+            if readonly:
+                if not os.path.isfile(db_path): raise Exception('Cannot open DB read-only as it does not exist: %s' % db_path)
+                conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(db_path), uri=True, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(db_path, check_same_thread=False)
+
+            db_connections[key] = conn
+
+        return db_connections[key]
+
+def prunedbconnections():
+    # close pooled connections belonging to threads that have finished, e.g. the workers of a thread pool that has been shut down
+    with db_connections_lock:
+        for key in [key for key in db_connections if not key[0].is_alive()]: db_connections.pop(key).close()
+
+def closedbconnections(db=None, thread=None):
+    # close pooled connections for db, or every pooled connection if db is not given
+    # for all threads, or just the given one (e.g. threading.current_thread() at the end of a worker's task)
+    # must be called before deleting/replacing a DB file, and on shutdown
+    db_path = os.path.abspath(db) if db else None
+
+    with db_connections_lock:
+        for key in list(db_connections):
+            if (db_path is None or key[1] == db_path) and (thread is None or key[0] is thread):
+                db_connections.pop(key).close()
 
 def addcolumntodbtable(db, table, colname, coltype, options=None):
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
-
-    c.execute('''ALTER TABLE {} ADD COLUMN {} {} {}'''.format(table, colname, coltype, options)) # !TODO: This is insecure!
+    conn = getdbconnection(db)
 
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute('''ALTER TABLE {} ADD COLUMN {} {} {}'''.format(table, colname, coltype, options or '')) # !TODO: This is insecure!
 
 def sql_placeholder_of_length(length):
     return '(' + ', '.join('?'*length) + ')'
 
 def checkifitemindb(db, table, column, item):
     # returns True if item exists in column of table in DB
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
+    conn = getdbconnection(db, readonly=True)
 
     sql_cmd = '''SELECT COUNT(%s) FROM %s WHERE %s=?''' % (column, table, column)
 
-    result = bool(c.execute(sql_cmd, (item,)).fetchone()[0])
-
-    conn.close()
+    result = bool(conn.execute(sql_cmd, (item,)).fetchall()[0][0])
 
     return result
 
 def tablesindb(db):
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
-
-    c.execute('''SELECT name FROM sqlite_master WHERE type='table';''')
+    conn = getdbconnection(db, readonly=True)
 
-    result = tuple(ii[0] for ii in c.fetchall())
-
-    conn.close()
+    result = tuple(ii[0] for ii in conn.execute('''SELECT name FROM sqlite_master WHERE type='table';''').fetchall())
 
     return result
 
 def columnsindbtable(db, table):
-    conn = sqlite3.connect(db)
+    conn = getdbconnection(db, readonly=True)
     c = conn.cursor()
 
     c.execute('''SELECT * FROM %s LIMIT 1''' % table)
 
-    colnames = (ii[0] for ii in c.description)
+    colnames = tuple(ii[0] for ii in c.description)
 
-    conn.close()
+    c.close() # don't hold the read lock on the table
 
     return colnames
 
 def gettablelen(db, table):
     # gets number of rows in table
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
+    conn = getdbconnection(db, readonly=True)
 
     sql_cmd = '''SELECT COUNT(*) FROM %s''' % table
 
-    result = c.execute(sql_cmd).fetchone()[0]
-
-    conn.close()
+    result = conn.execute(sql_cmd).fetchall()[0][0]
 
     return result
 
@@ -91,19 +122,16 @@ def getxbyyfromdb(db, table, x, y, y_val, flatten_on_single_match=True):
 
         sql_cmd = ('''SELECT %s FROM %s WHERE ''' + params) % tuple([x, table] + list(y)) # create SQL query with placeholders e.g. "SELECT Col1,Col2 FROM Table WHERE Col3=? AND Col4=?"
 
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
+    conn = getdbconnection(db, readonly=True)
 
     try:
         if y == 'ALL' and y_val == 'ALL':
-            found = c.execute(sql_cmd).fetchall()
+            found = conn.execute(sql_cmd).fetchall()
         else:
-            found = c.execute(sql_cmd, y_val).fetchall()
+            found = conn.execute(sql_cmd, y_val).fetchall()
     except:
         print(sql_cmd)
         raise
-    finally:
-        conn.close()
 
     if not found:
         return None
@@ -123,59 +151,51 @@ def getallitemsfromdbcol(db, table, columns, unique=False):
     #!TODO replace this with getXbyY for wildcard
     if isinstance(columns, list) or isinstance(columns, tuple): columns = ', '.join(columns)
 
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
+    conn = getdbconnection(db, readonly=True)
 
     if unique:
         sql_cmd = '''SELECT DISTINCT %s FROM %s''' % (columns, table)
     else:
         sql_cmd = '''SELECT %s FROM %s''' % (columns, table)
 
-    items = tuple( (ii[0] if isinstance(columns, str) else ii) for ii in c.execute(sql_cmd).fetchall()) # if we only want one column's data, we can flatten the output
-
-    conn.close()
+    items = tuple( (ii[0] if isinstance(columns, str) else ii) for ii in conn.execute(sql_cmd).fetchall()) # if we only want one column's data, we can flatten the output
 
     return items
 
 def createtable(db, table, columns=None):
     # !TODO: This is insecure!
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
+    conn = getdbconnection(db)
 
-    c.execute('''DROP TABLE IF EXISTS {}'''.format(table))
-    
     colparams = '(%s)' % ', '.join(columns)
 
-    c.execute('''CREATE TABLE {} {}'''.format(table, colparams))
-
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute('''DROP TABLE IF EXISTS {}'''.format(table))
+        conn.execute('''CREATE TABLE {} {}'''.format(table, colparams))
 
 def insertmany(db, table, entries):
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
+    conn = getdbconnection(db)
 
-    c.executemany('''INSERT INTO {} VALUES {}'''.format(table, sql_placeholder_of_length(len(entries[0]))), entries) # !TODO: This is insecure!
+    changes_before = conn.total_changes # connection is long-lived, so total_changes is cumulative
 
-    if verbose: print('Added %s entries' % conn.total_changes)
+    with conn:
+        conn.executemany('''INSERT INTO {} VALUES {}'''.format(table, sql_placeholder_of_length(len(entries[0]))), entries) # !TODO: This is insecure!
 
-    conn.commit()
-    conn.close()
+    if verbose: print('Added %s entries' % (conn.total_changes - changes_before))
 
 def copycolstonewDB(db_src, table_src, db_dest, table_dest, cols_to_copy):
     # copy columns from one DB to another
     # cols_to_copy: names of columns to copy, must be iterable of strings
     # cols_new_names: names of columns in new DB (default: original names), must be iterable of strings
 
-    conn = sqlite3.connect(db_dest)
-    c = conn.cursor()
-
-    c.execute('''DROP TABLE IF EXISTS %s''' % table_dest)
-    c.execute('''ATTACH DATABASE "%s" AS dbsrc''' % db_src)
-    c.execute('''CREATE TABLE %s AS SELECT %s FROM dbsrc.%s''' % (table_dest, ','.join(cols_to_copy), table_src))
+    conn = getdbconnection(db_dest)
 
-    conn.commit()
-    conn.close()
+    conn.execute('''ATTACH DATABASE "%s" AS dbsrc''' % db_src)
+    try:
+        with conn:
+            conn.execute('''DROP TABLE IF EXISTS %s''' % table_dest)
+            conn.execute('''CREATE TABLE %s AS SELECT %s FROM dbsrc.%s''' % (table_dest, ','.join(cols_to_copy), table_src))
+    finally:
+        conn.execute('''DETACH DATABASE dbsrc''') # pooled connection, so don't leave the source attached
 
 
     
@@ -0,0 +1,96 @@
+import http.server
+import os
+import sqlite3
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.argv = sys.argv[:1] # krabtools parses the command line when imported
+
+import auxdatatools
+import krabtools # sets the globals (verbose etc.) that the other modules expect
+import presets
+import sqlitetools
+
+@pytest.fixture
+def auxDB(tmp_path, monkeypatch):
+    # an empty aux data DB in place of the real one, with any static data cached from other tests dropped
+    db = str(tmp_path / 'auxdata.sqlite3')
+    monkeypatch.setattr(presets, 'auxdataDB', db)
+    auxdatatools.invalidatestaticdataindex()
+    auxdatatools.clearmemos()
+
+    yield db
+
+    auxdatatools.invalidatestaticdataindex()
+    auxdatatools.clearmemos()
+    sqlitetools.closedbconnections(db)
+
+@pytest.fixture
+def auxdata(auxDB):
+    # a few of each kind of static data: two regions with stations, a wormhole region without, and a ship with its blueprint
+    conn = sqlite3.connect(auxDB)
+    conn.execute('''CREATE TABLE Items (typeID INTEGER PRIMARY KEY, typeName TEXT, groupID INT, marketGroupID INT)''')
+    conn.execute('''CREATE TABLE MarketGroups (marketGroupID INTEGER PRIMARY KEY, parentGroupID INT, marketGroupName TEXT)''')
+    conn.execute('''CREATE TABLE Regions (regionID INTEGER PRIMARY KEY, regionName TEXT)''')
+    conn.execute('''CREATE TABLE Systems (solarsystemID INTEGER PRIMARY KEY, solarsystemName TEXT, regionID INT, constellationID INT, security REAL)''')
+    conn.execute('''CREATE TABLE Stations (stationID INTEGER PRIMARY KEY, stationName TEXT, solarsystemID INT, corporationID INT)''')
+    conn.execute('''CREATE TABLE bpProducts (typeID INT, activityID INT, productTypeID INT, quantity INT)''')
+    conn.execute('''CREATE TABLE bpMaterials (typeID INT, activityID INT, materialTypeID INT, quantity INT)''')
+    conn.execute('''CREATE TABLE bpTimes (typeID INT, activityID INT, time INT)''')
+
+    conn.executemany('''INSERT INTO Items VALUES (?,?,?,?)''', [(34, 'Tritanium', 18, 1857), (35, 'Pyerite', 18, 1857), (587, 'Rifter', 25, 61), (688, 'Rifter Blueprint', 105, 204),
+                                                              (3300, 'Gunnery', 255, 1209), (30001, 'Prototype Blueprint', 105, None)])
+    conn.executemany('''INSERT INTO MarketGroups VALUES (?,?,?)''', [(2, None, 'Blueprints'), (4, None, 'Ships'), (61, 4, 'Frigates'), (150, None, 'Skills'), (204, 2, 'Ships'), (1209, 150, 'Gunnery'),
+                                                                    (475, None, 'Manufacture & Research'), (1857, 475, 'Minerals')])
+    conn.executemany('''INSERT INTO Regions VALUES (?,?)''', [(10000002, 'The Forge'), (10000043, 'Domain'), (11000001, 'A-R00001')])
+    conn.executemany('''INSERT INTO Systems VALUES (?,?,?,?,?)''', [(30000142, 'Jita', 10000002, 20000020, 0.9459), (30000144, 'Perimeter', 10000002, 20000020, 0.9568),
+                                                                   (30002187, 'Amarr', 10000043, 20000322, 1.0), (31000007, 'J100820', 11000001, 21000001, -0.99)])
+    conn.executemany('''INSERT INTO Stations VALUES (?,?,?,?)''', [(60003760, 'Jita IV - Moon 4 - Caldari Navy Assembly Plant', 30000142, 1000035),
+                                                                  (60000361, 'Jita IV - Moon 1 - Ytiri Storage', 30000142, 1000004),
+                                                                  (60012739, 'Perimeter II - Moon 1 - CONCORD Assembly Plant', 30000144, 1000125),
+                                                                  (60008494, 'Amarr VIII (Oris) - Emperor Family Academy', 30002187, 1000086)])
+    conn.execute('''INSERT INTO bpProducts VALUES (?,?,?,?)''', (688, 1, 587, 1))
+    conn.executemany('''INSERT INTO bpMaterials VALUES (?,?,?,?)''', [(688, 1, 34, 32000), (688, 1, 35, 6000)])
+    conn.execute('''INSERT INTO bpTimes VALUES (?,?,?)''', (688, 1, 6000))
+    conn.commit()
+    conn.close()
+
+    return auxDB
+
+class RecordingHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # so connections are kept alive, like a real server
+
+    def do_GET(self):
+        self.server.requests.append({'path' : self.path, 'headers' : dict(self.headers), 'port' : self.client_address[1]})
+
+        status, headers, body = self.server.respond(self)
+
+        self.send_response(status)
+        for header, value in headers.items(): self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def httpserver():
+    # a local HTTP server which records every request it gets
+    # set its respond(handler) to return (status, headers, body) for each request, handler.path/handler.headers are the request's
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RecordingHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.respond = lambda handler: (404, {}, b'')
+    server.url = 'http://127.0.0.1:%s/' % server.server_port
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,225 @@
+import os
+import random
+import sqlite3
+
+import numpy as np
+import pytest
+
+import krabtools
+from krabtools import auxdatatools, presets, sqlitetools
+
+@pytest.mark.parametrize('table, x, y, y_val', [
+    ('Items', 'typeID', 'typeName', 'Tritanium'),
+    ('Items', 'typeName', 'typeID', 34),
+    ('Items', 'typeName', 'groupID', 18), # more than one match
+    ('Items', ('typeID', 'typeName'), 'groupID', 18),
+    ('Items', 'typeID', ('groupID', 'marketGroupID'), (18, 1857)),
+    ('Items', 'typeID', 'typeName', 'Nothing'),
+    ('Items', 'typeID', 'marketGroupID', None), # NULL never matches
+    ('Systems', 'solarSystemID', 'solarSystemName', 'Jita'), # column names are case-insensitive
+    ('Systems', 'security', 'solarsystemID', 30000142),
+    ('Stations', ('stationID', 'solarsystemID'), 'ALL', 'ALL'),
+    ('bpProducts', 'typeID', 'productTypeID', 587),
+    ('Items', 'typeName', 'typeID', '34'), # compared as numbers, by the column's type affinity
+    ('Items', 'typeName', 'typeID', ' 34.0 '),
+    ('Items', 'typeName', 'typeID', '3.4e1'),
+    ('Items', 'typeName', 'typeID', '0x22'), # not a number to SQLite
+    ('Items', 'typeName', ('groupID', 'marketGroupID'), ('18', 1857.0)),
+    ('Systems', 'solarsystemName', 'security', '0.9459'),
+    ('Items', 'typeID', 'typeName', 34), # compared as text
+    ])
+def test_static_data_index_lookups(auxdata, table, x, y, y_val):
+    index = auxdatatools.StaticDataIndex(auxdata)
+
+    for flatten in (True, False):
+        assert index.getxbyy(table, x, y, y_val, flatten) == sqlitetools.getxbyyfromdb(auxdata, table, x, y, y_val, flatten)
+
+@pytest.mark.parametrize('table, column, item', [
+    ('Items', 'typeName', 'Tritanium'),
+    ('Items', 'typeID', 34),
+    ('Items', 'typeID', 1),
+    ('Items', 'typeID', '34'),
+    ('Regions', 'regionName', 'the forge'), # = is case-sensitive for text in SQL
+    ('Systems', 'solarSystemName', 'Perimeter'),
+    ])
+def test_static_data_index_check_item(auxdata, table, column, item):
+    index = auxdatatools.StaticDataIndex(auxdata)
+
+    assert index.checkifitem(table, column, item) == sqlitetools.checkifitemindb(auxdata, table, column, item)
+
+@pytest.mark.parametrize('decltype', ['TEXT', 'VARCHAR(20)', 'INT', 'REAL', 'NUMERIC', ''])
+@pytest.mark.parametrize('value', [34, 34.0, 0.5, 1e20, 123456789.123, True, '34', '34.5', ' 34 ', '+34', '34.', '.5', '1_0', '0x22', 'abc', None])
+def test_type_affinity(decltype, value):
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''CREATE TABLE t (v %s)''' % decltype)
+    conn.executemany('''INSERT INTO t VALUES (?)''', [(ii,) for ii in (34, 34.0, 0.5, 1e20, 123456789.123, '34', '34.0', '0.5', '1.0e+20', '123456789.123', '1', '34.5', ' 34 ', '+34', '34.', '.5', '1_0', '0x22', 'abc')])
+    rows = conn.execute('''SELECT v FROM t''').fetchall()
+
+    converted = auxdatatools.applyaffinity(value, auxdatatools.sqlaffinity(decltype))
+
+    assert [row[0] == converted for row in rows] == [bool(match) for match, in conn.execute('''SELECT v = ? FROM t''', (value,))]
+
+def test_lookups_use_static_data_index(auxdata):
+    auxdatatools.usestaticdataindex()
+    try:
+        assert auxdatatools.getitemid('Tritanium') == 34
+        assert auxdatatools.getstaticdataindex().hastable('Items')
+    finally:
+        auxdatatools.usestaticdataindex(False)
+
+def oldflaggeditems(db):
+    # the items flagitemDB used to flag, one SELECT per category
+    conn = sqlite3.connect(db)
+    skip_ultimate, skip_sub, skip_items = (sqlitetools.sql_placeholder_of_length(len(ii)) for ii in (presets.ultimateMarketGroupsToSkip, presets.subMarketGroupsToSkip, presets.itemsToSkip))
+    queries = (('''SELECT typeID FROM Items WHERE marketGroupID IS NULL''', ()),
+               ('''SELECT Items.typeID FROM Items WHERE Items.marketGroupID not in (SELECT marketGroupID FROM MarketGroups)''', ()),
+               ('''SELECT typeID FROM Items WHERE typeName LIKE ?''', ('%%\'s Modified %',)),
+               ('''SELECT typeID FROM Items WHERE typeName LIKE ?''', ('%%s\' Modified %',)),
+               ('''SELECT Items.typeID FROM Items NATURAL JOIN MarketGroups WHERE MarketGroups.ultimateGroupID IN %s''' % skip_ultimate, presets.ultimateMarketGroupsToSkip),
+               ('''SELECT typeID FROM Items WHERE marketGroupID IN %s''' % skip_sub, presets.subMarketGroupsToSkip),
+               ('''SELECT typeID FROM Items WHERE typeName IN %s''' % skip_items, presets.itemsToSkip))
+    flagged = {typeID for sql_cmd, params in queries for typeID, in conn.execute(sql_cmd, params)}
+    conn.close()
+
+    return flagged
+
+def test_flag_items(auxdata):
+    conn = sqlite3.connect(auxdata)
+    conn.execute('''INSERT INTO MarketGroups VALUES (?,?,?)''', (812, 4, 'Titans'))
+    conn.executemany('''INSERT INTO Items VALUES (?,?,?,?)''', [(671, 'Erebus', 30, 812), (23913, 'Nyx', 659, 61), (13001, "Estamel's Modified Warp Disruptor", 52, 61),
+                                                              (13002, "Brokaras' Modified Heat Sink", 205, 61), (30000, 'Unreleased Thing', 1, None), (30002, 'Odd Item', 1, 99999)])
+    conn.commit()
+    conn.close()
+
+    krabtools.doUltimateMarketGroups()
+    for ii in range(2): # again, as if the table was kept from the last update
+        krabtools.flagitemDB()
+        krabtools.trimBPDB()
+
+    flagged = set(sqlitetools.getxbyyfromdb(auxdata, 'Items', 'typeID', 'ExcludeFromTrade', 1))
+
+    assert flagged == oldflaggeditems(auxdata)
+    assert flagged == {688, 3300, 30001, 671, 23913, 13001, 13002, 30002}
+    assert not sqlitetools.checkifitemindb(auxdata, 'Items', 'typeID', 30000)
+    assert sqlitetools.getxbyyfromdb(auxdata, 'Items', 'typeID', 'Manufacturable', 1) == 587
+
+def walkultimategroups(groups):
+    # what doUltimateMarketGroups did before the recursive query: follow each group's parents up until one has no parent
+    ultimate = {}
+    for group, parent in groups.items():
+        if parent is None: continue
+        while groups[parent] is not None: parent = groups[parent]
+        ultimate[group] = parent
+
+    return ultimate
+
+def test_ultimate_market_groups(auxDB):
+    # a few random trees of market groups, several levels deep
+    rng = random.Random(0)
+    groups = {}
+    for group in range(1, 500): groups[group] = rng.choice([None] + list(groups)[-50:]) if groups else None
+
+    conn = sqlite3.connect(auxDB)
+    conn.execute('''CREATE TABLE MarketGroups (marketGroupID INTEGER PRIMARY KEY, parentGroupID INT, marketGroupName TEXT)''')
+    conn.executemany('''INSERT INTO MarketGroups VALUES (?,?,?)''', [(group, parent, 'Group %s' % group) for group, parent in groups.items()])
+    conn.commit()
+    conn.close()
+
+    krabtools.doUltimateMarketGroups()
+
+    found = dict(sqlitetools.getxbyyfromdb(auxDB, 'MarketGroups', ('marketGroupID', 'ultimateGroupID'), 'ALL', 'ALL'))
+    expected = walkultimategroups(groups)
+
+    assert any(groups[groups[group]] not in (None, expected[group]) for group in expected) # make sure some trees are more than 2 levels deep
+    assert found == {group : expected.get(group) for group in groups}
+
+    coltypes = {col[1] : col[2] for col in sqlitetools.getdbconnection(auxDB).execute('''PRAGMA table_info(MarketGroups)''')}
+    assert coltypes['ultimateGroupID'] == 'INT'
+
+def test_memoise():
+    calls = []
+    @auxdatatools.memoise
+    def lookup(x):
+        calls.append(x)
+        return {'x' : x}
+
+    assert lookup(1) == lookup(1) == {'x' : 1}
+    lookup(1)['x'] = 2 # callers get a copy, not the cached dict
+    assert lookup(1) == {'x' : 1}
+    assert lookup([1]) == lookup([1]) == {'x' : [1]} # can't be cached, but still works
+    assert calls == [1, [1], [1]]
+
+    auxdatatools.clearmemos()
+    lookup(1)
+
+    assert calls == [1, [1], [1], 1]
+    assert auxdatatools.getmemostats()['test_auxdata.lookup'].misses == 1
+
+def test_memoised_lookups_cleared(auxdata):
+    assert auxdatatools.getmatsforbp(688) == {34 : 32000, 35 : 6000}
+
+    conn = sqlite3.connect(auxdata)
+    conn.execute('''UPDATE bpMaterials SET quantity=1''')
+    conn.commit()
+    conn.close()
+
+    assert auxdatatools.getmatsforbp(688) == {34 : 32000, 35 : 6000}
+    auxdatatools.clearmemos()
+    assert auxdatatools.getmatsforbp(688) == {34 : 1, 35 : 1}
+
+@pytest.mark.parametrize('location', [30000142, np.int64(30000142), np.int32(30000142)])
+def test_resolve_location_ID(location):
+    kind, ID = auxdatatools.resolvelocation(location)
+
+    assert (kind, ID) == ('system', 30000142)
+    assert type(ID) is int
+
+def test_resolve_location_invalid():
+    with pytest.raises(Exception): auxdatatools.resolvelocation(True)
+
+def test_incremental_aux_DB_update(auxDB, tmp_path, monkeypatch):
+    # a master DB with one row in every source table
+    masterDB = str(tmp_path / 'master.sqlite3')
+    conn = sqlite3.connect(masterDB)
+    for dataset in presets.auxdatainfo:
+        conn.execute('''CREATE TABLE %s (%s)''' % (dataset['srctable'], ', '.join('%s INT' % col for col in dataset['cols_to_keep'])))
+        conn.execute('''INSERT INTO %s VALUES (%s)''' % (dataset['srctable'], ', '.join('1' for col in dataset['cols_to_keep'])))
+    conn.commit()
+    conn.close()
+
+    fingerprinted = []
+    getsourcefingerprint = krabtools.getsourcefingerprint
+    monkeypatch.setattr(krabtools, 'getsourcefingerprint', lambda conn, srctable, cols: fingerprinted.append(srctable) or getsourcefingerprint(conn, srctable, cols))
+
+    krabtools.createauxDB(masterDB, auxDB)
+    assert fingerprinted == [] # nothing to compare against
+
+    for run in range(2):
+        # the steps after extraction change some tables, stand-ins for them here
+        conn = sqlitetools.getdbconnection(auxDB)
+        with conn:
+            for dataset in presets.auxdatainfo: conn.execute('''DELETE FROM %s''' % dataset['desttable'])
+
+        fingerprinted.clear()
+        krabtools.createauxDB(masterDB, auxDB, incremental=True)
+
+        kept = {dataset['desttable'] for dataset in presets.auxdatainfo if sqlitetools.getxbyyfromdb(auxDB, dataset['desttable'], 'COUNT(*)', 'ALL', 'ALL') == 0}
+        if run == 0:
+            assert kept == set() # no fingerprints from the full rebuild, so everything is rewritten
+        else:
+            assert kept == {'Regions', 'Systems', 'Stations', 'bpTimes'} # unchanged, and nothing else changes them
+        assert fingerprinted == [dataset['srctable'] for dataset in presets.auxdatainfo if dataset['desttable'] not in krabtools.auxdata_postprocessed_tables]
+
+def test_init_aux_data_classifies_locations(auxdata, monkeypatch):
+    monkeypatch.setattr(krabtools, 'skip_aux_data_check', True)
+
+    krabtools.initauxdata() # aux DB from before locations were classified
+
+    assert 'SystemClass' in sqlitetools.tablesindb(auxdata)
+
+def test_init_aux_data_skipped_without_aux_DB(auxDB, monkeypatch):
+    monkeypatch.setattr(krabtools, 'skip_aux_data_check', True)
+
+    krabtools.initauxdata()
+
+    assert not os.path.isfile(auxDB)
@@ -0,0 +1,114 @@
+import calendar
+import re
+import threading
+import time
+
+import pytest
+import requests
+
+import crest
+from crest import presets, sqlitetools
+
+@pytest.fixture
+def session(monkeypatch):
+    # a new shared session for each test
+    monkeypatch.setattr(crest, 'HTTP_session', None)
+    crest.resetrequeststats()
+
+    yield
+
+    crest.closesession()
+
+def test_session_reused(httpserver, session):
+    httpserver.respond = lambda handler: (200, {'Content-Type' : 'application/json'}, b'{}')
+
+    for ii in range(3): crest.httprequest('GET', httpserver.url + 'market/prices/')
+
+    assert len(set(request['port'] for request in httpserver.requests)) == 1 # all over one kept-alive connection
+    assert 'gzip' in httpserver.requests[0]['headers']['Accept-Encoding']
+    assert crest.getrequeststats()['nRequests'] == 3
+
+def test_server_errors_retried(httpserver, session):
+    statuses = [503, 503, 200]
+    httpserver.respond = lambda handler: (statuses.pop(0), {}, b'{}')
+
+    resp = crest.httprequest('GET', httpserver.url + 'market/prices/')
+
+    assert resp.status_code == 200
+    assert len(httpserver.requests) == 3
+
+def test_session_made_once(session, monkeypatch):
+    made = []
+    Session = crest.requests.Session
+    def slowsession():
+        made.append(None)
+        time.sleep(0.05) # plenty of time for the other threads to get in
+        return Session()
+    monkeypatch.setattr(crest.requests, 'Session', slowsession)
+
+    barrier, sessions = threading.Barrier(8), []
+    def getsession():
+        barrier.wait()
+        sessions.append(crest.getsession())
+
+    threads = [threading.Thread(target=getsession) for ii in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    assert len(made) == 1
+    assert all(session is sessions[0] for session in sessions)
+
+def test_rate_limit_messages(httpserver, session, monkeypatch, capsys):
+    httpserver.respond = lambda handler: (200, {}, b'{}')
+    monkeypatch.setattr(crest, 'CREST_cache_enabled', False)
+    monkeypatch.setattr(crest, 'TokenBucket_rate', 0.001, raising=False)
+    monkeypatch.setattr(crest, 'verbose', 1)
+
+    waits = threading.local()
+    def consumetokens(tokens):
+        waits.n = getattr(waits, 'n', 0) + 1
+        if waits.n <= 5: raise crest.NotEnoughTokens()
+    monkeypatch.setattr(crest, 'consumetokens', consumetokens)
+
+    crest.getcrestdatamany([httpserver.url + 'market/prices/?n=%s' % ii for ii in range(8)], max_workers=4)
+
+    out = capsys.readouterr().out
+    assert 'Rate limit reached' in out
+    assert all(re.fullmatch(r'Rate limit reached, sleeping \(\d+(\.\d+)?s\) *', line) for line in re.split('[\r\n]', out) if line) # one whole message at a time
+    assert crest.status_line == ''
+
+@pytest.fixture
+def crestcache(tmp_path, monkeypatch):
+    db = str(tmp_path / 'crestcache.sqlite3')
+    monkeypatch.setattr(presets, 'crestcacheDB', db)
+    monkeypatch.setattr(crest, 'CREST_cache_initialised', False)
+
+    yield db
+
+    sqlitetools.closedbconnections(db)
+
+def test_expired_responses_evicted(crestcache, monkeypatch):
+    now = time.time()
+    crest.storecachedresponse('fresh', '{}', None, None, now + 300)
+    crest.storecachedresponse('expired', '{}', None, None, now - 300)
+    crest.storecachedresponse('expired_etag', '{}', '"abc"', None, now - 300)
+    crest.storecachedresponse('expired_lastmodified', '{}', None, 'Thu, 01 Jan 2016 00:00:00 GMT', now - 300)
+    crest.storecachedresponse('long_expired_etag', '{}', '"abc"', None, now - crest.CREST_cache_keep_stale - 300)
+
+    monkeypatch.setattr(crest, 'CREST_cache_initialised', False) # next session
+    crest.initcrestcache()
+
+    assert set(sqlitetools.getxbyyfromdb(crestcache, 'Responses', 'cacheKey', 'ALL', 'ALL')) == {'fresh', 'expired_etag', 'expired_lastmodified'}
+
+@pytest.mark.parametrize('expires', ['Thu, 01 Jan 2037 00:00:00 GMT', 'Thu, 01 Jan 2037 00:00:00 +0000', 'Thu, 01 Jan 2037 00:00:00 -0000', 'Thu, 01 Jan 2037 01:00:00 +0100'])
+def test_cache_expiry_from_expires_header(expires, monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York') # a naive datetime would be taken as local time
+    time.tzset()
+    resp = requests.Response()
+    resp.headers['Expires'] = expires
+
+    try:
+        assert crest.getcacheexpiry(resp, 'adjprices') == calendar.timegm((2037, 1, 1, 0, 0, 0))
+    finally:
+        monkeypatch.undo()
+        time.tzset()
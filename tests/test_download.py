@@ -0,0 +1,97 @@
+import bz2
+import os
+
+import pytest
+
+import krabtools
+
+def makesource(tmp_path):
+    data = b'SQLite format 3\x00' + os.urandom(200000)
+    srcdir = tmp_path / 'src'
+    srcdir.mkdir()
+    src = srcdir / 'test.sqlite3.bz2'
+    src.write_bytes(bz2.compress(data))
+
+    return data, str(src)
+
+def test_download_and_decompress(tmp_path):
+    data, src = makesource(tmp_path)
+    out = krabtools.downloadanddecompress_bz2(src, outfilepath=str(tmp_path / 'out.sqlite3'), dlpath=str(tmp_path))
+
+    assert open(out, 'rb').read() == data
+    assert not os.path.exists(str(tmp_path / 'test.sqlite3.bz2.part'))
+
+def test_resume_from_partial_download(tmp_path):
+    data, src = makesource(tmp_path)
+    compressed = open(src, 'rb').read()
+    (tmp_path / 'test.sqlite3.bz2.part').write_bytes(compressed[:len(compressed) // 2])
+
+    out = krabtools.downloadanddecompress_bz2(src, outfilepath=str(tmp_path / 'out.sqlite3'), dlpath=str(tmp_path))
+
+    assert open(out, 'rb').read() == data
+
+@pytest.mark.parametrize('corrupt', [
+    lambda compressed: b'garbage' * 1000, # caught while decompressing the partial file
+    lambda compressed: compressed[:len(compressed) // 2] + b'\x00garbage' * 1000, # only caught once the rest arrives
+])
+def test_corrupt_partial_download_starts_again(tmp_path, corrupt):
+    data, src = makesource(tmp_path)
+    compressed = open(src, 'rb').read()
+    (tmp_path / 'test.sqlite3.bz2.part').write_bytes(corrupt(compressed))
+
+    out = krabtools.downloadanddecompress_bz2(src, outfilepath=str(tmp_path / 'out.sqlite3'), dlpath=str(tmp_path))
+
+    assert open(out, 'rb').read() == data
+
+@pytest.fixture
+def bz2server(httpserver, monkeypatch):
+    # serves a bz2 file with an ETag, honouring Range only while If-Range matches it, like a real server
+    monkeypatch.setattr(krabtools.crest, 'HTTP_session', None)
+
+    def serve(compressed, etag):
+        def respond(handler):
+            start = int(handler.headers['Range'][len('bytes='):-1]) if 'Range' in handler.headers else 0
+            if start and handler.headers.get('If-Range') == etag:
+                return (206, {'ETag' : etag, 'Content-Range' : 'bytes %s-%s/%s' % (start, len(compressed) - 1, len(compressed))}, compressed[start:])
+            return (200, {'ETag' : etag}, compressed)
+
+        httpserver.respond = respond
+        return httpserver.url + 'test.sqlite3.bz2'
+
+    yield serve
+
+    krabtools.crest.closesession()
+
+def test_download_over_HTTP_remembers_ETag(tmp_path, httpserver, bz2server):
+    data, src = makesource(tmp_path)
+    url = bz2server(open(src, 'rb').read(), '"v1"')
+
+    with open(str(tmp_path / 'out.sqlite3'), 'wb') as outfile:
+        krabtools.continuedownload_bz2(url, str(tmp_path / 'test.sqlite3.bz2.part'), outfile)
+
+    assert (tmp_path / 'test.sqlite3.bz2.part.validator').read_text() == '"v1"'
+
+    krabtools.downloadanddecompress_bz2(url, outfilepath=str(tmp_path / 'out.sqlite3'), dlpath=str(tmp_path)) # already all there
+
+    assert len(httpserver.requests) == 1
+    assert not os.path.exists(str(tmp_path / 'test.sqlite3.bz2.part.validator'))
+
+@pytest.mark.parametrize('server_etag, validator, expected_requests', [
+    ('"v1"', '"v1"', [('bytes=%s-', '"v1"')]), # same file, carries on from where it stopped
+    ('"v2"', '"v1"', [('bytes=%s-', '"v1"')]), # file has changed, the server sends all of the new one
+    ('"v1"', None, [(None, None)]), # can't tell if it's the same file, so don't try to resume
+])
+def test_resume_over_HTTP(tmp_path, httpserver, bz2server, server_etag, validator, expected_requests):
+    old_data, old_src = makesource(tmp_path)
+    old_compressed = open(old_src, 'rb').read()
+    half = len(old_compressed) // 2
+    (tmp_path / 'test.sqlite3.bz2.part').write_bytes(old_compressed[:half])
+    if validator: (tmp_path / 'test.sqlite3.bz2.part.validator').write_text(validator)
+
+    data = old_data if server_etag == validator else b'SQLite format 3\x00' + os.urandom(200000)
+    url = bz2server(old_compressed if server_etag == validator else bz2.compress(data), server_etag)
+
+    out = krabtools.downloadanddecompress_bz2(url, outfilepath=str(tmp_path / 'out.sqlite3'), dlpath=str(tmp_path))
+
+    assert open(out, 'rb').read() == data
+    assert [(request['headers'].get('Range'), request['headers'].get('If-Range')) for request in httpserver.requests] == [((range_ % half if range_ else None), if_range) for range_, if_range in expected_requests]
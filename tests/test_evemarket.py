@@ -0,0 +1,239 @@
+import os
+import sqlite3
+from statistics import mean, median, stdev
+
+import numpy as np
+import pytest
+
+import evemarket
+import krabtools
+from evemarket import auxdatatools
+
+def test_fill_price_gaps(monkeypatch):
+    batches = []
+    monkeypatch.setattr(auxdatatools, 'getitemid', lambda item: item)
+    monkeypatch.setattr(evemarket, 'getpricesbatch', lambda reqs: batches.append(reqs) or [float(item) for item, order_type, location in reqs])
+    pricelist = {34 : {'buy' : 4.0}}
+
+    evemarket.fillpricegaps([(34, 'buy', 'Jita'), (34, 'sell', 'Jita'), (35, 'buy', 'Jita'), (35, 'buy', 'Jita')], pricelist)
+
+    assert batches == [[(34, 'sell', 'Jita'), (35, 'buy', 'Jita')]] # only the missing prices, once each, all in one batch
+    assert pricelist == {34 : {'buy' : 4.0, 'sell' : 34.0}, 35 : {'buy' : 35.0}}
+
+def olditemstats(orders, order_type):
+    # how getitemstats worked out its price stats before calcorderstats, a price list for each one
+    prices = [order['price'] for order in orders]
+    pctile = (95 if order_type == 'buy' else 5)
+
+    return (round(mean(prices), 2), round(median(prices), 2), (round(stdev(prices), 2) if len(prices) > 1 else 0), round(np.percentile(prices, pctile), 2), len(prices))
+
+@pytest.mark.parametrize('prices', [
+    [5.0],
+    [1.0, 1.01],
+    [0.15, 1.2, 1.86, 2.04], # numpy's std dev rounds the other way
+    [3.27, 9.81, 3.24, 18.35, 18.36, 2.19, 13.54, 2.4, 9.7, 16.69], # and so does mean from fsum
+    [4.99, 5.0, 5.0, 5.01, 5.5, 6.25, 1000000.0],
+    [round(0.01 * ii * ii, 2) for ii in range(1, 101)],
+])
+@pytest.mark.parametrize('order_type', ['buy', 'sell'])
+def test_item_stats_unchanged(prices, order_type):
+    orders = [{'price' : price, 'volume' : 10} for price in prices]
+
+    assert evemarket.getitemstats(34, 'Jita', order_type, orders=orders, get_region_stats=False) == olditemstats(orders, order_type)
+
+@pytest.fixture
+def fakeorders(monkeypatch):
+    # Tritanium has a book of two sell orders, Pyerite has none
+    books = {34 : [{'price' : 5.0, 'volume' : 100}, {'price' : 6.0, 'volume' : 1000}], 35 : []}
+    monkeypatch.setattr(auxdatatools, 'getitemid', lambda item: item)
+    monkeypatch.setattr(auxdatatools, 'getitemName', lambda item: {34 : 'Tritanium', 35 : 'Pyerite'}[item])
+    monkeypatch.setattr(evemarket, 'getordersbatch', lambda reqs: [books[item] for item, location, order_type in reqs])
+
+def walkorderbook(orders, quantity, order_type):
+    # fill quantity one order at a time, best price first, with anything left over at the worst price
+    cost = 0
+    for price, volume in sorted(orders, reverse=(order_type == 'buy')):
+        taken = min(volume, quantity)
+        cost, quantity = cost + taken * price, quantity - taken
+
+    return round(cost + quantity * price, 2)
+
+@pytest.mark.parametrize('order_type', ['buy', 'sell'])
+def test_fill_costs(order_type):
+    orders = [(6.0, 1000), (5.0, 100), (5.5, 10), (7.25, 1)]
+    quantities = [0, 1, 100, 105, 110, 500, 1111, 2000] # the last one is more than the book has
+
+    assert evemarket.calcfillcosts([price for price, volume in orders], [volume for price, volume in orders], quantities, order_type) == [walkorderbook(orders, quantity, order_type) for quantity in quantities]
+    assert evemarket.calcfillcosts([], [], quantities, order_type) == [None] * len(quantities)
+
+def test_matslist_fill_costs(fakeorders):
+    assert evemarket.getmatslistfillcosts({34 : 150}, 'sell') == {34 : 5.0 * 100 + 6.0 * 50}
+
+def test_matslist_fill_costs_empty_book(fakeorders):
+    with pytest.raises(Exception, match='No sell orders for Pyerite at Jita'):
+        evemarket.getmatslistfillcosts({34 : 150, 35 : 10}, 'sell')
+
+def selectordersonebyone(orders, location):
+    # how selectordersbylocation picked out orders before, looking up each order's location
+    if isinstance(location, str): location = auxdatatools.getlocationid(location)
+
+    return [order for order in orders if (auxdatatools.isstation(location) and evemarket.getorderstation(order) == location)
+                                      or (auxdatatools.issystem(location) and evemarket.getordersystem(order) == location)
+                                      or (auxdatatools.isregion(location) and evemarket.getorderregion(order) == location)]
+
+def test_select_orders_by_locations(auxdata):
+    stations = [60003760, 60000361, 60012739, 60008494, 60099999] # the last one isn't in the aux data
+    orders = [{'location' : {'id' : station}, 'price' : float(ii)} for ii, station in enumerate(stations * 3)]
+    locations = [60003760, 'Jita', 30000144, 'The Forge', 10000043, 30002187, 11000001, 31000007]
+
+    assert evemarket.selectordersbylocations(orders, locations) == [selectordersonebyone(orders, location) for location in locations]
+    assert evemarket.selectordersbylocation(orders, 'Jita') == orders[0:2] + orders[5:7] + orders[10:12]
+
+@pytest.fixture
+def fakeorderbook(tmp_path, monkeypatch):
+    # a region with one sell order for Tritanium, counting how many times its order book is pulled
+    pulls = []
+    def getcrestpages(url):
+        pulls.append(url)
+        return [[{'type' : 34, 'stationID' : 60003760, 'buy' : False, 'price' : 5.0, 'volume' : 100, 'issued' : '2016-01-01T00:00:00'}]]
+    monkeypatch.setattr(evemarket.crest, 'getcrestpages', getcrestpages)
+    monkeypatch.setattr(evemarket.crest, 'getcresturl', lambda reqtype, **kwargs: kwargs['regionID'])
+
+    return str(tmp_path / 'orderbook.sqlite3'), pulls
+
+def test_snapshot_orders(fakeorderbook):
+    db, pulls = fakeorderbook
+
+    for ii in range(2): orders = evemarket.getsnapshotorders(34, 10000002, 'sell', db)
+
+    assert pulls == [10000002]
+    assert [(order['location']['id'], order['price'], order['volume']) for order in orders] == [(60003760, 5.0, 100)]
+    assert evemarket.getsnapshotorders(34, 10000002, 'buy', db) == []
+
+@pytest.fixture
+def recordedcrest(httpserver, monkeypatch):
+    # replays CREST responses recorded in tests/data from the local server, with their links pointing back at it
+    recorded = {'/market/10000002/orders/all/' : 'crest_allorders_10000002_page1.json', '/market/10000002/orders/all/?page=2' : 'crest_allorders_10000002_page2.json'}
+
+    def respond(handler):
+        if handler.path not in recorded: return (404, {}, b'{"message" : "Not found"}')
+
+        with open(os.path.join(os.path.dirname(__file__), 'data', recorded[handler.path]), 'rb') as f:
+            return (200, {'Content-Type' : 'application/vnd.ccp.eve.MarketOrderCollection-v1+json'}, f.read().replace(b'https://public-crest.eveonline.com/', httpserver.url.encode()))
+
+    httpserver.respond = respond
+    monkeypatch.setattr(evemarket.crest, 'CREST_public_baseURL', httpserver.url)
+    monkeypatch.setattr(evemarket.crest, 'CREST_cache_enabled', False)
+    monkeypatch.setattr(evemarket.crest, 'HTTP_session', None)
+
+    yield httpserver
+
+    evemarket.crest.closesession()
+
+def test_snapshot_from_recorded_pages(recordedcrest, tmp_path):
+    db = str(tmp_path / 'orderbook.sqlite3')
+
+    sell = evemarket.getsnapshotorders(34, 10000002, 'sell', db)
+    buy = evemarket.getsnapshotorders(34, 10000002, 'buy', db)
+
+    assert [request['path'] for request in recordedcrest.requests] == ['/market/10000002/orders/all/', '/market/10000002/orders/all/?page=2'] # one pass over both pages
+    assert sorted((order['location']['id'], order['price'], order['volume']) for order in sell) == [(60003760, 5.49, 1500000), (60012739, 5.51, 40000)]
+    assert [(order['location']['id'], order['price'], order['volume'], order['buy']) for order in buy] == [(60003760, 5.02, 800000, True)]
+    assert evemarket.getsnapshotorders(35, 10000002, 'sell', db)[0]['issued'] == '2016-05-02T19:40:13'
+    assert len(recordedcrest.requests) == 2
+
+def test_snapshot_expires(fakeorderbook, monkeypatch):
+    db, pulls = fakeorderbook
+    evemarket.getsnapshotorders(34, 10000002, 'sell', db)
+
+    monkeypatch.setattr(evemarket.presets, 'orderbook_snapshot_TTL', -1)
+    evemarket.getsnapshotorders(34, 10000002, 'sell', db)
+
+    assert pulls == [10000002] * 2
+
+def test_snapshot_lookup_uses_index(fakeorderbook):
+    db, pulls = fakeorderbook
+    evemarket.getsnapshotorders(34, 10000002, 'sell', db)
+
+    plan = evemarket.sqlitetools.getdbconnection(db).execute('''EXPLAIN QUERY PLAN SELECT price FROM Orders WHERE typeID=? AND buy=? AND regionID=?''', (34, 0, 10000002)).fetchall()
+
+    assert 'OrdersByType (typeID=? AND buy=? AND regionID=?)' in plan[0][-1]
+
+def test_price_DB_migrated_once(tmp_path, monkeypatch):
+    # price DBs from older versions have a single Prices table of Jita buy & sell prices
+    db = str(tmp_path / 'indyprices.sqlite3')
+    conn = sqlite3.connect(db)
+    conn.execute('''CREATE TABLE Prices (typeID INT PRIMARY KEY, buy REAL, sell REAL)''')
+    conn.executemany('''INSERT INTO Prices VALUES (?,?,?)''', [(34, 4.5, 5.0), (35, None, 9.0)])
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(auxdatatools, 'getlocationid', lambda location: 30000142)
+    tables_checked = []
+    tablesindb = evemarket.sqlitetools.tablesindb
+    monkeypatch.setattr(evemarket.sqlitetools, 'tablesindb', lambda db: tables_checked.append(db) or tablesindb(db))
+
+    for ii in range(3): evemarket.initpriceDB(db)
+
+    assert tables_checked == [db]
+    assert sorted(evemarket.sqlitetools.getxbyyfromdb(db, 'PriceSnapshots', ('typeID', 'locationID', 'side', 'price'), 'ALL', 'ALL')) == [(34, 30000142, 'buy', 4.5), (34, 30000142, 'sell', 5.0), (35, 30000142, 'sell', 9.0)]
+    assert 'Prices' not in tablesindb(db)
+
+def test_refetched_price_gets_new_timestamp(tmp_path, monkeypatch):
+    db = str(tmp_path / 'indyprices.sqlite3')
+    monkeypatch.setattr(auxdatatools, 'getlocationid', lambda location: 30000142)
+
+    assert evemarket.savepricelisttoDB({34: {'buy': 4.5, 'sell': 5.0}}, db, fetched_at=1000, ttl=60) == 2
+    assert sorted(evemarket.getstaleprices(db)) == [(34, 30000142, 'buy'), (34, 30000142, 'sell')]
+
+    # same price fetched again: nothing to write but the timestamp, which stops it being stale
+    assert evemarket.savepricelisttoDB({34: {'buy': 4.5, 'sell': 5.5}}, db, ttl=60) == 1
+    assert evemarket.getstaleprices(db) == []
+    assert sorted(evemarket.sqlitetools.getxbyyfromdb(db, 'PriceSnapshots', ('side', 'price'), 'ALL', 'ALL')) == [('buy', 4.5), ('sell', 5.5)]
+
+def test_price_list_saves_refetched_prices(tmp_path, monkeypatch):
+    db = str(tmp_path / 'indyprices.sqlite3')
+    monkeypatch.setattr(auxdatatools, 'getlocationid', lambda location: 30000142)
+    evemarket.savepricelisttoDB({34: {'buy': 4.5}, 35: {'buy': 9.0}}, db, fetched_at=1000, ttl=60)
+
+    pricelist = evemarket.PriceList()
+    pricelist.load(db)
+    assert not pricelist.isdirty()
+
+    pricelist.update({34: {'buy': 4.5}}) # fetched again, same price
+    assert pricelist.isdirty()
+    assert pricelist.flush(db) == 0 # no price to write...
+    assert evemarket.getstaleprices(db) == [(35, 30000142, 'buy')] # ...but it's fresh again
+    assert not pricelist.isdirty()
+
+def test_price_list_is_for_one_location(auxdata, monkeypatch):
+    monkeypatch.setattr(evemarket, 'getpricesbatch', lambda reqs: [1.0 for req in reqs])
+    pricelist = evemarket.PriceList(location='Jita')
+
+    evemarket.fillpricegaps([(34, 'buy', 'Jita'), (35, 'buy', 30000142)], pricelist)
+    assert pricelist == {34: {'buy': 1.0}, 35: {'buy': 1.0}}
+
+    with pytest.raises(Exception, match='cannot add prices for Amarr'):
+        evemarket.fillpricegaps([(587, 'sell', 'Amarr')], pricelist)
+    assert 587 not in pricelist
+
+def test_delete_price_DB_stops_autosave(tmp_path, monkeypatch):
+    db = str(tmp_path / 'indyprices.sqlite3')
+    monkeypatch.setattr(krabtools.presets, 'indypriceDB', db)
+    monkeypatch.setattr(auxdatatools, 'getlocationid', lambda location: 30000142)
+
+    pricelist = evemarket.PriceList({34: {'buy': 4.5}})
+    pricelist.flush(db)
+    pricelist.startautosave(db, interval=3600)
+    thread = pricelist.autosave_thread
+
+    try:
+        krabtools.deleteindypriceDB()
+
+        assert not thread.is_alive() # stopped before its connection was closed
+        assert pricelist.autosave_thread.is_alive() and pricelist.autosave_interval == 3600 # and started again afterwards
+        assert not (tmp_path / 'indyprices.sqlite3').exists()
+    finally:
+        pricelist.stopautosave()
+
+    assert pricelist not in evemarket.autosaving
@@ -0,0 +1,146 @@
+import random
+import sqlite3
+from collections import Counter
+from math import ceil
+
+import pytest
+
+import indytools
+import krabtools
+from indytools import auxdatatools, evemarket, presets
+
+@pytest.fixture
+def bpgraph(tmp_path, monkeypatch):
+    # makes a blueprint graph from {product : (quantity per run, {material : quantity})}, and uses it for the tests
+    def makegraph(bps):
+        db = str(tmp_path / 'auxdata.sqlite3')
+        activity = presets.bp_activities['Manufacturing']
+
+        conn = sqlite3.connect(db)
+        conn.execute('''CREATE TABLE bpProducts (typeID INT, activityID INT, productTypeID INT, quantity INT)''')
+        conn.execute('''CREATE TABLE bpMaterials (typeID INT, activityID INT, materialTypeID INT, quantity INT)''')
+        conn.execute('''CREATE TABLE bpTimes (typeID INT, activityID INT, time INT)''')
+        for product, (outputqty, mats) in bps.items():
+            conn.execute('''INSERT INTO bpProducts VALUES (?,?,?,?)''', (product + 10000, activity, product, outputqty))
+            conn.execute('''INSERT INTO bpTimes VALUES (?,?,?)''', (product + 10000, activity, 60))
+            conn.executemany('''INSERT INTO bpMaterials VALUES (?,?,?,?)''', [(product + 10000, activity, mat, qty) for mat, qty in mats.items()])
+        conn.commit()
+        conn.close()
+
+        monkeypatch.setattr(indytools, 'blueprintgraph', indytools.BlueprintGraph(db))
+        auxdatatools.clearmemos()
+
+    yield makegraph
+
+    auxdatatools.clearmemos()
+
+def expandmats(bps, product, qty):
+    # base materials for qty of product by walking every path down the tree, only right when every BP makes 1 per run
+    out = Counter()
+    for mat, matqty in bps[product][1].items():
+        if mat in bps:
+            out.update(expandmats(bps, mat, qty * matqty))
+        else:
+            out[mat] += qty * matqty
+
+    return dict(out)
+
+def test_base_mats_shared_components(bpgraph):
+    # component 2 is used by the product and by component 1, so is needed at two different depths
+    bps = {1000 : (1, {1 : 3, 2 : 2, 34 : 10}), 1 : (1, {2 : 5, 35 : 7}), 2 : (1, {34 : 4, 36 : 1})}
+    bpgraph(bps)
+
+    assert indytools.getbasematsforitem(1000, n_produced=3) == expandmats(bps, 1000, 3)
+
+def test_base_mats_components_built_together(bpgraph):
+    # all the demand for a component is added up before working out how many runs of it we need
+    bpgraph({1000 : (1, {1 : 1, 2 : 1}), 1 : (1, {2 : 1}), 2 : (10, {34 : 5})})
+
+    assert indytools.getbasematsforitem(1000) == {34 : 5}
+
+def test_base_mats_component_ME(bpgraph):
+    bpgraph({1000 : (1, {1 : 10}), 1 : (1, {34 : 100})})
+
+    assert indytools.getbasematsforitem(1000, ME_components={1 : 10}) == {34 : 900}
+
+def itembyitemME(matslist, runs, ME, production_efficiences=()):
+    # the ME calculation as it was done before it used arrays, one material at a time
+    matslist_scaled = {}
+    for matID, matqty in matslist.items():
+        matqty *= 1 - (ME * 0.01)
+        for efficiency in production_efficiences: matqty *= 1 - efficiency
+
+        matslist_scaled[matID] = runs if matqty / runs < 1 else ceil(matqty)
+
+    return matslist_scaled
+
+def test_ME_matches_item_by_item():
+    rng = random.Random(0)
+    for ii in range(1000):
+        runs = rng.randint(1, 50)
+        matslist = {matID : rng.choice([1, 2, 3, 7, 10, 11, 100, 101, 999, 12345]) * runs for matID in rng.sample(range(1, 1000), rng.randint(1, 20))}
+        ME = rng.randint(0, 10)
+        efficiencies = rng.choice([[], [0.02], [0.25], [0.02, 0.15, 0.1]])
+
+        assert indytools.scalematslistbyefficiency(matslist, runs, ME, efficiencies) == itembyitemME(matslist, runs, ME, efficiencies)
+
+def test_mats_for_bp_runs(bpgraph):
+    bpgraph({1000 : (1, {34 : 1000, 35 : 7, 36 : 1}), 1001 : (1, {34 : 333, 37 : 2})})
+    configs = [(product, runs, ME) for product in (1000, 1001) for runs in (1, 3, 10) for ME in range(11)]
+
+    assert indytools.getmatsforbpruns(configs) == [indytools.getmatsforitem(product, n_produced=runs, ME=ME) for product, runs, ME in configs]
+    assert indytools.getmatsforbpruns(configs, [0.05]) == [indytools.getmatsforitem(product, n_produced=runs, ME=ME, production_efficiences=[0.05]) for product, runs, ME in configs]
+
+def test_build_costs_depth_pricing(bpgraph, monkeypatch):
+    bpgraph({1000 : (1, {34 : 150, 35 : 10})})
+    books = {34 : [{'price' : 5.0, 'volume' : 100}, {'price' : 6.0, 'volume' : 1000}], 35 : [{'price' : 10.0, 'volume' : 10}]}
+    monkeypatch.setattr(auxdatatools, 'getitemid', lambda item: item)
+    monkeypatch.setattr(evemarket, 'getordersbatch', lambda reqs: [books[item] for item, location, order_type in reqs])
+    monkeypatch.setattr(indytools, 'calcjobfee', lambda item, runs, systemModifier, buildLocation='POS': 1000.0)
+    monkeypatch.setattr(indytools, 'verbose', 1)
+
+    costs = indytools.calcbuildcosts(1000, 1, depthPricing=True)
+
+    assert costs['baseMatsCosts'] == {34 : 5.0 * 100 + 6.0 * 50, 35 : 10.0 * 10}
+    assert costs['totalCost'] == sum(costs['baseMatsCosts'].values()) + sum(costs['baseMatsBuyFees'].values()) + 1000.0
+
+@pytest.fixture
+def adjprices(auxdata):
+    # the aux data with Rifters flagged manufacturable, adjusted prices for their materials, and a BP for something that isn't an item
+    conn = sqlite3.connect(auxdata)
+    conn.execute('''ALTER TABLE Items ADD COLUMN adjPrice REAL''')
+    conn.executemany('''UPDATE Items SET adjPrice=? WHERE typeID=?''', [(5.0, 34), (10.0, 35)])
+    conn.execute('''INSERT INTO bpProducts VALUES (?,?,?,?)''', (30001, 1, 99999, 1))
+    conn.execute('''INSERT INTO bpMaterials VALUES (?,?,?,?)''', (30001, 1, 34, 10))
+    conn.commit()
+    conn.close()
+
+    krabtools.invalidateauxdatacaches()
+    krabtools.trimBPDB()
+
+    yield auxdata
+
+    krabtools.invalidateauxdatacaches()
+
+def test_base_costs(adjprices):
+    krabtools.updatebasecosts()
+
+    assert krabtools.basecosts_cache == {587 : 32000 * 5.0 + 6000 * 10.0} # only manufacturable items
+    assert krabtools.getbasecostforitem('Rifter') == krabtools.calcbasecostforitem(587, updatedb=False) == 220000.0
+    assert krabtools.getbasecostforitem('Tritanium') is None
+    assert indytools.calcjobfee(587, 2, 0.5) == 220000.0
+
+def test_base_costs_missing_adj_price(adjprices, monkeypatch):
+    conn = sqlite3.connect(adjprices)
+    conn.execute('''UPDATE Items SET adjPrice=NULL WHERE typeID=35''')
+    conn.commit()
+    conn.close()
+
+    assert krabtools.calcbasecostforitem(587, updatedb=False) is None
+
+    monkeypatch.setattr(krabtools, 'calcbasecostforitem', None) # looking up a missing base cost mustn't calculate (and write) it
+    assert krabtools.getbasecostforitem(587) is None
+    assert krabtools.getbasecostforitem(587) is None
+
+    with pytest.raises(Exception, match='No base cost for 587'):
+        indytools.calcjobfee(587, 1, 0.5)
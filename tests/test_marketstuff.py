@@ -0,0 +1,164 @@
+import random
+import sqlite3
+import threading
+from operator import itemgetter
+
+import pytest
+
+import evemarket
+import marketstuff
+import presets
+from marketstuff import auxdatatools
+from marketstuff import sqlitetools
+
+@pytest.fixture
+def marketDB(tmp_path, monkeypatch):
+    db = str(tmp_path / 'market.sqlite3')
+    monkeypatch.setattr(presets, 'marketDB', db)
+
+    yield db
+
+    sqlitetools.closedbconnections(db)
+
+def test_init_market_DB_uses_pooled_connection(marketDB, monkeypatch):
+    conn = sqlitetools.getdbconnection(marketDB)
+    monkeypatch.setattr(sqlite3, 'connect', None) # no connections of its own
+
+    marketstuff.initmarketDB()
+
+    assert {'MarketItems', 'Trades', 'Scans', 'ScanCheckpoint'} <= {row[0] for row in conn.execute('''SELECT name FROM sqlite_master WHERE type='table' ''')}
+
+def oldfindtrades(entries, margin_threshold_pct, margin_threshold_abs, min_volume_abs, max_competition):
+    # the per-item loop findtrades used to run (with the column names fixed), on rows of (ItemID, systemID, MedianPrice, MeanRegionalVolume, nOrders)
+    margin_threshold = margin_threshold_pct / 100
+
+    trades = []
+    for item in sorted(set(entry[0] for entry in entries)):
+        itementries = [entry[1:] for entry in entries if entry[0] == item and entry[2] is not None and entry[3] is not None]
+        if not itementries: continue
+
+        max_entry = max(itementries, key=itemgetter(1))
+
+        if max_entry[2] < min_volume_abs: continue
+        if max_entry[3] > max_competition: continue
+
+        minprice_for_margin = max_entry[1] / (margin_threshold + 1)
+
+        for entry in itementries:
+            if entry[1] <= minprice_for_margin:
+                this_margin = (max_entry[1] - entry[1]) / entry[1]
+
+                if this_margin * entry[1] >= margin_threshold_abs:
+                    trades.append( (item, entry[0], entry[1], entry[2], max_entry[0], max_entry[1], max_entry[2], max_entry[3]) )
+
+    return trades
+
+def test_find_trades(marketDB):
+    rng = random.Random(0)
+    entries = [(item, system, rng.choice([None] + list(range(1, 20))), rng.choice([None, 10.0, 100.0, 1000.0]), rng.randint(0, 10)) for item in range(50) for system in range(20)]
+
+    marketstuff.initmarketDB()
+    marketstuff.addtomarketDB([(item, system, price, price, 0.0, price, nOrders, volume, 0.0) for item, system, price, volume, nOrders in entries], 'MarketItems')
+
+    for itemIDs in (None, list(range(0, 50, 3)) + [0]):
+        marketstuff.findtrades(itemIDs, 20, 2.5, 50, 5)
+
+        trades = sqlitetools.getdbconnection(marketDB).execute('''SELECT ItemID, BuysystemID, BuyMedianPrice, BuyMeanRegionalVolume, SellsystemID, SellMedianPrice, SellMeanRegionalVolume, nSellOrders
+                                                                   FROM Trades ORDER BY rowid''').fetchall()
+        expected = oldfindtrades([entry for entry in entries if itemIDs is None or entry[0] in itemIDs], 20, 2.5, 50, 5)
+
+        assert trades == expected
+        assert len(expected) > 10
+
+def test_find_trades_verbose(marketDB, monkeypatch, capsys):
+    monkeypatch.setattr(marketstuff, 'verbose', 1)
+    monkeypatch.setattr(auxdatatools, 'getitemName', lambda item: 'item %s' % item)
+    monkeypatch.setattr(auxdatatools, 'getsystemName', lambda system: 'system %s' % system)
+
+    marketstuff.initmarketDB()
+    assert 'MarketItemsByItem' in {row[0] for row in sqlitetools.getdbconnection(marketDB).execute('''SELECT name FROM sqlite_master WHERE type='index' ''')}
+
+    marketstuff.addtomarketDB([(1, 10, 4.0, 4.0, 0.0, 4.0, 1, 100.0, 0.0), (1, 11, 0.0, 0.0, 0.0, 0.0, 1, 100.0, 0.0), (1, 12, 10.0, 10.0, 0.0, 10.0, 1, 100.0, 0.0)], 'MarketItems')
+    marketstuff.findtrades(None, 20, 1, 50, 5)
+
+    out = capsys.readouterr().out
+    assert 'item 1, system 10 -> system 12. Margin: 150.0%' in out
+    assert 'item 1, system 11 -> system 12. Margin: n/a' in out # bought for nothing
+    assert sqlitetools.gettablelen(marketDB, 'Trades') == 2
+
+@pytest.fixture
+def fakemarket(marketDB, monkeypatch):
+    # two regions of three systems each, with CREST replaced by fixed stats
+    monkeypatch.setattr(auxdatatools, 'getsystemregion', lambda system: 10000000 + system // 10)
+    monkeypatch.setattr(evemarket, 'getorders', lambda item, location, order_type: [])
+    monkeypatch.setattr(evemarket, 'getavgregionstats', lambda item, region, avg_period: (10.0, 1.0))
+    monkeypatch.setattr(evemarket, 'selectordersbylocations', lambda orders, locations: [[] for location in locations])
+    monkeypatch.setattr(evemarket, 'getitemstats', lambda item, system, order_type, orders=None, get_region_stats=True: (1.0, 1.0, 0.0, 1.0, 0))
+
+    return list(range(100)), [1, 2, 3, 11, 12, 13]
+
+def runscan(*args, **kwargs):
+    # run the scan in a thread so a deadlock fails the test rather than hanging it
+    result = {}
+    def scan():
+        try:
+            result['timings'] = marketstuff.pullitemstatstomarketDB(*args, **kwargs)
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=scan, daemon=True)
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), 'scan deadlocked'
+
+    return result
+
+def scannedpairs():
+    return sorted(sqlitetools.getdbconnection(presets.marketDB).execute('''SELECT ItemID, systemID FROM MarketItems''').fetchall())
+
+def test_scan(fakemarket):
+    items, systems = fakemarket
+    result = runscan(items, systems, 'sell', cache_limit=10, max_workers=4)
+
+    assert result['timings']['n_written'] == len(items) * len(systems)
+    assert scannedpairs() == sorted((item, system) for item in items for system in systems)
+
+def test_scan_resumes(fakemarket, monkeypatch):
+    items, systems = fakemarket
+    def getorders(item, location, order_type):
+        if item == 55: raise Exception('CREST error')
+        return []
+    monkeypatch.setattr(evemarket, 'getorders', getorders)
+    monkeypatch.setattr(marketstuff, 'scan_shard_size', 10)
+
+    assert str(runscan(items, systems, 'sell', cache_limit=5, max_workers=2)['error']) == 'CREST error'
+
+    monkeypatch.setattr(evemarket, 'getorders', lambda item, location, order_type: [])
+    result = runscan(items, systems, 'sell', cache_limit=5, max_workers=2, resume=True)
+
+    assert result['timings']['n_written'] < len(items) * len(systems) # carried on, rather than starting again
+    assert scannedpairs() == sorted((item, system) for item in items for system in systems)
+
+def test_writer_error_stops_scan(fakemarket, monkeypatch):
+    items, systems = fakemarket
+    def insertmarketitems(conn, entries): raise sqlite3.OperationalError('disk I/O error')
+    monkeypatch.setattr(marketstuff, 'insertmarketitems', insertmarketitems)
+
+    result = runscan(items, systems, 'sell', cache_limit=1, max_workers=2)
+
+    assert isinstance(result['error'], sqlite3.OperationalError)
+
+def test_worker_error_stops_scan(fakemarket, monkeypatch):
+    items, systems = fakemarket
+    pulled = []
+    def getorders(item, location, order_type):
+        pulled.append(item)
+        if item == 0: raise Exception('CREST error')
+        return []
+    monkeypatch.setattr(evemarket, 'getorders', getorders)
+    monkeypatch.setattr(marketstuff, 'scan_shard_size', 1)
+
+    result = runscan(items, systems, 'sell', max_workers=1)
+
+    assert str(result['error']) == 'CREST error'
+    assert len(pulled) < len(items) # didn't carry on through the other shards first
@@ -0,0 +1,39 @@
+import sqlite3
+import threading
+
+import pytest
+
+import sqlitetools
+
+def connectinthread(db):
+    conns = []
+    thread = threading.Thread(target=lambda: conns.append(sqlitetools.getdbconnection(db)))
+    thread.start()
+    thread.join()
+
+    return conns[0]
+
+def test_connection_pooled_per_thread(tmp_path):
+    db = str(tmp_path / 'test.sqlite3')
+
+    assert sqlitetools.getdbconnection(db) is sqlitetools.getdbconnection(db)
+    assert connectinthread(db) is not sqlitetools.getdbconnection(db)
+
+    sqlitetools.closedbconnections(db)
+
+def test_finished_threads_connections_closed(tmp_path):
+    db = str(tmp_path / 'test.sqlite3')
+    conns = [connectinthread(db) for ii in range(3)]
+
+    sqlitetools.prunedbconnections()
+
+    for conn in conns:
+        with pytest.raises(sqlite3.ProgrammingError): conn.execute('''SELECT 1''')
+
+    assert not any(key[1] == str(tmp_path / 'test.sqlite3') for key in sqlitetools.db_connections)
+
+def test_readonly_missing_db(tmp_path):
+    db = str(tmp_path / 'missing.sqlite3')
+
+    with pytest.raises(Exception, match='does not exist'): sqlitetools.getdbconnection(db, readonly=True)
+    assert not (tmp_path / 'missing.sqlite3').exists()